@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 from datetime import datetime
 from functools import partial
@@ -5,22 +7,56 @@ from math import sqrt
 from time import sleep, time
 
 import altair as alt
-import geopandas as gpd
 import polars as pl
+import pyarrow as pa
 import streamlit as st
 from streamlit.components.v1 import html
 
 from utils import (
-    download_all, fill_all_taxes, 
-    _try_download, TAX_GROUPS
+    LABEL_COLUMNS, bounded_cache, calculate_tax_base, clean_rates,
+    clean_scales, cube_taxes, download_year, export_reference_data,
+    fill_all_taxes, get_schedule, invalidate_downloads, load_cube,
+    manifest_digest, rate_curves, scan_all_taxes, select_scales
 )
+from utils.geodata import canton_static_url, map_layer, static_url
+from utils.instrumentation import (
+    PROFILE_DIR, Trace, configure_logging, profile, span, timed, trace
+)
+
+# rendered maps are kept in memory and, if set, also on disk
+MAP_CACHE_BYTES = int(os.environ.get('TAXMAPP_MAP_CACHE_MB', 64)) * 2**20
+MAP_CACHE_DIR = os.environ.get('TAXMAPP_MAP_CACHE_DIR')
+# the debug panel is shown if set, or with ?debug=1 in the url
+DEBUG = bool(os.environ.get('TAXMAPP_DEBUG'))
+
+
+def get_table(income: float, assets: float, canton: str = 'All cantons',
+              columns: list[str] | None = None, **kwargs) -> pl.DataFrame:
+    # grid-aligned amounts are looked up in the materialised cube, if built
+    table = cube_taxes(income, assets, **kwargs)
+    if table is None and canton == 'All cantons':
+        # fill_all_taxes holds its own bounded cache, shared by all sessions
+        table = fill_all_taxes(income, assets, **kwargs)
+    if table is None:
+        # only the canton's rates get the tax bases of `columns` computed
+        return scan_all_taxes(
+            income, assets, where=pl.col('canton') == canton,
+            columns=columns, **kwargs
+        ).collect()
+    if canton != 'All cantons':
+        table = table.filter(pl.col('canton') == canton)
+    return table if columns is None else table.select(*LABEL_COLUMNS, *columns)
 
 
-@st.cache_data
-def get_table(income: float, assets: float, **kwargs) -> pl.DataFrame:
-    return fill_all_taxes(income, assets, **kwargs)
+def get_labels() -> pl.DataFrame:
+    # the communes and cantons of the rates, no tax gets computed
+    return (
+        clean_rates().filter(pl.col('FSO_ID').is_not_null())
+        .select('canton_ID', 'canton', 'FSO_ID', 'commune')
+    )
 
 
+@timed()
 def display_table(income: float, assets: float, **kwargs) -> None:
     column_names = {
         'canton_ID': 'Canton ID',
@@ -32,20 +68,15 @@ def display_table(income: float, assets: float, **kwargs) -> None:
         'assets_tax': st.column_config.NumberColumn("Assets Tax", format="%.2f"),
         'total': st.column_config.NumberColumn("Total", format="%.2f"),
     }
-    table = get_table(income, assets, **kwargs).select(column_names.keys())
     options = ['All cantons']
-    options.extend(table['canton'].unique().sort())
+    options.extend(get_labels()['canton'].unique().sort())
     canton = st.pills('Filter by canton', options, default='All cantons')
-    if canton == 'All cantons':
-        table = table.sort(by='total')
-        st.dataframe(table, column_config=column_names)
-    else:
-        table = (
-            table
-            .sort(by='total')
-            .filter(pl.col('canton').is_in([canton]))
-        )
-        st.dataframe(table, column_config = column_names) 
+    table = (
+        get_table(income, assets, canton, **kwargs)
+        .select(column_names.keys())
+        .sort(by='total')
+    )
+    st.dataframe(table, column_config=column_names)
     # st.download_button(
     #     label = "Download data as CSV file",
     #     data  = table.write_csv(),
@@ -53,63 +84,97 @@ def display_table(income: float, assets: float, **kwargs) -> None:
     #     mime = "text/csv",
     # ) # streamlit can make it by default, so it's redundant
 
-@st.cache_data
-def create_map(income: float, assets: float, 
-               canton: str = 'All cantons', **kwargs) -> alt.Chart:
-    PATH_S = (
-        './geodata/2024_GEOM_TK/01_INST'
-        '/Gesamtfläche_gf/K4_suis18480101_gf'
-        '/K4suis18480101gf_ch2007Poly.shp'
-    )
-    PATH_K = (
-        './geodata/2024_GEOM_TK/01_INST'
-        '/Gesamtfläche_gf/K4_kant20220101_gf'
-        '/K4kant20220101gf_ch2007Poly.shp'
-    )
-    PATH_G = (
-        './geodata/2024_GEOM_TK/01_INST'
-        '/Gesamtfläche_gf/K4_polg20240101_gf'
-        '/K4polg20240101gf_ch2007Poly.shp'
-    )
-    sdf: gpd.GeoDataFrame = gpd.read_file(PATH_S).to_crs("EPSG:4326")
-    kdf: gpd.GeoDataFrame = gpd.read_file(PATH_K).to_crs("EPSG:4326")
-    gdf: gpd.GeoDataFrame = gpd.read_file(PATH_G).to_crs("EPSG:4326")
-    gdf['id_i64'] = gdf['id'].astype(int)
-    table = get_table(income, assets, **kwargs)
-    layer1 = (
-        alt.Chart(sdf)
-        .mark_geoshape(stroke='white', strokeWidth=3, color='null')
-        .properties(width=600)        
-    )
-    layer2 = (
-        alt.Chart(kdf)
-        .mark_geoshape(stroke='white', strokeWidth=1, color='null')
-        .properties(width=600) 
-      
+@st.cache_resource(show_spinner=False)
+def reference_data() -> list[str]:
+    # exported by the first process, every other one maps the same files
+    return export_reference_data()
+
+
+@st.cache_resource(show_spinner=False)
+def mapped_layer(layer: str, resolution: str) -> pa.Table:
+    return map_layer(layer, resolution)
+
+
+def shape_extent(layer: str, resolution: str, index: int) -> dict[str, float]:
+    """Centroid and bounds of a shape, read from the mapped layer"""
+    table = mapped_layer(layer, resolution)
+    return {
+        column: table.column(column)[index].as_py()
+        for column in ['centroid_x', 'centroid_y', 'minx', 'miny', 'maxx', 'maxy']
+    }
+
+
+def url_chart(url: str) -> alt.Chart:
+    """Chart of a GeoJSON file fetched (and cached) by the browser"""
+    return alt.Chart(
+        alt.UrlData(url, format=alt.DataFormat(type='json', property='features'))
     )
-    layer3 = (
-        alt.Chart(gdf)
+
+
+def geo_chart(layer: str, resolution: str) -> alt.Chart:
+    """Chart of a whole geometry layer"""
+    return url_chart(static_url(layer, resolution))
+
+@timed()
+def create_map(income: float, assets: float, 
+               canton: str = 'All cantons', with_neighbours: bool = True,
+               **kwargs) -> alt.Chart:
+    # the map only shows the totals of the selected canton
+    sel = get_table(income, assets, canton, columns=['total'], **kwargs)
+    domain = [sel['total'].min(), sel['total'].max()]
+    if canton == 'All cantons':
+        resolution = 'coarse'
+        with span('map_geometry'):
+            extent = shape_extent('switzerland', resolution, 0)
+        communes = geo_chart('communes', resolution)
+        outlines = [
+            geo_chart('cantons', resolution)
+            .mark_geoshape(stroke='white', strokeWidth=1, color='null')
+            .properties(width=600),
+            geo_chart('switzerland', resolution)
+            .mark_geoshape(stroke='white', strokeWidth=3, color='null')
+            .properties(width=600),
+        ]
+        context = []
+    else:
+        # only the canton's own geometry (and a thin ring of neighbouring
+        # communes) is sent to the browser
+        canton_id = sel[0, 'canton_ID']
+        with span('map_geometry'):
+            extent = shape_extent('cantons', 'fine', canton_id-1)
+        communes = url_chart(canton_static_url(canton_id, 'communes'))
+        outlines = [
+            url_chart(canton_static_url(canton_id, 'boundary'))
+            .mark_geoshape(stroke='white', strokeWidth=3, color='null')
+            .properties(width=600),
+        ]
+        context = [
+            url_chart(canton_static_url(canton_id, 'ring'))
+            .mark_geoshape(stroke='white', strokeWidth=0.2, color='gainsboro')
+            .properties(width=600)
+        ] if with_neighbours else []
+    deltamax = max(extent['maxx']-extent['minx'], extent['maxy']-extent['miny'])
+    base_layer = (
+        communes
         .mark_geoshape(stroke='white', strokeWidth=0.2, color='lightslategray')
         .properties(width=600)       
     )
-    domain = [table['total'].min(), table['total'].max()]
-    if canton == 'All cantons':
-        sel = table.to_pandas()
-        center = sdf.centroid[0]
-        bounds = sdf.bounds.iloc[0]
-    else:
-        sel = table.filter(pl.col('canton').is_in([canton])).to_pandas()
-        canton_id = sel['canton_ID'].iloc[0]
-        center = kdf.centroid[canton_id-1]
-        bounds = kdf.bounds.iloc[canton_id-1]
-    deltamax = max(bounds.maxx-bounds.minx, bounds.maxy-bounds.miny)
-    gdf_data = gdf.merge(sel, left_on='id_i64', right_on='FSO_ID')
-    gdf_data['Overall taxes CHF'] = gdf_data['total']  
+    # only the FSO_ID -> total vector changes between renders, 
+    # it is joined to the cached geometry in the browser. It is attached
+    # once at the top level by name: altair copies and validates inline
+    # values again for every layer
+    totals = alt.NamedData('totals')
     top_layer = (
-        alt.Chart(gdf_data)
+        communes
+        .transform_lookup(
+            lookup = 'properties.id',
+            from_ = alt.LookupData(totals, key='FSO_ID', fields=['total'])
+        )
+        .transform_filter('isValid(datum.total)')
+        .transform_calculate(**{'Overall taxes CHF': 'datum.total'})
         .mark_geoshape(stroke='white', strokeWidth=0.2)
         .encode(
-            alt.Color('Overall taxes CHF').scale(
+            alt.Color('Overall taxes CHF:Q').scale(
                 domain = domain,
                 scheme = 'redyellowblue', # 'redyellowgreen' not colorblind-friendly
                 # type = 'quantize',
@@ -135,17 +200,20 @@ def create_map(income: float, assets: float,
             alt.Y('y:Q').scale(domain=[0,400])
         )
     )
-    swissmap: alt.LayerChart = (layer3 + top_layer + layer2 + layer1)
+    swissmap: alt.LayerChart = alt.layer(*context, base_layer, top_layer, *outlines)
     if canton != 'All cantons':
         swissmap = swissmap.project( 
             # type = "identity",       
             # clipExtent = [[bounds.minx, bounds.miny], [bounds.maxx, bounds.maxy]],
-            center = (center.x, center.y),
+            center = (extent['centroid_x'], extent['centroid_y']),
             scale = 10_000 / sqrt(deltamax)
         )
 
     return (
         alt.layer(swissmap, annotation)
+        .properties(datasets={
+            'totals': sel.select('FSO_ID', pl.col('total').round(2)).to_dicts()
+        })
         .resolve_axis(x='independent', y='independent')
         .configure(background='null')
         .configure_axis(disable=True)
@@ -163,46 +231,77 @@ def create_map(income: float, assets: float,
     )
 
 
-def add_map(chart: alt.Chart) -> None:
-    """Salva la mappa come file html e la carica in streamlit"""
-    if not os.path.isdir('cachedata'):
-        os.mkdir('cachedata')
-    chart.save('cachedata/map.html', embed_options={'renderer':'svg'})
-    with open('cachedata/map.html') as fp:
-        html(fp.read(), height=500)
+def _map_key(income: float, assets: float, canton: str, **kwargs) -> str:
+    """Content hash of the inputs a rendered map depends on"""
+    payload = json.dumps(
+        [income, assets, canton, sorted(kwargs.items()), manifest_digest()],
+        default=str
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+@bounded_cache(max_bytes=MAP_CACHE_BYTES, quantize={'income': 1, 'assets': 1})
+@timed()
+def render_map(income: float, assets: float, 
+               canton: str = 'All cantons', **kwargs) -> str:
+    """Renders the map to html in memory, optionally backed by files 
+    named after the content hash of the inputs"""
+    file_path = None
+    if MAP_CACHE_DIR:
+        key = _map_key(income, assets, canton, **kwargs)
+        file_path = os.path.join(MAP_CACHE_DIR, f'{key}.html')
+        if os.path.isfile(file_path):
+            with open(file_path, encoding='UTF-8') as fp:
+                return fp.read()
+    chart = create_map(income, assets, canton, **kwargs)
+    with span('altair_to_html') as fields:
+        map_html = chart.to_html(embed_options={'renderer':'svg'})
+        fields['bytes'] = len(map_html)
+    if file_path is not None:
+        os.makedirs(MAP_CACHE_DIR, exist_ok=True)
+        tmp_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as fp:
+            fp.write(map_html)
+        os.replace(tmp_path, file_path)
+    return map_html
+
+
+@timed()
+def add_map(map_html: str) -> None:
+    """Carica la mappa renderizzata in streamlit"""
+    html(map_html, height=500)
 
 
 def show_map(income: float, assets: float, **kwargs) -> None:
-    table = get_table(income, assets, **kwargs)
     options = ['All cantons']
-    options.extend(table['canton'].unique().sort())
+    options.extend(get_labels()['canton'].unique().sort())
     canton = st.pills(
         'Filter by canton', options, 
         default='All cantons', key="pills1"
     )
-    add_map(create_map(income, assets, canton, **kwargs))
+    add_map(render_map(income, assets, canton, **kwargs))
 
 
+@timed()
 def show_1v1(**kwargs):
     income, assets = get_user_inputs('k1', 'k2')
-    table = get_table(income, assets, **kwargs).with_columns(
-        (100*pl.col('total')/income).alias('ratio_percentage')
-    )
+    # communes are picked from the labels, only the two on screen get taxed
+    labels = get_labels()
     st.divider()
     sx, central, dx = st.columns([4,1,4], vertical_alignment='bottom')
     options = ['All cantons']
-    options.extend(table['canton'].unique().sort())
+    options.extend(labels['canton'].unique().sort())
     # swap = central.button(':material/sync_alt:')
-    default1, default2 = table['commune'].unique().sort()[:2]
+    default1, default2 = labels['commune'].unique().sort()[:2]
     with sx:
         canton_sx = st.pills(
             'Filter by canton', options, 
             default='All cantons', key="pills_sx"
         )
         if canton_sx == 'All cantons':
-            sel1 = table.filter(pl.col('commune') != default2)
+            sel1 = labels.filter(pl.col('commune') != default2)
         else:
-            sel1 = table.filter(
+            sel1 = labels.filter(
                 (pl.col('canton').is_in([canton_sx]))
                 & (pl.col('commune') != st.session_state.get('city2', default2))
             )
@@ -218,11 +317,11 @@ def show_1v1(**kwargs):
             default='All cantons', key="pills_dx"
         )
         if canton_dx == 'All cantons':
-            sel2 = table.filter(
+            sel2 = labels.filter(
                 pl.col('commune') != st.session_state.get('city1', default1)
             )
         else:
-            sel2 = table.filter(
+            sel2 = labels.filter(
                 (pl.col('canton').is_in([canton_dx]))
                 & (pl.col('commune') != city1)
             )
@@ -232,8 +331,17 @@ def show_1v1(**kwargs):
             key='city2'
         )
     
-    row1 = table.filter(pl.col('commune') == city1)
-    row2 = table.filter(pl.col('commune') == city2)
+    pair = (
+        scan_all_taxes(
+            income, assets,
+            where = pl.col('commune').is_in([city1, city2]),
+            **kwargs
+        )
+        .with_columns((100*pl.col('total')/income).alias('ratio_percentage'))
+        .collect()
+    )
+    row1 = pair.filter(pl.col('commune') == city1)
+    row2 = pair.filter(pl.col('commune') == city2)
     sx.html(f'<p style="text-align: justify; font-size: 80%; margin: 0">'
             f'CHF {row1[0, "total"]:,.2f}'
             f' ({row1[0, "ratio_percentage"]:.2f}% of income)</p>')
@@ -302,7 +410,7 @@ def show_1v1(**kwargs):
             alt.Color('value', title='CHF').scale(
                 scheme = 'redyellowblue',
                 reverse = True,
-                domain = [table['total'].min(), table['total'].max()]
+                domain = [0, pair['total'].max()]
                 # type = 'quantize'
             ),
             # alt.Opacity('opacity:Q', legend=None)
@@ -358,43 +466,78 @@ def show_1v1(**kwargs):
                                                           width="small"),
     }
     st.dataframe(pl.concat([row1, row2]), use_container_width=True, column_config=column_names)
+    show_rate_curves(
+        [row1[0, 'FSO_ID'], row2[0, 'FSO_ID']], income, **kwargs
+    )
+
+
+@timed()
+def show_rate_curves(fso_ids: list[int], income: float, **kwargs) -> None:
+    """Marginal and effective income tax rates (federal tax included),
+    straight from the scales brackets"""
+    curves = (
+        rate_curves(fso_ids, upper=max(200_000, 2*income), **kwargs)
+        .unpivot(
+            on = ['marginal_rate', 'effective_rate'],
+            index = ['commune', 'amount'],
+            variable_name = 'rate'
+        )
+        .with_columns(
+            pl.col('rate').str.replace('_rate', '').str.to_titlecase()
+        )
+    )
+    lines = (
+        alt.Chart(curves)
+        .mark_line(strokeWidth=2)
+        .encode(
+            alt.X('amount:Q', title='Taxable income CHF'),
+            alt.Y('value:Q', title='Income tax rate').axis(format='%'),
+            alt.Color('commune:N', title='Commune'),
+            alt.StrokeDash('rate:N', title='Rate'),
+            tooltip = ['commune:N', 'rate:N', 'amount:Q',
+                       alt.Tooltip('value:Q', format='.2%')]
+        )
+    )
+    current = (
+        alt.Chart(pl.DataFrame({'amount': [income]}))
+        .mark_rule(stroke='red', strokeWidth=2)
+        .encode(alt.X('amount:Q'))
+    )
+    st.altair_chart(
+        (lines + current).configure_legend(orient='top'),
+        use_container_width=True
+    )
 
 
 def download_data(year: int = datetime.today().year):
     t0 = time()
-    text = 'Download {}/54. {:.0f}m{:.0f}s to end.'
-    my_bar = st.progress(1, text=text.format(0, 5, 0))
-    for adv, key in enumerate(TAX_GROUPS.keys(), 1):
-        try:
-            _try_download(key, year, taxType='income', rs='scales')
-            t1 = time()
-            left_time = (54-adv)*(t1-t0)/adv
-            mins, secs = divmod(left_time, 60)
-            my_bar.progress(round(adv*1.5), text=text.format(adv, mins, secs))
-        except Exception as e:
-            sleep(3)
-            my_bar.empty()
-            raise e
-    for adv, key in enumerate(list(TAX_GROUPS.keys())[:-1], 27):
-        try:
-            _try_download(key, year, taxType='assets', rs='scales')
-            t1 = time()
-            left_time = (54-adv)*(t1-t0)/adv
-            mins, secs = divmod(left_time, 60)
-            my_bar.progress(round(adv*1.5), text=text.format(adv, mins, secs))
-        except Exception as e:
-            sleep(3)
-            my_bar.empty()
-            raise e
-    try:
-        _try_download(99, year)
-        my_bar.progress(100)
-    except Exception as e:
-            sleep(3)
-            my_bar.empty()
-            raise e
+    text = 'Download {}/{}. {:.0f}m{:.0f}s to end.'
+    my_bar = st.progress(1, text=text.format(0, 54, 0, 5))
+
+    def progress(done: int, total: int) -> None:
+        left_time = (total-done)*(time()-t0)/done
+        mins, secs = divmod(left_time, 60)
+        my_bar.progress(
+            round(100*done/total), text=text.format(done, total, mins, secs)
+        )
+
+    report = download_year(year, progress=progress)
+    # only what depends on the workbooks that actually changed is dropped,
+    # the rest of the caches stays warm
+    invalidate_downloads(report.changed)
+    if report.changed:
+        # the new workbooks are stored and exported once, here
+        export_reference_data()
+        load_cube.cache_clear() # outdated cubes are no longer found
+    for job in report.changed:
+        render_map.cache_discard(
+            lambda arguments:
+            arguments.get('latest_year', datetime.today().year) >= job.year
+        )
     sleep(3)
     my_bar.empty()
+    if report.errors:
+        raise next(iter(report.errors.values()))
 
 
 def get_last_update() -> datetime:
@@ -526,31 +669,87 @@ def about():
     st.write(get_readme(), unsafe_allow_html=True)
 
 
+def debug_enabled() -> bool:
+    return DEBUG or st.query_params.get('debug') == '1'
+
+
+def debug_panel(run: Trace) -> None:
+    """Timings of the stages of the last run, counters and cache usage"""
+    caches = {
+        'clean_rates': clean_rates, 'clean_scales': clean_scales,
+        'select_scales': select_scales, 'get_schedule': get_schedule,
+        'calculate_tax_base': calculate_tax_base,
+        'fill_all_taxes': fill_all_taxes, 'render_map': render_map,
+    }
+    with st.sidebar.expander('Debug', icon=':material/speed:'):
+        st.write(f'Last run: {run.duration * 1e3:,.0f} ms')
+        if run.spans:
+            st.dataframe(
+                pl.DataFrame(run.summary()).with_columns(
+                    pl.col('total_ms').round(2)
+                ),
+                hide_index=True
+            )
+        if run.counters:
+            st.dataframe(
+                pl.DataFrame({
+                    'counter': list(run.counters),
+                    'value': list(run.counters.values())
+                }).sort('counter'),
+                hide_index=True
+            )
+        st.dataframe(
+            pl.DataFrame([
+                {'cache': name, **cache.cache_info()._asdict()}
+                for name, cache in caches.items()
+            ]).drop('maxbytes'),
+            hide_index=True
+        )
+        if st.button('Profile next run', icon=':material/timer:'):
+            st.session_state['profile_next_run'] = True
+            st.rerun()
+        for file_name in st.session_state.get('profile_files', []):
+            with open(os.path.join(PROFILE_DIR, file_name), 'rb') as file:
+                st.download_button(file_name, file.read(), file_name=file_name)
+
+
 def main():
+    configure_logging()
     page_config()
     # navigation()
-    year = select_year()
-    language = choose_language()
-    st.image('elements/taxmapp.svg', use_container_width=True)
-    def home():
-        homepage(latest_year=year)
-    def page2():
-        one_to_one(latest_year=year)
-    pg = st.navigation([
-        st.Page(
-            home,
-            # partial(homepage, latest_year=year).func, 
-            default=True, title='Home',
-            icon=':material/house:'
-        ), 
-        st.Page(
-            page2,
-            # partial(one_to_one, latest_year=year).func, 
-            title='1v1', icon=':material/compare_arrows:'
-        ),
-        st.Page(about, icon=':material/info:', title='About')
-    ])
-    pg.run()
+    # a single run can be profiled from the debug panel, the stages of
+    # every run are traced
+    profiling = st.session_state.pop('profile_next_run', False)
+    name = f"run-{datetime.now():%Y%m%d-%H%M%S}"
+    with (profile(name) if profiling else trace('run')) as run:
+        reference_data()
+        year = select_year()
+        language = choose_language()
+        st.image('elements/taxmapp.svg', use_container_width=True)
+        def home():
+            homepage(latest_year=year)
+        def page2():
+            one_to_one(latest_year=year)
+        pg = st.navigation([
+            st.Page(
+                home,
+                # partial(homepage, latest_year=year).func, 
+                default=True, title='Home',
+                icon=':material/house:'
+            ), 
+            st.Page(
+                page2,
+                # partial(one_to_one, latest_year=year).func, 
+                title='1v1', icon=':material/compare_arrows:'
+            ),
+            st.Page(about, icon=':material/info:', title='About')
+        ])
+        pg.run()
+    if profiling:
+        st.session_state['profile_files'] = [f'{name}.prof', 
+                                             f'{name}.trace.json']
+    if debug_enabled():
+        debug_panel(run)
 
 
 if __name__ == '__main__':
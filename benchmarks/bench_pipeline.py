@@ -0,0 +1,177 @@
+"""Benchmarks of the tax pipeline and of the map on the bundled 2022-2024
+data. Run from the repository root, e.g. save a baseline before a change
+and compare with it afterwards (exits with 1 if anything got slower):
+
+    python benchmarks/bench_pipeline.py --json baseline.json
+    python benchmarks/bench_pipeline.py --baseline baseline.json
+
+"cold" runs start with every cache empty (workbooks are parsed again),
+"store" runs read the history store with empty in-memory caches,
+"mapped" runs map the Arrow exports with empty in-memory caches and
+"warm" runs hit the in-memory caches.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+# isolated history store, workbook cache and exports, so that cold runs
+# are cold and the real ones are left untouched
+SCRATCH = tempfile.mkdtemp(prefix='taxmapp-bench-')
+os.environ['TAXMAPP_DB'] = os.path.join(SCRATCH, 'history.sqlite')
+os.environ['TAXMAPP_REFDATA_DIR'] = os.path.join(SCRATCH, 'refdata')
+os.environ['TAXMAPP_CUBE_DIR'] = os.path.join(SCRATCH, 'cube')
+
+sys.path.append(os.path.dirname(sys.path[0]))
+
+import polars as pl
+
+from benchmarks.harness import Benchmark, main
+from utils import (
+    build_cube, calculate_tax_base, clean_rates, clean_scales,
+    cube_taxes, fill_all_taxes, fill_taxes, get_commune_index, get_schedule,
+    history, rate_curves, refdata, scan_all_taxes, select_scales,
+    solve_income, workbooks
+)
+
+YEARS = [2022, 2023, 2024]
+# a canton whose income scales follow each layout
+LAYOUT_CANTONS = {'base': 'GE', 'diff': 'ZH', 'flat': 'OW', 'formula': 'BL'}
+INCOME, ASSETS = 80_000, 250_000
+GRID_ASSETS = 240_000 # on the grid of the ranking cube
+TARGET = 15_000 # tax bill solved for
+CURVE_COMMUNES = [261, 2829] # Zürich, Liestal
+MEMORY_CACHES = [
+    clean_rates, clean_scales, select_scales, get_schedule,
+    calculate_tax_base, fill_all_taxes, get_commune_index
+]
+workbooks.CACHE_DIR = os.path.join(SCRATCH, 'workbooks')
+
+
+def forget_memory() -> None:
+    for cache in MEMORY_CACHES:
+        cache.cache_clear()
+
+
+def forget_exports() -> None:
+    forget_memory()
+    shutil.rmtree(refdata.REFDATA_DIR, ignore_errors=True)
+
+
+def forget_everything() -> None:
+    forget_exports()
+    shutil.rmtree(workbooks.CACHE_DIR, ignore_errors=True)
+    history.disconnect()
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(os.environ['TAXMAPP_DB'] + suffix):
+            os.remove(os.environ['TAXMAPP_DB'] + suffix)
+
+
+def forget_results() -> None:
+    calculate_tax_base.cache_clear()
+    fill_all_taxes.cache_clear()
+
+
+def loader_benchmarks(name: str, func) -> list[Benchmark]:
+    return [
+        Benchmark(f'{name}_cold', func, forget_everything),
+        Benchmark(f'{name}_store', func, forget_exports),
+        Benchmark(f'{name}_mapped', func, forget_memory),
+        Benchmark(f'{name}_warm', func),
+    ]
+
+
+def pipeline_benchmarks() -> list[Benchmark]:
+    benchmarks = []
+    for year in YEARS:
+        benchmarks += loader_benchmarks(
+            f'clean_rates[{year}]', lambda year=year: clean_rates(year)
+        )
+        benchmarks += loader_benchmarks(
+            f'clean_scales[ZH,{year}]',
+            lambda year=year: clean_scales('ZH', 'income', year)
+        )
+        benchmarks.append(Benchmark(
+            f'select_scales[ZH,{year}]',
+            lambda year=year: select_scales('ZH', latest_year=year),
+            select_scales.cache_clear
+        ))
+        for layout, canton in LAYOUT_CANTONS.items():
+            benchmarks.append(Benchmark(
+                f'calculate_tax_base[{layout},{year}]',
+                lambda canton=canton, year=year: calculate_tax_base(
+                    INCOME, canton, latest_year=year
+                ),
+                calculate_tax_base.cache_clear
+            ))
+        benchmarks.append(Benchmark(
+            f'fill_taxes[{year}]',
+            lambda year=year: fill_taxes(INCOME, latest_year=year),
+            forget_results
+        ))
+        benchmarks.append(Benchmark(
+            f'fill_all_taxes[{year}]_store',
+            lambda year=year: fill_all_taxes(INCOME, ASSETS, latest_year=year),
+            forget_memory
+        ))
+        benchmarks.append(Benchmark(
+            f'fill_all_taxes[{year}]',
+            lambda year=year: fill_all_taxes(INCOME, ASSETS, latest_year=year),
+            forget_results
+        ))
+        benchmarks.append(Benchmark(
+            f'scan_all_taxes[{year},TI]',
+            lambda year=year: scan_all_taxes(
+                INCOME, ASSETS, where=pl.col('canton') == 'TI',
+                latest_year=year
+            ).collect(),
+            forget_results
+        ))
+        benchmarks.append(Benchmark(
+            f'scan_all_taxes[{year},pair]',
+            lambda year=year: scan_all_taxes(
+                INCOME, ASSETS, where=pl.col('FSO_ID').is_in(CURVE_COMMUNES),
+                latest_year=year
+            ).collect(),
+            forget_results
+        ))
+        benchmarks.append(Benchmark(
+            f'fill_all_taxes[{year}]_warm',
+            lambda year=year: fill_all_taxes(INCOME, ASSETS, latest_year=year)
+        ))
+        benchmarks.append(Benchmark(
+            f'cube_taxes[{year}]',
+            lambda year=year: cube_taxes(INCOME, GRID_ASSETS, latest_year=year),
+            lambda year=year: build_cube(year)
+        ))
+        benchmarks.append(Benchmark(
+            f'solve_income[{year}]',
+            lambda year=year: solve_income(TARGET, ASSETS, latest_year=year)
+        ))
+        benchmarks.append(Benchmark(
+            f'rate_curves[{year}]',
+            lambda year=year: rate_curves(CURVE_COMMUNES, latest_year=year)
+        ))
+    return benchmarks
+
+
+def map_benchmarks() -> list[Benchmark]:
+    from app import create_map # imports streamlit
+    # the chart specification sent to the browser, which draws it
+    return [
+        Benchmark(
+            'create_map[national]',
+            lambda: create_map(INCOME, ASSETS, latest_year=2024).to_json()
+        ),
+        Benchmark(
+            'create_map[canton]',
+            lambda: create_map(INCOME, ASSETS, 'TI', latest_year=2024).to_json()
+        ),
+    ]
+
+
+if __name__ == '__main__':
+    try:
+        main(pipeline_benchmarks() + map_benchmarks(), __doc__.splitlines()[0])
+    finally:
+        shutil.rmtree(SCRATCH, ignore_errors=True)
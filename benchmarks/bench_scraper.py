@@ -0,0 +1,95 @@
+"""Download throughput and retry behaviour of the scraper against the
+offline ESTV stand-in. Run from the repository root:
+
+    python benchmarks/bench_scraper.py [--year 2024] [--json results.json]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Iterator
+
+sys.path.append(os.path.dirname(sys.path[0]))
+
+from utils.scraper import MAX_WORKERS, Session, Throttle, download_many, year_jobs
+from utils.standin import EstvStandIn
+
+# a remote service answers in a few hundred milliseconds
+LATENCY = {'latency': 0.3, 'jitter': 0.2}
+# name -> stand-in options and scraper options
+SCENARIOS: dict[str, tuple[dict, dict]] = {
+    'sequential': (LATENCY, {'max_workers': 1}),
+    'concurrent': (LATENCY, {}),
+    'not_modified': (LATENCY, {'repeat': True}),
+    'flaky': ({**LATENCY, 'failure_rate': 0.1}, {}),
+    'rate_limited': ({**LATENCY, 'rate_limit': 5}, {}),
+    'unthrottled': ({**LATENCY, 'rate_limit': 20}, {'min_delay': 0.0}),
+}
+
+
+@contextmanager
+def _scratch_dir() -> Iterator[str]:
+    """Downloads land in a temporary directory, never in data/"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            yield tmp
+        finally:
+            os.chdir(cwd)
+
+
+def run_scenario(year: int, standin_options: dict,
+                 max_workers: int = MAX_WORKERS, min_delay: float = 0.1,
+                 repeat: bool = False, seed: int = 0) -> dict:
+    jobs = year_jobs(year)
+    with EstvStandIn(os.path.abspath('data'), seed=seed,
+                     **standin_options) as standin, _scratch_dir():
+        def session() -> Session:
+            return Session(Throttle(min_delay), base_url=standin.url)
+        if repeat: # time a refresh of files already downloaded
+            download_many(jobs, max_workers, session=session())
+            standin.reset_stats()
+        t0 = perf_counter()
+        report = download_many(jobs, max_workers, session=session())
+        elapsed = perf_counter() - t0
+        stats = standin.stats()
+    return {
+        'files': len(jobs),
+        'changed': len(report.changed),
+        'errors': len(report.errors),
+        'seconds': round(elapsed, 3),
+        'files_per_second': round(len(jobs) / elapsed, 2),
+        'mb_per_second': round(stats['bytes_sent'] / elapsed / 2**20, 2),
+        'retries': stats['requests'] - len(jobs),
+        **stats,
+    }
+
+
+def run(year: int, scenarios: list[str] | None = None) -> dict[str, dict]:
+    results = {}
+    for name in scenarios or SCENARIOS:
+        standin_options, options = SCENARIOS[name]
+        results[name] = run_scenario(year, standin_options, **options)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--year', type=int, default=2024)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    results = run(args.year, args.scenario)
+    columns = ['seconds', 'files_per_second', 'mb_per_second', 'changed',
+               'errors', 'retries', 'connections', 'max_concurrency']
+    print(f"{'scenario':<14}" + ''.join(f'{c:>17}' for c in columns))
+    for name, result in results.items():
+        print(f'{name:<14}' + ''.join(f'{result[c]:>17}' for c in columns))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,128 @@
+"""Timing, JSON results and baseline comparison shared by the benchmarks"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+from dataclasses import dataclass
+from datetime import datetime
+from importlib.metadata import PackageNotFoundError, version
+from time import perf_counter
+from typing import Callable
+
+TOLERANCE = 0.25 # slowdown (relative to the baseline median) that fails
+NOISE_FLOOR = 1e-3 # seconds, differences below it are never reported
+PACKAGES = ['polars', 'numpy', 'geopandas', 'altair', 'streamlit']
+
+
+@dataclass
+class Benchmark:
+    name: str
+    func: Callable[[], object]
+    # run before every repetition and not timed, e.g. to empty the caches
+    setup: Callable[[], None] | None = None
+
+
+def measure(benchmark: Benchmark, repeat: int = 5, warmup: int = 1) -> dict:
+    """Timings in seconds of `repeat` calls after `warmup` untimed ones"""
+    times = []
+    for i in range(warmup + repeat):
+        if benchmark.setup is not None:
+            benchmark.setup()
+        t0 = perf_counter()
+        benchmark.func()
+        elapsed = perf_counter() - t0
+        if i >= warmup:
+            times.append(elapsed)
+    return {
+        'repeat': repeat,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _version(package: str) -> str | None:
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return None
+
+
+def metadata() -> dict:
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'packages': {package: _version(package) for package in PACKAGES},
+    }
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict],
+            tolerance: float = TOLERANCE) -> list[tuple[str, str, float | None]]:
+    """(name, status, current/baseline median) of every benchmark, where
+    status is one of 'slower', 'faster', 'ok', 'new' and 'missing'"""
+    rows = []
+    for name in dict.fromkeys([*baseline, *results]):
+        if name not in baseline or name not in results:
+            rows.append((name, 'new' if name in results else 'missing', None))
+            continue
+        before, after = baseline[name]['median'], results[name]['median']
+        ratio = after / before if before else float('inf')
+        status = 'ok'
+        if abs(after - before) >= NOISE_FLOOR:
+            if ratio > 1 + tolerance:
+                status = 'slower'
+            elif ratio < 1 / (1 + tolerance):
+                status = 'faster'
+        rows.append((name, status, ratio))
+    return rows
+
+
+def main(benchmarks: list[Benchmark], description: str | None = None) -> None:
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default='',
+                        help='only run the benchmarks whose name contains it')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with these saved results')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    results = {}
+    for benchmark in benchmarks:
+        if args.filter not in benchmark.name:
+            continue
+        results[benchmark.name] = timing = measure(benchmark, args.repeat)
+        print(f"{benchmark.name:<40}{timing['median'] * 1e3:>12.3f} ms"
+              f" ± {timing['stdev'] * 1e3:.3f}", flush=True)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'meta': metadata(), 'results': results}, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        baseline = {k: v for k, v in baseline.items() if args.filter in k}
+        rows = compare(results, baseline, args.tolerance)
+        print(f"\n{'benchmark':<40}{'status':>10}{'ratio':>10}")
+        for name, status, ratio in rows:
+            print(f"{name:<40}{status:>10}"
+                  + (f'{ratio:>10.2f}' if ratio is not None else f"{'-':>10}"))
+        if any(status == 'slower' for _, status, _ in rows):
+            sys.exit(1)
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+import warnings
+
+import polars as pl
+
+from utils.batch import read_chunks, score_file, score_households
+
+HOUSEHOLDS = pl.DataFrame({
+    'income': [80_000.0, 150_000.0, 0.0, 60_000.0, 95_000.0],
+    'assets': [250_000.0, 2_000_000.0, 0.0, 10_000.0, 0.0],
+    'taxable_entity': ['single', 'with_family', None, 'single', 'single'],
+    'year': [None, 2023, 2022, None, None],
+    'commune': ['261', 'Delémont', 'Lugano', None, 'Atlantis'],
+    'household': ['a', 'b', 'c', 'd', 'e'],
+}, schema_overrides={'year': pl.Int64})
+
+
+class ScoreFileTest(unittest.TestCase):
+    """Files scored in chunks by the pool match `score_households`"""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        warnings.simplefilter('ignore')
+        cls.expected = score_households(HOUSEHOLDS)
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory.name, name)
+
+    def test_round_trip(self) -> None:
+        for name in ['households.csv', 'households.parquet']:
+            with self.subTest(input=name):
+                if name.endswith('.csv'):
+                    HOUSEHOLDS.write_csv(self.path(name))
+                else:
+                    HOUSEHOLDS.write_parquet(self.path(name))
+                progress = []
+                report = score_file(
+                    self.path(name), self.path('taxes.parquet'),
+                    chunk_size=2, max_workers=2, years=[None, 2022, 2023],
+                    progress=lambda *args: progress.append(args)
+                )
+                scored = pl.read_parquet(self.path('taxes.parquet'))
+                self.assertEqual(report.households, HOUSEHOLDS.height)
+                self.assertEqual(report.rows, scored.height)
+                self.assertEqual([p[0] for p in progress], [2, 4, 5])
+                self.assertTrue(scored.equals(
+                    self.expected.cast(scored.schema)
+                ))
+                self.assertEqual(os.listdir(self.directory.name).count(
+                    'taxes.parquet'), 1)
+
+    def test_empty_file(self) -> None:
+        HOUSEHOLDS.clear().write_parquet(self.path('empty.parquet'))
+        HOUSEHOLDS.clear().write_csv(self.path('empty.csv'))
+        for name in ['empty.parquet', 'empty.csv']:
+            with self.subTest(input=name):
+                report = score_file(self.path(name),
+                                    self.path('taxes.parquet'),
+                                    max_workers=1, years=[None])
+                self.assertEqual((report.households, report.rows), (0, 0))
+                self.assertEqual(
+                    pl.read_parquet(self.path('taxes.parquet')).height, 0
+                )
+
+    def test_read_chunks(self) -> None:
+        HOUSEHOLDS.write_csv(self.path('households.csv'))
+        chunks = list(read_chunks(self.path('households.csv'), 2))
+        self.assertEqual([chunk.height for chunk in chunks], [2, 2, 1])
+        self.assertEqual(pl.concat(chunks).get_column('row').to_list(),
+                         list(range(HOUSEHOLDS.height)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import tempfile
+import unittest
+
+from unittest import mock
+
+import numpy as np
+import polars as pl
+
+from utils import cube
+from utils.cube import Grid, build_cube, cube_taxes, load_cube
+from utils.pipelines import fill_all_taxes
+
+GRID = Grid(income_step=5_000, income_max=20_000,
+            assets_step=20_000, assets_max=40_000)
+
+
+class RankingCubeTest(unittest.TestCase):
+    """The cube holds `fill_all_taxes` at every grid point, ranked"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        patch = mock.patch.object(cube, 'CUBE_DIR', self.directory.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(load_cube.cache_clear)
+        load_cube.cache_clear()
+
+    def assertSameTaxes(self, table: pl.DataFrame,
+                        expected: pl.DataFrame) -> None:
+        table, expected = table.sort('FSO_ID'), expected.sort('FSO_ID')
+        self.assertEqual(table.columns, expected.columns)
+        self.assertTrue(table.select(expected.columns[:4])
+                        .equals(expected.select(expected.columns[:4])))
+        for column in expected.columns[4:]:
+            # Float32: about one cent of precision
+            np.testing.assert_allclose(
+                table.get_column(column).to_numpy(),
+                expected.get_column(column).to_numpy(),
+                rtol=1e-6, atol=1e-2
+            )
+
+    def test_grid_points(self) -> None:
+        self.assertIsNone(load_cube(2024, GRID))
+        directory = build_cube(2024, GRID)
+        self.assertEqual(build_cube(2024, GRID), directory)
+        ranking = load_cube(2024, GRID)
+        for income in GRID.incomes:
+            for assets in GRID.assets:
+                table = ranking.taxes(income, assets)
+                total = table.get_column('total').drop_nulls()
+                self.assertTrue(total.is_sorted())
+                self.assertSameTaxes(
+                    table, fill_all_taxes(income, assets, latest_year=2024)
+                )
+        self.assertIsNone(ranking.taxes(12_345, 0))
+        self.assertIsNone(ranking.taxes(GRID.income_max + 5_000, 0))
+
+    def test_cube_taxes(self) -> None:
+        build_cube(2024, GRID)
+        ranking = load_cube(2024, GRID)
+        with mock.patch.object(cube, 'load_cube',
+                               lambda year: ranking if year == 2024 else None):
+            self.assertSameTaxes(
+                cube_taxes(10_000, 20_000, latest_year=2024),
+                fill_all_taxes(10_000, 20_000, latest_year=2024)
+            )
+            self.assertIsNone(cube_taxes(10_001, 20_000, latest_year=2024))
+            self.assertIsNone(cube_taxes(10_000, 20_000, latest_year=2023))
+            self.assertIsNone(cube_taxes(10_000, 20_000, latest_year=2024,
+                                         taxable_entity='with_family'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import warnings
+
+import polars as pl
+
+from utils.curves import rate_curves
+from utils.pipelines import scan_all_taxes
+
+
+class RateCurvesTest(unittest.TestCase):
+    """Curves follow `fill_all_taxes`, cantons without scales are null"""
+
+    def setUp(self) -> None:
+        warnings.simplefilter('ignore')
+
+    def test_income_taxes(self) -> None:
+        curves = rate_curves([261, 2829], upper=200_000, samples=5)
+        for fso_id, amount, tax in (
+            curves.select('FSO_ID', 'amount',
+                          pl.col('cantonal_tax') + pl.col('communal_tax'))
+            .unique('FSO_ID', keep='last').iter_rows()
+        ):
+            expected = scan_all_taxes(
+                amount, 0.0, where=pl.col('FSO_ID') == fso_id
+            ).collect().item(0, 'income_tax')
+            self.assertAlmostEqual(tax, expected, places=6)
+
+    def test_missing_scales(self) -> None:
+        # JU has no income scales for families
+        curves = rate_curves([261, 6711], taxable_entity='with_family')
+        jura = curves.filter(pl.col('FSO_ID') == 6711)
+        self.assertGreater(jura.height, 0)
+        for column in ['cantonal_tax', 'communal_rate', 'tax', 'marginal_rate']:
+            self.assertEqual(jura.get_column(column).null_count(), jura.height)
+        self.assertEqual(jura.get_column('federal_tax').null_count(), 0)
+        zurich = curves.filter(pl.col('FSO_ID') == 261)
+        self.assertEqual(zurich.get_column('tax').null_count(), 0)
+        with self.assertRaises(ValueError):
+            rate_curves([6711], type_of_tax='wealth')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import math
+import unittest
+
+import numpy as np
+
+from utils.formulas import compile_derivative, compile_formula
+
+# formula -> (tax, derivative) at 50_000, computed by hand
+ACCEPTED = {
+    '$wert$': (50_000.0, 1.0),
+    '1200.5': (1200.5, 0.0),
+    '.5 * $wert$': (25_000.0, 0.5),
+    '2e-2 * $wert$ + 100': (1_100.0, 0.02),
+    '$wert$ - 10000 - 5000': (35_000.0, 1.0),
+    '$wert$ / 100 / 4': (125.0, 0.0025),
+    '3 * ($wert$ - 10000) / 2': (60_000.0, 1.5),
+    '-(0.01 * $wert$)': (-500.0, -0.01),
+    '+$wert$ * -2': (-100_000.0, -2.0),
+    '((($wert$)))': (50_000.0, 1.0),
+    'log $wert$': (math.log(50_000), 1 / 50_000),
+    'log($wert$ / 5)': (math.log(10_000), 1 / 50_000),
+    '0.02 * $wert$ * (log $wert$ - 1)':
+        (1_000 * (math.log(50_000) - 1), 0.02 * math.log(50_000)),
+    '1000 / $wert$': (0.02, -1000 / 50_000**2),
+    '232436.77 + 0.1862 * ($wert$ - 1265000)':
+        (232436.77 + 0.1862 * (50_000 - 1265000), 0.1862),
+}
+REJECTED = [
+    '', '$wert', 'wert', 'x', 'amount * 2', '2 ** $wert$', '2 ^ $wert$',
+    '$wert$ % 7', 'exp($wert$)', 'log', 'abs($wert$)', '(1 + $wert$',
+    '1 + $wert$)', '1 +', '* 2', '2 3', '$wert$ $wert$', '1,5 * $wert$',
+    '__import__("os").system("true")', "__import__('os')",
+    '().__class__.__bases__[0].__subclasses__()', '$wert$.real',
+    'np.log($wert$)', 'open("/etc/passwd").read()', 'lambda: 1',
+    '[1][0]', '1 if $wert$ else 0', '$wert$ == 1', '"1"', 'log.__doc__',
+]
+
+
+class CompileFormulaTest(unittest.TestCase):
+    """Only the ESTV formula grammar is accepted, evaluated like Python"""
+
+    def test_accepted(self) -> None:
+        amounts = np.array([50_000.0, 50_000.0])
+        for formula, (tax, rate) in ACCEPTED.items():
+            with self.subTest(formula=formula):
+                np.testing.assert_allclose(
+                    compile_formula(formula)(amounts), tax, rtol=1e-12
+                )
+                np.testing.assert_allclose(
+                    compile_derivative(formula)(amounts), rate, rtol=1e-12
+                )
+                self.assertEqual(compile_formula(formula)(50_000.0).shape, ())
+
+    def test_derivative_by_differences(self) -> None:
+        amounts = np.geomspace(10, 1e7, 50)
+        h = amounts * 1e-6
+        for formula in ACCEPTED:
+            f = compile_formula(formula)
+            numeric = (f(amounts + h) - f(amounts - h)) / (2 * h)
+            np.testing.assert_allclose(
+                compile_derivative(formula)(amounts), numeric,
+                rtol=1e-5, atol=1e-9
+            )
+
+    def test_rejected(self) -> None:
+        for formula in REJECTED:
+            with self.subTest(formula=formula):
+                with self.assertRaises(ValueError):
+                    compile_formula(formula)
+                with self.assertRaises(ValueError):
+                    compile_derivative(formula)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+import geopandas as gpd
+import shapely
+
+from utils.geodata import GEO_LAYERS, RESOLUTIONS, _simplify
+
+
+class SimplifyTest(unittest.TestCase):
+    """Simplified layers still tile: no overlaps between neighbours, and
+    only their outline moves, by a fraction of the tolerance on average"""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.layers = {
+            layer: gpd.read_file(GEO_LAYERS[layer])
+            for layer in ['cantons', 'communes']
+        }
+
+    def assertTiles(self, source: gpd.GeoDataFrame, tolerance: float) -> None:
+        geometries = _simplify(source, tolerance).geometry.values
+        self.assertFalse(shapely.is_empty(geometries).any())
+        self.assertTrue(shapely.is_valid(geometries).all())
+        self.assertTrue(shapely.coverage_is_valid(geometries))
+        left, right = shapely.STRtree(geometries).query(
+            geometries, predicate='intersects'
+        )
+        pairs = left < right
+        overlap = shapely.area(shapely.intersection(
+            geometries[left[pairs]], geometries[right[pairs]]
+        )).sum()
+        self.assertLess(overlap, 1.0) # m²
+        outline = shapely.union_all(source.geometry.values)
+        shift = abs(shapely.union_all(geometries).area - outline.area)
+        self.assertLess(shift / outline.length, 0.05 * tolerance)
+
+    def test_coverages(self) -> None:
+        for layer, source in self.layers.items():
+            for resolution, tolerance in RESOLUTIONS.items():
+                if tolerance == 0:
+                    continue
+                with self.subTest(layer=layer, resolution=resolution):
+                    self.assertTiles(source, tolerance)
+
+
+if __name__ == '__main__':
+    unittest.main()
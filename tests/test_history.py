@@ -0,0 +1,118 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+import polars as pl
+
+from utils import history
+from utils.pipelines import (
+    available_rates_years, clean_rates, get_commune_index,
+    retrieve_multipliers_by_year
+)
+
+
+class ConnectTest(unittest.TestCase):
+    """One connection per thread and store, the schema created once"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, 'history.sqlite')
+
+    def tearDown(self) -> None:
+        history.disconnect(self.db_path)
+        self.directory.cleanup()
+
+    def test_reused_by_thread(self) -> None:
+        connection = history.connect(self.db_path)
+        self.assertIs(history.connect(self.db_path), connection)
+        others = []
+        thread = threading.Thread(
+            target=lambda: others.append(history.connect(self.db_path))
+        )
+        thread.start()
+        thread.join()
+        self.assertIsNot(others[0], connection)
+        self.assertEqual(history.stored_years('rates', db_path=self.db_path), [])
+
+    def test_disconnect_recreates(self) -> None:
+        history.connect(self.db_path)
+        history.disconnect(self.db_path)
+        os.remove(self.db_path)
+        self.assertEqual(history.snapshots(self.db_path).height, 0)
+
+
+# run in a fresh process, on a scratch store and scratch exports
+LOOKUPS = """
+import json, sys
+from utils.pipelines import clean_rates, retrieve_multipliers_by_year
+for year in sys.argv[1:]:
+    clean_rates(int(year))
+print(json.dumps({
+    year: retrieve_multipliers_by_year('Zürich', year)['income_canton']
+    for year in [2022, 2023, 2024]
+}))
+"""
+
+
+class MultipliersTest(unittest.TestCase):
+    """Lookups see every year of rates, whatever the store held before"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, 'history.sqlite')
+        self.env = {
+            **os.environ,
+            'TAXMAPP_DB': self.db_path,
+            'TAXMAPP_REFDATA_DIR': os.path.join(self.directory.name, 'refdata'),
+        }
+        self.expected = {
+            str(year): clean_rates(year).filter(pl.col('commune') == 'Zürich')
+                       .item(0, 'income_canton')
+            for year in [2022, 2023, 2024]
+        }
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def lookups(self, *years: int) -> dict[str, float]:
+        return json.loads(subprocess.run(
+            [sys.executable, '-c', LOOKUPS, *map(str, years)],
+            env=self.env, capture_output=True, check=True, text=True
+        ).stdout)
+
+    def stored_years(self) -> list[int]:
+        years = history.stored_years('rates', db_path=self.db_path)
+        history.disconnect(self.db_path)
+        return years
+
+    def test_empty_store(self) -> None:
+        self.assertEqual(self.lookups(2024), self.expected)
+        self.assertEqual(self.stored_years(), available_rates_years())
+
+    def test_exports_only(self) -> None:
+        self.lookups(2022, 2023, 2024)
+        os.remove(self.db_path)
+        self.assertEqual(self.lookups(), self.expected)
+        self.assertEqual(self.stored_years(), available_rates_years())
+
+
+class CommuneIndexTest(unittest.TestCase):
+    """The index resolves communes through the same lookup as the library"""
+
+    def test_resolve(self) -> None:
+        index = get_commune_index()
+        for commune in ['Zürich', 'zurich', 261, 'Liestal', 'Zür']:
+            for year in [2022, 2024]:
+                self.assertEqual(index.resolve(commune, year),
+                                 retrieve_multipliers_by_year(commune, year))
+        self.assertEqual(index.resolve('Zurich', 2022)['FSO_ID'], 261)
+        self.assertEqual(index.years(261), available_rates_years())
+        self.assertIsNone(index.resolve('Atlantis'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import json
+import os
+import pstats
+import tempfile
+import unittest
+
+from utils.instrumentation import current_trace, profile, span, timed, trace
+from utils.pipelines import fill_all_taxes
+
+
+class TraceTest(unittest.TestCase):
+    """A trace records the stages and cache traffic of a request"""
+
+    def test_pipeline_stages(self) -> None:
+        fill_all_taxes(80_000, 100_000)
+        with trace('request') as current:
+            table = fill_all_taxes(80_000, 100_000) # cached
+        self.assertEqual(current.spans, [])
+        self.assertEqual(current.counters['cache.fill_all_taxes.hits'], 1)
+
+        with trace('request') as current:
+            table = fill_all_taxes(80_001, 100_000)
+        stages = {stage['name']: stage for stage in current.summary()}
+        self.assertEqual(stages['fill_all_taxes']['calls'], 1)
+        self.assertIn('tax_bases_by_canton', stages)
+        self.assertEqual(current.counters['cache.fill_all_taxes.misses'], 1)
+        self.assertEqual(current.counters['rows.fill_all_taxes'], table.height)
+        # the whole request outlasts each of its stages
+        self.assertGreaterEqual(
+            current.duration, max(s.duration for s in current.spans)
+        )
+        self.assertIsNone(current_trace())
+
+    def test_nesting(self) -> None:
+        @timed('inner')
+        def inner() -> int:
+            return 1
+
+        with trace('request') as current:
+            with span('outer', step='a') as fields:
+                inner()
+                fields['extra'] = True
+        inner_span, outer_span = current.spans
+        self.assertEqual((inner_span.name, inner_span.depth), ('inner', 1))
+        self.assertEqual((outer_span.name, outer_span.depth), ('outer', 0))
+        self.assertEqual(outer_span.fields, {'step': 'a', 'extra': True})
+        self.assertLessEqual(inner_span.duration, outer_span.duration)
+
+    def test_nothing_listens(self) -> None:
+        with span('outer') as fields:
+            pass
+        self.assertEqual(fields, {})
+        self.assertIsNone(current_trace())
+
+    def test_profile(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            with profile('request', directory) as current:
+                fill_all_taxes(80_002, 100_000)
+            stats = pstats.Stats(os.path.join(directory, 'request.prof'))
+            self.assertGreater(stats.total_calls, 0)
+            with open(os.path.join(directory, 'request.trace.json')) as file:
+                events = json.load(file)['traceEvents']
+        self.assertEqual(len(events), len(current.spans))
+        self.assertIn('fill_all_taxes', {event['name'] for event in events})
+        self.assertTrue(all(event['ph'] == 'X' for event in events))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import warnings
+
+import polars as pl
+
+from utils.inverse import solve_income
+from utils.pipelines import scan_all_taxes
+
+# Zürich, Liestal (formula scales), Lugano, Delémont
+COMMUNES = [261, 2829, 5192, 6711]
+
+
+class SolveIncomeTest(unittest.TestCase):
+    """The incomes solved for give back the target in `fill_all_taxes`"""
+
+    def setUp(self) -> None:
+        warnings.simplefilter('ignore')
+
+    def assertInverts(self, target: float, assets: float, on: str,
+                      **kwargs) -> None:
+        solved = solve_income(target, assets, on=on, **kwargs).filter(
+            pl.col('FSO_ID').is_in(COMMUNES)
+        )
+        self.assertEqual(solved.height, len(COMMUNES))
+        for fso_id, income in solved.select('FSO_ID', 'income').iter_rows():
+            taxes = scan_all_taxes(
+                income, assets, where=pl.col('FSO_ID') == fso_id, **kwargs
+            ).collect().row(0, named=True)
+            reached = taxes['total'] if on == 'total' else income - taxes['total']
+            self.assertAlmostEqual(reached, target, delta=0.01)
+
+    def test_total(self) -> None:
+        self.assertInverts(15_000, 250_000, 'total')
+        self.assertInverts(4_000, 0, 'total', latest_year=2023)
+
+    def test_net_income(self) -> None:
+        self.assertInverts(60_000, 100_000, 'net_income')
+
+    def test_out_of_reach(self) -> None:
+        # the assets tax alone exceeds the target
+        solved = solve_income(1.0, 10_000_000)
+        self.assertEqual(solved.get_column('income').null_count(),
+                         solved.filter(pl.col('canton').is_not_null()).height)
+
+    def test_missing_scales(self) -> None:
+        # JU has no income scales for families
+        solved = solve_income(10_000, taxable_entity='with_family')
+        nulls = solved.filter(pl.col('canton').is_not_null()
+                              & pl.col('income').is_null())
+        self.assertEqual(nulls.get_column('canton').unique().to_list(), ['JU'])
+        self.assertEqual(
+            nulls.height, solved.filter(pl.col('canton') == 'JU').height
+        )
+        self.assertEqual(solved.filter(pl.col('canton') == 'ZH')
+                         .get_column('income').null_count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import unittest
+import warnings
+
+from unittest import mock
+
+import numpy as np
+import polars as pl
+
+from utils import pipelines
+from utils.batch import score_households, warm_caches
+from utils.pipelines import (
+    available_rates_years, calculate_tax_base, clean_rates, clean_scales,
+    fill_all_taxes, fill_taxes, get_schedule, iter_sweep_all_taxes,
+    scan_all_taxes, select_scales, sweep_all_taxes, tax_bases_by_canton
+)
+
+
+class MissingScalesTest(unittest.TestCase):
+    """JU has no income scales for families: its communes get null taxes,
+    every other commune keeps its taxes"""
+
+    def setUp(self) -> None:
+        warnings.simplefilter('ignore')
+
+    def assertOnlyJuraIsNull(self, table: pl.DataFrame, column: str) -> None:
+        table = table.filter(pl.col('canton').is_not_null())
+        nulls = table.filter(pl.col(column).is_null())
+        self.assertEqual(nulls.get_column('canton').unique().to_list(), ['JU'])
+        self.assertEqual(
+            nulls.height, table.filter(pl.col('canton') == 'JU').height
+        )
+
+    def test_fill_all_taxes(self) -> None:
+        table = fill_all_taxes(150_000, 2_000_000, taxable_entity='with_family')
+        self.assertOnlyJuraIsNull(table, 'total')
+
+    def test_fill_taxes(self) -> None:
+        table = fill_taxes(150_000, taxable_entity='with_family')
+        self.assertOnlyJuraIsNull(table, 'cantonal_income_tax')
+
+    def test_tax_bases_by_canton(self) -> None:
+        bases = tax_bases_by_canton(150_000, ['JU', 'ZH'],
+                                    taxable_entity='with_family')
+        self.assertIsNone(bases.row(0, named=True)['income_canton_base'])
+        self.assertIsNotNone(bases.row(1, named=True)['income_canton_base'])
+
+    def test_sweep_all_taxes(self) -> None:
+        incomes, assets = np.array([0.0, 150_000.0]), np.array([0.0, 2e6])
+        table = sweep_all_taxes(incomes, assets, taxable_entity='with_family')
+        self.assertOnlyJuraIsNull(table.filter(pl.col('scenario') == 1),
+                                  'total')
+        chunks = pl.concat(iter_sweep_all_taxes(
+            incomes, assets, chunk_size=1, taxable_entity='with_family'
+        ))
+        self.assertTrue(chunks.equals(table))
+
+    def test_score_households(self) -> None:
+        table = score_households(pl.DataFrame({
+            'income': [150_000.0], 'assets': [2_000_000.0],
+            'taxable_entity': ['with_family'],
+        }))
+        self.assertOnlyJuraIsNull(table, 'total')
+        expected = fill_all_taxes(150_000, 2_000_000,
+                                  taxable_entity='with_family')
+        np.testing.assert_allclose(
+            table.sort('FSO_ID').get_column('total').to_numpy(),
+            expected.sort('FSO_ID').get_column('total').to_numpy()
+        )
+
+    def test_invalid_entity_still_raises(self) -> None:
+        with self.assertRaises(ValueError):
+            fill_all_taxes(150_000, 0, taxable_entity='couple')
+
+
+class ScanAllTaxesTest(unittest.TestCase):
+    """Rows and columns are selected before any tax base is computed"""
+
+    def scan(self, columns: list[str] | None) -> tuple[pl.DataFrame, list]:
+        with mock.patch.object(pipelines, 'tax_bases_by_canton',
+                               wraps=tax_bases_by_canton) as bases:
+            table = scan_all_taxes(
+                80_000, 250_000, where=pl.col('canton') == 'TI',
+                columns=columns, latest_year=2023
+            ).collect()
+        return table, [call.args[1:3] for call in bases.call_args_list]
+
+    def test_pushdown(self) -> None:
+        full = fill_all_taxes(80_000, 250_000, latest_year=2023)
+        full = full.filter(pl.col('canton') == 'TI')
+        table, calls = self.scan(None)
+        self.assertTrue(table.equals(full))
+        self.assertEqual(calls, [(['TI'] * table.height, ('income',)),
+                                 (['TI'] * table.height, ('assets',))])
+        for columns, types_of_tax in [
+            (['income_tax', 'federal_tax'], [('income',)]),
+            (['communal_assets_tax'], [('assets',)]),
+            (['total'], [('income',), ('assets',)]),
+        ]:
+            with self.subTest(columns=columns):
+                table, calls = self.scan(columns)
+                self.assertEqual([call[1] for call in calls], types_of_tax)
+                self.assertTrue(table.equals(full.select(
+                    'canton_ID', 'canton', 'FSO_ID', 'commune', *columns
+                )))
+        with self.assertRaises(ValueError):
+            scan_all_taxes(0, 0, columns=['wealth_tax'])
+
+
+class CacheBoundsTest(unittest.TestCase):
+    """Every cache of the pipeline is bounded, and holds every year"""
+
+    def setUp(self) -> None:
+        warnings.simplefilter('ignore')
+
+    def test_bounded(self) -> None:
+        caches = [clean_rates, clean_scales, select_scales, get_schedule,
+                  calculate_tax_base, fill_all_taxes]
+        for cache in caches:
+            with self.subTest(cache=cache.__name__):
+                self.assertTrue(cache.max_entries or cache.max_bytes)
+
+    def test_warm_caches_fit(self) -> None:
+        caches = [clean_rates, clean_scales, select_scales, get_schedule]
+        for cache in caches:
+            cache.cache_clear()
+        warm_caches([None, *available_rates_years()])
+        for cache in caches:
+            with self.subTest(cache=cache.__name__):
+                info = cache.cache_info()
+                self.assertEqual(info.evictions, 0)
+                self.assertLess(info.currsize, cache.max_entries / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
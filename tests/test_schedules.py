@@ -0,0 +1,67 @@
+import unittest
+
+import numpy as np
+import polars as pl
+
+from utils.formulas import compile_derivative, compile_formula
+from utils.pipelines import get_schedule, select_scales
+from utils.schedules import FORMULA_OPEN_END, compile_schedule
+
+FORMULAS = [None, '0.01 * $wert$', '0.02 * $wert$ * (log $wert$ - 1) + 300']
+
+
+def formula_scales(floors: list[float],
+                   formulas: list[str | None]) -> pl.DataFrame:
+    return pl.DataFrame({
+        'layout': 'formula', 'taxable_worth': floors, 'formula': formulas
+    })
+
+
+class FormulaScheduleTest(unittest.TestCase):
+    """Formula brackets evaluate their formula exactly, up to any amount"""
+
+    def assertExact(self, scales: pl.DataFrame, amounts: np.ndarray) -> None:
+        schedule = compile_schedule(scales)
+        floors = scales.get_column('taxable_worth').to_numpy()
+        formulas = scales.get_column('formula').to_list()
+        idx = np.searchsorted(floors, amounts, side='right') - 1
+        expected = np.array([
+            compile_formula(formulas[i])(amount) if formulas[i] else 0.0
+            for i, amount in zip(idx, amounts)
+        ])
+        rates = np.array([
+            compile_derivative(formulas[i])(amount) if formulas[i] else 0.0
+            for i, amount in zip(idx, amounts)
+        ])
+        np.testing.assert_array_equal(schedule(amounts), expected)
+        np.testing.assert_array_equal(schedule.marginal_rates(amounts), rates)
+        for amount, tax in zip(amounts[:50], expected[:50]):
+            self.assertEqual(float(schedule(amount)), tax)
+
+    def test_open_end(self) -> None:
+        scales = formula_scales([0.0, 10_000.0, 50_000.0], FORMULAS)
+        cutoff = 50_000 * FORMULA_OPEN_END
+        amounts = np.concatenate([
+            np.geomspace(1, cutoff, 500), np.geomspace(cutoff, 1e10, 500)
+        ])
+        self.assertExact(scales, amounts)
+
+    def test_below_one_franc(self) -> None:
+        scales = formula_scales([0.0], FORMULAS[2:])
+        schedule = compile_schedule(scales)
+        self.assertEqual(float(schedule(0.0)), float(schedule(1.0)))
+        self.assertTrue(np.isfinite(schedule.marginal_rates(0.0)))
+
+    def test_basel_land(self) -> None:
+        for taxable_entity in ['single', 'with_family']:
+            scales = select_scales('BL', taxable_entity, latest_year=2024)
+            self.assertEqual(scales.get_column('layout')[0], 'formula')
+            amounts = np.geomspace(1, 1e9, 2_000)
+            self.assertExact(scales, amounts)
+            schedule = get_schedule('BL', taxable_entity, latest_year=2024)
+            np.testing.assert_array_equal(schedule(amounts),
+                                          compile_schedule(scales)(amounts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import filecmp
+import os
+import shutil
+import tempfile
+import unittest
+
+from urllib.error import HTTPError
+
+from utils.scraper import (
+    DownloadJob, Session, Throttle, download_many, load_manifest, year_jobs
+)
+from utils.standin import EstvStandIn
+
+DATA_DIR = os.path.abspath('data')
+# rates and a few scales of income (ZH, Conf) and assets (ZH, TI)
+JOBS = [
+    job for job in year_jobs(2024)
+    if job.rs == 'rates' or job.taxGroup in (21, 26, 77)
+]
+
+
+class ScraperTest(unittest.TestCase):
+    """Downloads from the offline stand-in, into a scratch directory"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        # the stand-in serves a copy of the workbooks, to change them
+        self.served = os.path.join(self.directory.name, 'served')
+        for job in JOBS:
+            source = os.path.join(DATA_DIR, os.path.relpath(job.file_path,
+                                                            'data'))
+            target = os.path.join(self.served,
+                                  os.path.relpath(job.file_path, 'data'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy(source, target)
+        self.downloads = os.path.join(self.directory.name, 'downloads')
+        os.makedirs(self.downloads)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.downloads)
+        self.manifest = os.path.join(self.downloads, 'manifest.json')
+
+    def standin(self, **options) -> EstvStandIn:
+        standin = EstvStandIn(self.served, seed=0, **options).start()
+        self.addCleanup(standin.stop)
+        return standin
+
+    def download(self, standin: EstvStandIn, jobs: list[DownloadJob] = JOBS,
+                 **options):
+        session = Session(Throttle(min_delay=0.0, step=0.0), backoff=0.01,
+                          base_url=standin.url, **options)
+        self.addCleanup(session.close)
+        return download_many(jobs, max_workers=4, session=session,
+                             manifest_path=self.manifest)
+
+    def assertDownloaded(self, jobs: list[DownloadJob]) -> None:
+        for job in jobs:
+            served = os.path.join(self.served,
+                                  os.path.relpath(job.file_path, 'data'))
+            self.assertTrue(filecmp.cmp(job.file_path, served, shallow=False))
+
+    def test_not_modified(self) -> None:
+        standin = self.standin()
+        report = self.download(standin)
+        self.assertEqual((sorted(report.changed), report.errors),
+                         (sorted(JOBS), {}))
+        self.assertDownloaded(JOBS)
+        manifest = load_manifest(self.manifest)
+        self.assertEqual(len(manifest), len(JOBS))
+        self.assertTrue(all(entry['etag'] for entry in manifest.values()))
+        # unchanged workbooks: conditional requests, nothing rewritten
+        mtimes = [os.stat(job.file_path).st_mtime_ns for job in JOBS]
+        standin.reset_stats()
+        report = self.download(standin)
+        self.assertEqual((report.changed, report.errors), ([], {}))
+        self.assertEqual(standin.stats()['statuses'], {304: len(JOBS)})
+        self.assertEqual(standin.stats()['bytes_sent'], 0)
+        self.assertEqual(
+            [os.stat(job.file_path).st_mtime_ns for job in JOBS], mtimes
+        )
+
+    def test_changed(self) -> None:
+        standin = self.standin()
+        self.download(standin)
+        rates, scales = JOBS[-1], JOBS[0]
+        served = os.path.join(self.served,
+                              os.path.relpath(rates.file_path, 'data'))
+        with open(served, 'ab') as file: # a new version on the server
+            file.write(b'\0')
+        with open(scales.file_path, 'ab') as file: # a local edit
+            file.write(b'\0')
+        standin.reset_stats()
+        report = self.download(standin)
+        self.assertEqual(sorted(report.changed), sorted([rates, scales]))
+        self.assertEqual(standin.stats()['statuses'],
+                         {200: 2, 304: len(JOBS) - 2})
+        self.assertDownloaded(JOBS)
+
+    def test_retries(self) -> None:
+        standin = self.standin(failure_rate=0.5)
+        report = self.download(standin, max_retries=10)
+        self.assertEqual((len(report.changed), report.errors), (len(JOBS), {}))
+        self.assertDownloaded(JOBS)
+        statuses = standin.stats()['statuses']
+        self.assertGreater(statuses[503], 0)
+        self.assertEqual(statuses[200], len(JOBS))
+
+    def test_rate_limited(self) -> None:
+        standin = self.standin(rate_limit=3)
+        report = self.download(standin)
+        self.assertEqual((len(report.changed), report.errors), (len(JOBS), {}))
+        self.assertGreater(standin.stats()['statuses'][429], 0)
+
+    def test_gives_up(self) -> None:
+        standin = self.standin(failure_rate=1.0)
+        report = self.download(standin, JOBS[:1], max_retries=2)
+        self.assertEqual(report.errors[JOBS[0]].code, 503)
+        self.assertEqual(standin.stats()['statuses'], {503: 3})
+        self.assertFalse(os.path.exists(JOBS[0].file_path))
+        # client errors are not retried
+        standin = self.standin()
+        missing = DownloadJob(99, 1999)
+        report = self.download(standin, [missing])
+        self.assertIsInstance(report.errors[missing], HTTPError)
+        self.assertEqual(standin.stats()['statuses'], {404: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import json
+import unittest
+import warnings
+
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+import polars as pl
+
+from utils.pipelines import fill_all_taxes, retrieve_multipliers_by_year
+from utils.service import MAX_BATCH, TaxService
+
+
+class TaxServiceTest(unittest.TestCase):
+    """The service answers in-process on a free local port, offline"""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        warnings.simplefilter('ignore')
+        cls.service = TaxService(port=0, years=[None]).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.service.stop()
+
+    def request(self, path: str, payload=None, data: bytes | None = None,
+                **query) -> tuple[int, object]:
+        url = self.service.url + path
+        if query:
+            url += '?' + urlencode(query)
+        if payload is not None:
+            data = json.dumps(payload).encode()
+        try:
+            with urlopen(Request(url, data=data), timeout=30) as response:
+                return response.status, json.load(response)
+        except HTTPError as e:
+            with e:
+                return e.code, json.load(e)
+
+    def test_taxes(self) -> None:
+        expected = fill_all_taxes(80_000, 250_000)
+        status, rows = self.request('/taxes', income=80_000, assets=250_000)
+        self.assertEqual(status, 200)
+        self.assertEqual(rows, expected.to_dicts())
+        status, rows = self.request('/taxes', income=80_000, assets=250_000,
+                                    canton='ZH')
+        self.assertEqual(rows, expected.filter(pl.col('canton') == 'ZH')
+                               .to_dicts())
+        status, rows = self.request('/taxes', {'income': 80_000,
+                                               'assets': 250_000,
+                                               'commune': 'Zürich'})
+        self.assertEqual(status, 200)
+        self.assertEqual(rows, expected.filter(pl.col('FSO_ID') == 261)
+                               .to_dicts())
+
+    def test_batch(self) -> None:
+        queries = [
+            {'income': 80_000, 'assets': 250_000, 'commune': 261},
+            {'income': 50_000, 'assets': 0, 'commune': 'Lugano',
+             'latest_year': 2022},
+            {'income': 50_000},
+        ]
+        status, answers = self.request('/taxes', queries)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(answers), 3)
+        self.assertEqual(answers[0], fill_all_taxes(80_000, 250_000)
+                         .filter(pl.col('FSO_ID') == 261).to_dicts())
+        self.assertEqual(answers[1], fill_all_taxes(50_000, 0, latest_year=2022)
+                         .filter(pl.col('commune') == 'Lugano').to_dicts())
+        self.assertEqual(answers[2], {'status': 400,
+                                      'error': "Missing parameter 'assets'"})
+        status, body = self.request('/taxes', queries[:1] * (MAX_BATCH + 1))
+        self.assertEqual(status, 413)
+        self.assertIn('error', body)
+
+    def test_bad_requests(self) -> None:
+        status, body = self.request('/taxes', income=80_000)
+        self.assertEqual((status, body),
+                         (400, {'error': "Missing parameter 'assets'"}))
+        status, body = self.request('/taxes', data=b'{"income": 1,')
+        self.assertEqual((status, body), (400, {'error': 'Invalid JSON'}))
+        status, body = self.request('/taxes', ['not a query'])
+        self.assertEqual(body, [{'status': 400,
+                                 'error': 'A query should be an object'}])
+        status, body = self.request('/taxes', income='a lot', assets=0)
+        self.assertEqual(status, 400)
+        status, body = self.request('/nowhere')
+        self.assertEqual(status, 404)
+
+    def test_commune(self) -> None:
+        for commune in ['Zürich', 'zurich', '261']:
+            with self.subTest(commune=commune):
+                status, row = self.request('/commune', commune=commune,
+                                           latest_year=2022)
+                self.assertEqual(status, 200)
+                self.assertEqual(row, retrieve_multipliers_by_year(261, 2022))
+        status, row = self.request('/commune', {'commune': 261})
+        self.assertEqual(row, retrieve_multipliers_by_year(261))
+        self.assertEqual(self.request('/commune', commune='Atlantis'),
+                         (200, None))
+
+    def test_health_and_metrics(self) -> None:
+        status, health = self.request('/health')
+        self.assertEqual(status, 200)
+        self.assertEqual(health['status'], 'ok')
+        self.assertIn(2024, health['years'])
+        self.request('/scales', canton='ZH')
+        self.request('/scales', canton='ZH', type_of_tax='wealth')
+        status, metrics = self.request('/metrics')
+        self.assertEqual(status, 200)
+        scales = metrics['endpoints']['/scales']
+        self.assertGreaterEqual(scales['requests'], 2)
+        self.assertGreaterEqual(scales['errors'], 1)
+        self.assertIsNotNone(scales['p95_ms'])
+
+
+if __name__ == '__main__':
+    unittest.main()
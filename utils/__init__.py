@@ -1,22 +1,65 @@
 from .constants import (
     COLNAMES_RATES, COLNAMES_SCALES_BASE, 
     COLNAMES_SCALES_DIFF, COLNAMES_SCALES_FLAT,
-    COLNAMES_SCALES_FORMULA, TAX_AUTHORITIES,
-    TAXABLE_ENTITIES,TAX_GROUPS
+    COLNAMES_SCALES_FORMULA, FORMULA_HEADERS,
+    TAX_AUTHORITIES, TAXABLE_ENTITIES,TAX_GROUPS
+)
+from .caching import (
+    BoundedCache, CacheInfo,
+    bounded_cache
+)
+from .workbooks import (
+    ingest_workbook,
+    ingest_workbooks,
+    read_workbook
+)
+from .refdata import map_table, read_exported
+from .formulas import Formula, compile_derivative, compile_formula
+from .schedules import (
+    MissingScalesError, ScaleLayout, TaxSchedule,
+    compile_schedule
 )
 from .pipelines import (
-    Authority, MaritalStatus, TaxType,
+    Authority, CommuneIndex, MaritalStatus, TaxType,
+    LABEL_COLUMNS, TAX_COLUMNS,
+    apply_multipliers,
+    available_rates_years,
     calculate_tax_base,
+    calculate_tax_bases,
     clean_rates,
     clean_scales,
+    export_reference_data,
     fill_all_taxes,
     fill_taxes,
+    get_commune_index,
+    get_schedule,
+    invalidate_downloads,
+    invalidate_rates,
+    invalidate_scales,
+    iter_sweep_all_taxes,
+    normalise_commune,
     retrieve_multipliers,
     retrieve_multipliers_by_year,
+    scan_all_taxes,
+    scan_taxes,
     select_scales,
-    show_taxes
+    show_taxes,
+    sweep_all_taxes,
+    tax_bases_by_canton,
+    tax_bases_or_nan
 )
+from .inverse import Target, solve_income
+from .curves import rate_curves
+from .cube import Grid, RankingCube, build_cube, cube_taxes, load_cube
 from .scraper import (
+    DownloadJob, DownloadReport, DownloadResult, Response, Session, Throttle,
     _try_download,
-    download_all
+    download,
+    download_all,
+    download_many,
+    download_year,
+    load_manifest,
+    manifest_digest,
+    save_manifest,
+    year_jobs
 )
\ No newline at end of file
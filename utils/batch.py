@@ -0,0 +1,275 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import warnings
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from time import perf_counter
+from typing import Callable, Iterator, NamedTuple, TypeAlias
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+sys.path.append(os.path.dirname(sys.path[0]))
+
+from utils.history import normalise_commune
+from utils.pipelines import (
+    LABEL_COLUMNS, TAX_COLUMNS, apply_multipliers, available_rates_years,
+    clean_rates, get_commune_index, tax_bases_or_nan
+)
+
+# households per chunk: those without a commune get ~2,100 rows each
+CHUNK_SIZE = 1_000
+
+Progress: TypeAlias = Callable[[int, int, float], None]
+
+
+class BatchReport(NamedTuple):
+    households: int
+    rows: int # one per household with a commune, else one per commune
+    seconds: float
+
+    @property
+    def households_per_second(self) -> float:
+        return self.households / self.seconds if self.seconds else 0.0
+
+
+def _fso_ids(communes: pl.Series) -> pl.Series:
+    """FSO_IDs of communes given by number or by name"""
+    communes = communes.cast(pl.String).str.strip_chars()
+    index = get_commune_index()
+    names = {
+        name: index.by_name.get(normalise_commune(name), [None])[0]
+        for name in communes.drop_nulls().unique().to_list()
+        if not name.isdigit()
+    }
+    return (
+        pl.when(communes.str.contains(r'^\d+$'))
+        .then(communes.cast(pl.Int64, strict=False))
+        .otherwise(communes.replace_strict(names, default=None,
+                                           return_dtype=pl.Int64))
+    )
+
+
+def _commune_taxes(households: pl.DataFrame, **kwargs) -> pl.DataFrame:
+    """Taxes of households in a given commune, vectorized by canton"""
+    table = households.select('row', 'income', 'assets', 'FSO_ID').join(
+        clean_rates(), on='FSO_ID', how='left'
+    )
+    cantons = table.get_column('canton').to_numpy()
+    amounts = {
+        'income': table.get_column('income').to_numpy(),
+        'assets': table.get_column('assets').to_numpy(),
+    }
+    bases = {
+        f'{type_of_tax}_{authority}_base': np.full(table.height, np.nan)
+        for type_of_tax in ['income', 'assets']
+        for authority in ['canton', 'commune']
+    }
+    for canton in table.get_column('canton').drop_nulls().unique().to_list():
+        rows = cantons == canton
+        for type_of_tax in ['income', 'assets']:
+            for authority in ['canton', 'commune']:
+                bases[f'{type_of_tax}_{authority}_base'][rows] = (
+                    tax_bases_or_nan(
+                        amounts[type_of_tax][rows], canton,
+                        authority = authority,
+                        type_of_tax = type_of_tax,
+                        **kwargs
+                    )
+                )
+    federal = tax_bases_or_nan(amounts['income'], 'Conf',
+                               authority='federal', **kwargs)
+    return apply_multipliers(
+        table.with_columns(
+            *(pl.Series(name, values, nan_to_null=True)
+              for name, values in bases.items()),
+            pl.when(pl.col('canton').is_not_null())
+            .then(pl.Series(federal, nan_to_null=True)).alias('federal_tax')
+        )
+    ).select('row', *LABEL_COLUMNS, *TAX_COLUMNS)
+
+
+def _all_communes_taxes(households: pl.DataFrame, **kwargs) -> pl.DataFrame:
+    """Taxes of households in every commune, one row per commune each"""
+    communes = clean_rates().select('FSO_ID').drop_nulls()
+    return _commune_taxes(
+        households.select('row', 'income', 'assets')
+        .join(communes, how='cross'),
+        **kwargs
+    )
+
+
+def score_households(households: pl.DataFrame) -> pl.DataFrame:
+    """Taxes of a table of households with `income` and `assets` columns
+    and optionally `taxable_entity` (single by default), `year` (the
+    latest_year of the scales) and `commune` (FSO_ID or name). Households
+    without a commune get a row for every commune. Other columns are
+    kept; `row` numbers the households unless it is given."""
+    for column in ['income', 'assets']:
+        if column not in households.columns:
+            raise ValueError(f'Households need an `{column}` column')
+    if 'row' not in households.columns:
+        households = households.with_row_index('row')
+    households = households.with_columns(
+        pl.col('row').cast(pl.Int64),
+        pl.col('income').cast(pl.Float64),
+        pl.col('assets').cast(pl.Float64),
+        (pl.col('taxable_entity') if 'taxable_entity' in households.columns
+         else pl.lit(None)).cast(pl.String).fill_null('single')
+        .alias('taxable_entity'),
+        (pl.col('year') if 'year' in households.columns
+         else pl.lit(None)).cast(pl.Int64).alias('year'),
+        (_fso_ids(households.get_column('commune'))
+         if 'commune' in households.columns
+         else pl.lit(None, dtype=pl.Int64)).alias('FSO_ID'),
+        # unknown communes get null taxes, not a row for every commune
+        (pl.col('commune').is_not_null() if 'commune' in households.columns
+         else pl.lit(False)).alias('located'),
+    )
+    parts = []
+    for (entity, year), group in households.group_by(
+        ['taxable_entity', 'year'], maintain_order=True
+    ):
+        kwargs = {'taxable_entity': entity}
+        if year is not None:
+            kwargs['latest_year'] = year
+        located = group.get_column('located')
+        if located.any():
+            parts.append(_commune_taxes(group.filter(located), **kwargs))
+        if not located.all():
+            parts.append(_all_communes_taxes(group.filter(~located), **kwargs))
+    schema = {
+        'row': pl.Int64, 'canton_ID': pl.Int64, 'canton': pl.String,
+        'FSO_ID': pl.Int64, 'commune': pl.String,
+        **{column: pl.Float64 for column in TAX_COLUMNS}
+    }
+    # no households, no groups
+    taxes = (pl.concat(parts).cast(schema) if parts
+             else pl.DataFrame(schema=schema))
+    return (
+        households.drop('FSO_ID', 'commune', 'located', strict=False)
+        .join(taxes, on='row')
+        .sort('row', 'FSO_ID', maintain_order=True)
+    )
+
+
+def read_chunks(file_path: str, chunk_size: int = CHUNK_SIZE
+) -> Iterator[pl.DataFrame]:
+    """Streams a CSV or Parquet file of households in chunks, numbering
+    the households in a `row` column"""
+    offset = 0
+    if file_path.endswith('.parquet'):
+        parquet = pq.ParquetFile(file_path)
+        # pyarrow cannot iterate over a file without row groups
+        batches = (
+            pl.from_arrow(batch)
+            for batch in parquet.iter_batches(chunk_size)
+        ) if parquet.metadata.num_row_groups else iter([])
+    else:
+        reader = pl.read_csv_batched(
+            file_path, batch_size=chunk_size,
+            schema_overrides={'commune': pl.String}
+        )
+        batches = (batch for chunk in iter(lambda: reader.next_batches(1), None)
+                   for batch in chunk)
+    # CSV batch sizes are only a hint to polars
+    for batch in batches:
+        for chunk in batch.iter_slices(chunk_size):
+            yield chunk.with_row_index('row', offset)
+            offset += chunk.height
+
+
+def warm_caches(years: list[int | None]) -> None:
+    """Fills the scales caches of the given years (None for the default),
+    for every canton and taxable entity"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        score_households(pl.DataFrame({
+            'income': 0.0, 'assets': 0.0,
+            'taxable_entity': ['single', 'with_family'] * len(years),
+            'year': [year for year in years for _ in range(2)],
+        }, schema_overrides={'year': pl.Int64}))
+
+
+def score_file(input_path: str, output_path: str,
+               chunk_size: int = CHUNK_SIZE, max_workers: int | None = None,
+               years: list[int | None] | None = None,
+               progress: Progress | None = None) -> BatchReport:
+    """Scores a CSV or Parquet file of households (see `score_households`)
+    into a Parquet file, one row group per chunk. Chunks are scored by a
+    pool of processes with warm caches; at most two chunks per process are
+    in flight, so memory stays flat whatever the size of the input."""
+    if years is None:
+        years = [None, *available_rates_years()]
+    warm_caches(years) # workbooks are stored once, before the workers start
+    max_workers = max_workers or os.cpu_count() or 1
+    t0 = perf_counter()
+    households = rows = 0
+    writer: pq.ParquetWriter | None = None
+    tmp_path = f'{output_path}.{os.getpid()}.tmp'
+    pending: deque[tuple[int, Future]] = deque()
+
+    def write(chunk_height: int, future: Future) -> None:
+        nonlocal writer, households, rows
+        table = future.result().to_arrow()
+        if writer is None:
+            writer = pq.ParquetWriter(tmp_path, table.schema)
+        writer.write_table(table.cast(writer.schema))
+        households += chunk_height
+        rows += table.num_rows
+        if progress is not None:
+            progress(households, rows, perf_counter() - t0)
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=warm_caches, initargs=(years,)
+        ) as pool:
+            for chunk in read_chunks(input_path, chunk_size):
+                pending.append(
+                    (chunk.height, pool.submit(score_households, chunk))
+                )
+                if len(pending) >= 2 * max_workers:
+                    write(*pending.popleft())
+            while pending:
+                write(*pending.popleft())
+        if writer is None: # empty input
+            score_households(
+                pl.DataFrame({'income': [], 'assets': []})
+            ).write_parquet(tmp_path)
+        else:
+            writer.close()
+        os.replace(tmp_path, output_path)
+    finally:
+        if writer is not None and writer.is_open:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return BatchReport(households, rows, perf_counter() - t0)
+
+
+def _print_progress(households: int, rows: int, seconds: float) -> None:
+    print(f'{households:,} households, {rows:,} rows,'
+          f' {households / seconds:,.0f} households/s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Scores a CSV or Parquet file of households'
+    )
+    parser.add_argument('input')
+    parser.add_argument('output', help='Parquet file')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--year', type=int, action='append', dest='years',
+                        help='years to warm up (default: every year)')
+    args = parser.parse_args()
+    report = score_file(args.input, args.output, args.chunk_size,
+                        args.workers, args.years, _print_progress)
+    print(f'Scored {report.households:,} households into {report.rows:,}'
+          f' rows in {report.seconds:.1f}s'
+          f' ({report.households_per_second:,.0f} households/s)')
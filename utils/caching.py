@@ -0,0 +1,164 @@
+import inspect
+import sys
+import threading
+
+from collections import OrderedDict
+from functools import update_wrapper
+from time import monotonic
+from typing import Any, Callable, NamedTuple
+
+import polars as pl
+
+from utils.instrumentation import count
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    currsize: int
+    nbytes: int
+    maxbytes: int | None
+
+
+def sizeof(value: Any) -> int:
+    """Approximate memory held by a cached value"""
+    if isinstance(value, pl.DataFrame):
+        return value.estimated_size()
+    return sys.getsizeof(value)
+
+
+def quantise(value: float, step: float) -> float:
+    """Rounds `value` to the closest multiple of `step`"""
+    return round(value / step) * step
+
+
+class BoundedCache:
+    """Thread-safe LRU cache of function results with a memory budget,
+    an optional time-to-live and optional quantisation of the inputs.
+
+    `quantize` maps argument names to the step they are rounded to
+    before both the lookup and the call, so that nearby inputs share
+    the same entry. Exposes the same `cache_info()`/`cache_clear()`
+    interface as `functools.lru_cache`."""
+
+    def __init__(self, func: Callable, max_bytes: int | None = None,
+                 max_entries: int | None = None, ttl: float | None = None,
+                 quantize: dict[str, float] | None = None) -> None:
+        self.func = func
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.quantize = quantize or {}
+        self._signature = inspect.signature(func)
+        self._entries: OrderedDict[Any, tuple[Any, int, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_clear()
+        update_wrapper(self, func)
+
+    def _bind(self, args: tuple, kwargs: dict) -> inspect.BoundArguments:
+        bound = self._signature.bind(*args, **kwargs)
+        for name, step in self.quantize.items():
+            if bound.arguments.get(name) is not None:
+                bound.arguments[name] = quantise(bound.arguments[name], step)
+        return bound
+
+    @staticmethod
+    def _key(bound: inspect.BoundArguments) -> tuple:
+        key = []
+        for name, value in bound.arguments.items():
+            if isinstance(value, dict): # **kwargs
+                value = tuple(sorted(value.items()))
+            key.append((name, value))
+        return tuple(key)
+
+    def _evict(self) -> None:
+        while self._entries and (
+            (self.max_bytes is not None and self._nbytes > self.max_bytes)
+            or (self.max_entries is not None
+                and len(self._entries) > self.max_entries)
+        ):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self._nbytes -= size
+            self._evictions += 1
+
+    def __call__(self, *args, **kwargs) -> Any:
+        bound = self._bind(args, kwargs)
+        key = self._key(bound)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None \
+                    and monotonic() - entry[2] > self.ttl:
+                del self._entries[key]
+                self._nbytes -= entry[1]
+                self._expirations += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                count(f'cache.{self.__name__}.hits')
+                return entry[0]
+            self._misses += 1
+        count(f'cache.{self.__name__}.misses')
+        # the lock is not held while computing, concurrent misses
+        # of the same key may both compute it
+        value = self.func(*bound.args, **bound.kwargs)
+        size = sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size, monotonic())
+            self._nbytes += size
+            self._evict()
+        return value
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(
+                self._hits, self._misses, self._evictions, self._expirations,
+                len(self._entries), self._nbytes, self.max_bytes
+            )
+
+    def _arguments(self, key: tuple) -> dict[str, Any]:
+        """Arguments of a cached call, defaults and **kwargs included"""
+        arguments = {
+            name: parameter.default
+            for name, parameter in self._signature.parameters.items()
+            if parameter.default is not inspect.Parameter.empty
+        }
+        for name, value in key:
+            if self._signature.parameters[name].kind is inspect.Parameter.VAR_KEYWORD:
+                arguments.update(value)
+            else:
+                arguments[name] = value
+        return arguments
+
+    def cache_discard(self, predicate: Callable[[dict[str, Any]], bool]) -> int:
+        """Drops the entries whose arguments satisfy `predicate`, leaving
+        the rest of the cache warm. Returns how many were dropped."""
+        with self._lock:
+            stale = [
+                key for key in self._entries
+                if predicate(self._arguments(key))
+            ]
+            for key in stale:
+                self._nbytes -= self._entries.pop(key)[1]
+        return len(stale)
+
+    def cache_clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self._hits = self._misses = 0
+            self._evictions = self._expirations = 0
+
+
+def bounded_cache(max_bytes: int | None = None, max_entries: int | None = None,
+                  ttl: float | None = None,
+                  quantize: dict[str, float] | None = None
+) -> Callable[[Callable], BoundedCache]:
+    """Decorator version of `BoundedCache`"""
+    def decorator(func: Callable) -> BoundedCache:
+        return BoundedCache(func, max_bytes, max_entries, ttl, quantize)
+    return decorator
@@ -32,6 +32,8 @@ COLNAMES_SCALES_FORMULA = [
     'taxable_worth', 'formula'
 ]
 
+FORMULA_HEADERS = ['Formel', 'Formule', 'Formula']
+
 TAX_AUTHORITIES = {
     'canton': ['Kanton', 'Canton', 'Cantone'],
     'commune': ['Gemeinde', 'Commune', 'Comune'],
@@ -0,0 +1,221 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache
+from typing import NamedTuple
+
+import numpy as np
+import polars as pl
+
+sys.path.append(os.path.dirname(sys.path[0]))
+
+from utils.instrumentation import count, timed
+from utils.pipelines import sweep_all_taxes
+from utils.refdata import map_table, write_table
+from utils.workbooks import WORKBOOK_PATTERNS
+
+CUBE_DIR = os.environ.get('TAXMAPP_CUBE_DIR', 'cachedata/cube')
+# steps of the homepage widgets, bounds of the materialised grid
+INCOME_STEP = 5_000
+ASSETS_STEP = 20_000
+INCOME_MAX = int(os.environ.get('TAXMAPP_CUBE_INCOME_MAX', 250_000))
+ASSETS_MAX = int(os.environ.get('TAXMAPP_CUBE_ASSETS_MAX', 1_000_000))
+INCOME_COLUMNS = [
+    'federal_tax', 'income_tax', 'cantonal_income_tax', 'communal_income_tax'
+]
+ASSETS_COLUMNS = ['assets_tax', 'cantonal_assets_tax', 'communal_assets_tax']
+
+
+class Grid(NamedTuple):
+    income_step: float = INCOME_STEP
+    income_max: float = INCOME_MAX
+    assets_step: float = ASSETS_STEP
+    assets_max: float = ASSETS_MAX
+
+    @property
+    def incomes(self) -> np.ndarray:
+        return np.arange(0, self.income_max + 1, self.income_step, dtype=float)
+
+    @property
+    def assets(self) -> np.ndarray:
+        return np.arange(0, self.assets_max + 1, self.assets_step, dtype=float)
+
+    def index(self, income: float, assets: float) -> tuple[int, int] | None:
+        """Grid point of the amounts, None if they are off the grid"""
+        i, j = income / self.income_step, assets / self.assets_step
+        if not (i.is_integer() and j.is_integer()):
+            return None
+        if not (0 <= income <= self.income_max and 0 <= assets <= self.assets_max):
+            return None
+        return int(i), int(j)
+
+
+GRID = Grid()
+
+
+def _source_stamp() -> list[tuple[str, int, int]]:
+    """Workbooks the cube is computed from, with their mtime and size"""
+    return [
+        (os.path.normpath(file_path), stat.st_mtime_ns, stat.st_size)
+        for pattern in WORKBOOK_PATTERNS
+        for file_path in sorted(glob.glob(pattern))
+        for stat in [os.stat(file_path)]
+    ]
+
+
+def _cube_dir(year: int, grid: Grid) -> str:
+    """A new directory whenever the grid or a workbook changes, so that a
+    rebuild never touches files mapped by other processes"""
+    key = json.dumps([grid, _source_stamp()]).encode()
+    return os.path.join(CUBE_DIR, str(year), hashlib.sha256(key).hexdigest()[:16])
+
+
+@dataclass(frozen=True)
+class RankingCube:
+    """Taxes of every commune at every point of a grid of incomes and
+    assets, for the single taxable entity in a given year. Arrays are
+    memory-mapped Float32 (about one cent of precision): taxes by income
+    (incomes × communes × INCOME_COLUMNS) and by assets, plus totals and
+    the rank order of the communes (incomes × assets × communes)."""
+    year: int
+    grid: Grid
+    labels: pl.DataFrame # canton_ID, canton, FSO_ID, commune
+    income: np.ndarray
+    assets: np.ndarray
+    total: np.ndarray
+    rank: np.ndarray
+
+    def taxes(self, income: float, assets: float) -> pl.DataFrame | None:
+        """`fill_all_taxes` at a grid point, rows ranked by total. None if
+        the amounts are off the grid."""
+        point = self.grid.index(income, assets)
+        if point is None:
+            return None
+        i, j = point
+        rank = self.rank[i, j]
+        columns = {
+            **{column: self.income[i, :, k]
+               for k, column in enumerate(INCOME_COLUMNS)},
+            **{column: self.assets[j, :, k]
+               for k, column in enumerate(ASSETS_COLUMNS)},
+            'total': self.total[i, j],
+        }
+        return self.labels[rank].with_columns(
+            pl.Series(column, values[rank], dtype=pl.Float64, nan_to_null=True)
+            for column, values in columns.items()
+        ).select(
+            'canton_ID', 'canton', 'FSO_ID', 'commune', 'federal_tax',
+            'income_tax', 'cantonal_income_tax', 'communal_income_tax',
+            'assets_tax', 'cantonal_assets_tax', 'communal_assets_tax', 'total'
+        )
+
+
+def _save(path: str, array: np.ndarray) -> None:
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.save(file, array)
+    os.replace(tmp_path, path)
+
+
+@timed()
+def build_cube(year: int, grid: Grid = GRID) -> str:
+    """Materialises the cube of `year` (the latest_year of the scales) over
+    `grid` and removes the outdated ones. Returns its directory."""
+    directory = _cube_dir(year, grid)
+    if os.path.isfile(os.path.join(directory, 'cube.json')):
+        return directory
+    incomes, assets = grid.incomes, grid.assets
+    n = max(len(incomes), len(assets))
+    # income and assets taxes are independent: one sweep gives both axes
+    sweep = sweep_all_taxes(
+        np.pad(incomes, (0, n - len(incomes))),
+        np.pad(assets, (0, n - len(assets))),
+        latest_year = year
+    ).filter(pl.col('FSO_ID').is_not_null())
+    labels = sweep.filter(pl.col('scenario') == 0).select(
+        'canton_ID', 'canton', 'FSO_ID', 'commune'
+    )
+    communes = labels.height
+
+    def axis(length: int, columns: list[str]) -> np.ndarray:
+        values = (
+            sweep.filter(pl.col('scenario') < length).select(columns)
+            .to_numpy().astype(np.float32)
+        )
+        return values.reshape(length, communes, len(columns))
+
+    by_income = axis(len(incomes), INCOME_COLUMNS)
+    by_assets = axis(len(assets), ASSETS_COLUMNS)
+    total = (
+        by_income[:, None, :, 1].astype(np.float64)
+        + by_assets[None, :, :, 0]
+    ).astype(np.float32)
+    rank = np.argsort(total, axis=-1, kind='stable').astype(np.uint16)
+    os.makedirs(directory, exist_ok=True)
+    write_table(os.path.join(directory, 'labels.arrow'),
+                labels.to_arrow(compat_level=pl.CompatLevel.oldest()))
+    for name, array in [('income', by_income), ('assets', by_assets),
+                        ('total', total), ('rank', rank)]:
+        _save(os.path.join(directory, f'{name}.npy'), array)
+    # written last: the cube is complete once it exists
+    with open(os.path.join(directory, 'cube.json'), 'w') as file:
+        json.dump({'year': year, 'grid': grid._asdict(),
+                   'communes': communes,
+                   'built_at': datetime.now().isoformat()}, file)
+    for outdated in glob.glob(os.path.join(CUBE_DIR, str(year), '*')):
+        if outdated != directory:
+            shutil.rmtree(outdated, ignore_errors=True)
+    load_cube.cache_clear() # may hold a miss of this cube
+    return directory
+
+
+@lru_cache
+def load_cube(year: int, grid: Grid = GRID) -> RankingCube | None:
+    """Maps the cube of `year`, None if it is not built or out of date.
+    Clear the cache after downloading workbooks."""
+    directory = _cube_dir(year, grid)
+    if not os.path.isfile(os.path.join(directory, 'cube.json')):
+        return None
+    arrays = {
+        name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+        for name in ['income', 'assets', 'total', 'rank']
+    }
+    labels = pl.from_arrow(map_table(os.path.join(directory, 'labels.arrow')))
+    return RankingCube(year, grid, labels, **arrays)
+
+
+@timed()
+def cube_taxes(income: float, assets: float, **kwargs) -> pl.DataFrame | None:
+    """`fill_all_taxes(income, assets, **kwargs)` looked up in the cube, if
+    built and the amounts are on its grid, else None. Only the single
+    taxable entity is materialised."""
+    if not set(kwargs) <= {'latest_year', 'taxable_entity'}:
+        return None
+    if kwargs.get('taxable_entity', 'single') != 'single':
+        return None
+    cube = load_cube(kwargs.get('latest_year', datetime.today().year))
+    table = None if cube is None else cube.taxes(income, assets)
+    count('cube.hits' if table is not None else 'cube.misses')
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Materialises the taxes of every commune over the grid'
+                    ' of incomes and assets reachable from the homepage'
+    )
+    parser.add_argument('--year', type=int, action='append', dest='years',
+                        help='years to build (default: 2022 to this year)')
+    parser.add_argument('--income-max', type=float, default=INCOME_MAX)
+    parser.add_argument('--assets-max', type=float, default=ASSETS_MAX)
+    args = parser.parse_args()
+    grid = Grid(INCOME_STEP, args.income_max, ASSETS_STEP, args.assets_max)
+    for year in args.years or range(2022, datetime.today().year + 1):
+        print(f'Built {build_cube(year, grid)}')
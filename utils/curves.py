@@ -0,0 +1,125 @@
+import os
+import sys
+import warnings
+
+from datetime import datetime
+
+import numpy as np
+import polars as pl
+
+sys.path.append(os.path.dirname(sys.path[0]))
+
+from utils.instrumentation import timed
+from utils.pipelines import TaxType, clean_rates, get_schedule
+from utils.schedules import MissingScalesError, TaxSchedule
+
+
+def _schedule(canton: str, type_of_tax: TaxType, authority: str,
+              **kwargs) -> TaxSchedule:
+    return get_schedule(
+        canton,
+        taxable_entity = kwargs.get('taxable_entity', 'single'),
+        type_of_tax = type_of_tax,
+        authority = authority,
+        latest_year = kwargs.get('latest_year', datetime.today().year)
+    )
+
+
+def _curve_amounts(schedules: list[TaxSchedule], upper: float,
+                   samples: int) -> tuple[np.ndarray, np.ndarray]:
+    """Sampled amounts up to `upper` and the kinks of the schedules in
+    between, each kink preceded by its left limit so that jumps of the
+    marginal rate are drawn as vertical steps. Also returns which amounts
+    are left limits."""
+    kinks = np.unique(np.concatenate([s.kinks for s in schedules]))
+    kinks = kinks[(kinks > 0) & (kinks < upper)]
+    amounts = np.concatenate([
+        np.linspace(0, upper, samples), kinks, np.nextafter(kinks, 0)
+    ])
+    left = np.concatenate([
+        np.zeros(samples + len(kinks), bool), np.ones(len(kinks), bool)
+    ])
+    order = np.argsort(amounts, kind='stable')
+    return amounts[order], left[order]
+
+
+@timed()
+def rate_curves(fso_ids: list[int], type_of_tax: TaxType = 'income',
+                upper: float = 300_000, samples: int = 301,
+                **kwargs) -> pl.DataFrame:
+    """Exact marginal and effective tax rates of the given communes, for
+    amounts of `type_of_tax` from 0 to `upper`. **kwargs include
+    latest_year=... and taxable_entity=...
+
+    Marginal rates come straight from the brackets (the derivative of
+    the formula for formula scales), scaled by the cantonal and communal
+    multipliers; the federal tax is added to income. Besides `samples`
+    evenly spaced amounts, every bracket edge is included twice, with the
+    rate below and above it. Returns a long table, one row per commune
+    and amount. Communes of cantons without such scales (e.g. JU for
+    families) get null cantonal and communal taxes and rates."""
+    if type_of_tax not in ['income', 'assets']:
+        raise ValueError('`type_of_tax` should be either "income" or "assets"')
+    communes = clean_rates().filter(pl.col('FSO_ID').is_in(fso_ids))
+    federal = (
+        _schedule('Conf', type_of_tax, 'federal', **kwargs)
+        if type_of_tax == 'income' else None
+    )
+    curves = []
+    for i, row in enumerate(communes.iter_rows(named=True)):
+        m1 = row[f'{type_of_tax}_canton']
+        m2 = row[f'{type_of_tax}_commune']
+        if m1 is None or m2 is None:
+            continue
+        try:
+            canton = _schedule(row['canton'], type_of_tax, 'canton', **kwargs)
+            commune = _schedule(row['canton'], type_of_tax, 'commune',
+                                **kwargs)
+        except MissingScalesError as e:
+            warnings.warn(f"No curves of {row['canton']} with {kwargs}: {e}")
+            canton = commune = None
+        schedules = [s for s in (canton, commune, federal) if s]
+        # left limits are evaluated in the lower bracket, shown at the edge
+        amounts, left = _curve_amounts(schedules, upper, samples)
+        missing = np.full(len(amounts), np.nan)
+        columns = {
+            'amount': np.where(left, np.nextafter(amounts, np.inf), amounts),
+            'cantonal_tax': m1 * canton(amounts) if canton else missing,
+            'communal_tax': m2 * commune(amounts) if commune else missing,
+            'federal_tax': federal(amounts) if federal else np.zeros(len(amounts)),
+            'cantonal_rate': m1 * canton.marginal_rates(amounts) if canton
+                             else missing,
+            'communal_rate': m2 * commune.marginal_rates(amounts) if commune
+                             else missing,
+            'federal_rate': federal.marginal_rates(amounts) if federal
+                            else np.zeros(len(amounts)),
+        }
+        curves.append(
+            communes.slice(i, 1)
+            .select('canton_ID', 'canton', 'FSO_ID', 'commune')
+            .join(pl.DataFrame(columns).fill_nan(None), how='cross')
+        )
+    if not curves:
+        raise ValueError(f'No multipliers found for the communes {fso_ids}')
+    return (
+        pl.concat(curves)
+        .with_columns(
+            tax = (
+                pl.col('cantonal_tax') + pl.col('communal_tax')
+                + pl.col('federal_tax')
+            ),
+            marginal_rate = (
+                pl.col('cantonal_rate') + pl.col('communal_rate')
+                + pl.col('federal_rate')
+            )
+        )
+        .with_columns(
+            effective_rate = pl.when(pl.col('amount') > 0)
+            .then(pl.col('tax') / pl.col('amount'))
+            .otherwise(None)
+        )
+    )
+
+
+if __name__ == '__main__':
+    print(rate_curves([261, 5192]))
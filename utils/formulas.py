@@ -0,0 +1,171 @@
+import re
+
+from functools import lru_cache
+from typing import Callable, TypeAlias
+
+import numpy as np
+
+Formula: TypeAlias = Callable[[np.ndarray], np.ndarray]
+_Node: TypeAlias = Callable[[np.ndarray], np.ndarray | float]
+
+# ESTV formulas only use numbers, the `$wert$` placeholder (the taxable
+# amount), the four arithmetic operators, brackets and the natural `log`
+_TOKEN = re.compile(
+    r'\s*(?:'
+    r'(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)'
+    r'|(?P<wert>\$wert\$)'
+    r'|(?P<function>log)'
+    r'|(?P<operator>[-+*/()])'
+    r')'
+)
+_OPERATORS = {
+    '+': np.add,
+    '-': np.subtract,
+    '*': np.multiply,
+    '/': np.divide,
+}
+# the same operators on (value, derivative) pairs, for the derivatives
+_DUAL_OPERATORS = {
+    '+': lambda u, v: (u[0] + v[0], u[1] + v[1]),
+    '-': lambda u, v: (u[0] - v[0], u[1] - v[1]),
+    '*': lambda u, v: (u[0] * v[0], u[1] * v[0] + u[0] * v[1]),
+    '/': lambda u, v: (u[0] / v[0], (u[1] * v[0] - u[0] * v[1]) / v[0]**2),
+}
+
+
+def _tokenize(formula: str) -> list[tuple[str, str]]:
+    tokens = []
+    position = 0
+    formula = formula.rstrip()
+    while position < len(formula):
+        match = _TOKEN.match(formula, position)
+        if match is None:
+            raise ValueError(
+                f"Unexpected character {formula[position:].strip()[0]!r}"
+                f" in formula {formula!r}"
+            )
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        position = match.end()
+    return tokens
+
+
+def _apply(operator: np.ufunc, left: _Node, right: _Node) -> _Node:
+    return lambda x: operator(left(x), right(x))
+
+
+def _dual_log(u: tuple) -> tuple:
+    return np.log(u[0]), u[1] / u[0]
+
+
+def _dual_negative(u: tuple) -> tuple:
+    return np.negative(u[0]), np.negative(u[1])
+
+
+class _Parser:
+    """Recursive descent parser of the grammar
+        expr    := term (('+' | '-') term)*
+        term    := unary (('*' | '/') unary)*
+        unary   := ('+' | '-' | 'log') unary | primary
+        primary := number | '$wert$' | '(' expr ')'
+    """
+    def __init__(self, formula: str, dual: bool = False) -> None:
+        self.formula = formula
+        self.tokens = _tokenize(formula)
+        self.position = 0
+        # dual nodes evaluate to (value, derivative) pairs
+        self.dual = dual
+        self.operators = _DUAL_OPERATORS if dual else _OPERATORS
+
+    def _peek(self) -> str | None:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][1]
+        return None
+
+    def _next(self) -> tuple[str, str]:
+        if self.position >= len(self.tokens):
+            raise ValueError(f"Unexpected end of formula {self.formula!r}")
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    def parse(self) -> _Node:
+        node = self._expr()
+        if self._peek() is not None:
+            raise ValueError(
+                f"Unexpected {self._peek()!r} in formula {self.formula!r}"
+            )
+        return node
+
+    def _binary(self, operands: Callable[[], _Node], 
+                operators: tuple[str, ...]) -> _Node:
+        node = operands()
+        while self._peek() in operators:
+            operator = self.operators[self._next()[1]]
+            node = _apply(operator, node, operands())
+        return node
+
+    def _expr(self) -> _Node:
+        return self._binary(self._term, ('+', '-'))
+
+    def _term(self) -> _Node:
+        return self._binary(self._unary, ('*', '/'))
+
+    def _unary(self) -> _Node:
+        if self._peek() in ('+', '-', 'log'):
+            operator = self._next()[1]
+            operand = self._unary()
+            if self.dual:
+                if operator == 'log':
+                    return lambda x: _dual_log(operand(x))
+                if operator == '-':
+                    return lambda x: _dual_negative(operand(x))
+                return operand
+            if operator == 'log':
+                return lambda x: np.log(operand(x))
+            if operator == '-':
+                return lambda x: np.negative(operand(x))
+            return operand
+        return self._primary()
+
+    def _primary(self) -> _Node:
+        kind, value = self._next()
+        if kind == 'number':
+            number = float(value)
+            if self.dual:
+                return lambda x: (number, 0.0)
+            return lambda x: number
+        if kind == 'wert':
+            if self.dual:
+                return lambda x: (x, 1.0)
+            return lambda x: x
+        if value == '(':
+            node = self._expr()
+            if self._next()[1] != ')':
+                raise ValueError(f"Unbalanced brackets in formula {self.formula!r}")
+            return node
+        raise ValueError(f"Unexpected {value!r} in formula {self.formula!r}")
+
+
+@lru_cache
+def compile_formula(formula: str) -> Formula:
+    """Parses an ESTV formula once into a NumPy-vectorized callable.
+    Anything outside the formula grammar raises a ValueError."""
+    node = _Parser(formula).parse()
+
+    def evaluate(amounts: float | np.ndarray) -> np.ndarray:
+        amounts = np.asarray(amounts, dtype=np.float64)
+        return np.broadcast_to(node(amounts), amounts.shape).astype(np.float64)
+
+    return evaluate
+
+
+@lru_cache
+def compile_derivative(formula: str) -> Formula:
+    """Exact derivative of an ESTV formula with respect to `$wert$`, by
+    forward differentiation of the parsed formula"""
+    node = _Parser(formula, dual=True).parse()
+
+    def evaluate(amounts: float | np.ndarray) -> np.ndarray:
+        amounts = np.asarray(amounts, dtype=np.float64)
+        return np.broadcast_to(node(amounts)[1], amounts.shape).astype(np.float64)
+
+    return evaluate
@@ -0,0 +1,239 @@
+import os
+import re
+import warnings
+
+from functools import lru_cache
+from typing import Callable, Literal, TypeAlias
+
+import geopandas as gpd
+import pyarrow as pa
+import shapely
+
+from utils.refdata import REFDATA_DIR, map_table, write_table
+
+GeoLayer: TypeAlias = Literal['switzerland', 'cantons', 'communes']
+Resolution: TypeAlias = Literal['coarse', 'fine', 'full']
+
+GEO_LAYERS: dict[GeoLayer, str] = {
+    'switzerland': (
+        './geodata/2024_GEOM_TK/01_INST'
+        '/Gesamtfläche_gf/K4_suis18480101_gf'
+        '/K4suis18480101gf_ch2007Poly.shp'
+    ),
+    'cantons': (
+        './geodata/2024_GEOM_TK/01_INST'
+        '/Gesamtfläche_gf/K4_kant20220101_gf'
+        '/K4kant20220101gf_ch2007Poly.shp'
+    ),
+    'communes': (
+        './geodata/2024_GEOM_TK/01_INST'
+        '/Gesamtfläche_gf/K4_polg20240101_gf'
+        '/K4polg20240101gf_ch2007Poly.shp'
+    ),
+}
+# simplification tolerances in metres (LV95), coarse suits the national
+# view and fine a single canton. Simplifying the coverage keeps every point
+# where three communes meet: it takes a larger tolerance than simplifying
+# each polygon alone to drop as many points.
+RESOLUTIONS: dict[Resolution, float] = {
+    'coarse': 1_000,
+    'fine': 25,
+    'full': 0,
+}
+GEO_CACHE_DIR = 'cachedata/geodata'
+# GeoJSON copies served by streamlit (server.enableStaticServing) so
+# that browsers download each geometry once and cache it
+STATIC_DIR = 'static/geodata'
+STATIC_URL = 'app/static/geodata'
+STATIC_PRECISION = 1e-5 # degrees, about one metre
+# per canton subsets: its communes, its boundary and a thin ring of
+# neighbouring communes within RING_WIDTH metres, for context
+CantonPart: TypeAlias = Literal['communes', 'boundary', 'ring']
+CANTON_PARTS: tuple[CantonPart, ...] = ('communes', 'boundary', 'ring')
+CANTON_RESOLUTION: Resolution = 'fine'
+RING_WIDTH = 2_000
+
+
+def _store_path(layer: GeoLayer, resolution: Resolution) -> str:
+    return os.path.join(GEO_CACHE_DIR, f'{layer}_{resolution}.parquet')
+
+
+def _arrow_path(layer: GeoLayer, resolution: Resolution) -> str:
+    return os.path.join(REFDATA_DIR, 'geodata', f'{layer}_{resolution}.arrow')
+
+
+def _static_path(layer: GeoLayer, resolution: Resolution) -> str:
+    return os.path.join(STATIC_DIR, f'{layer}_{resolution}.geojson')
+
+
+def _canton_static_path(canton_id: int, part: CantonPart) -> str:
+    return os.path.join(STATIC_DIR, 'cantons', f'{canton_id}_{part}.geojson')
+
+
+def _write_atomically(path: str, write: Callable[[str], None]) -> None:
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _simplify(gdf: gpd.GeoDataFrame, tolerance: float) -> gpd.GeoDataFrame:
+    """Simplifies the polygons as a coverage: each border shared by two
+    neighbours is simplified once, so that they still tile without gaps
+    or overlaps. The few borders that do not match exactly in the source
+    are snapped together first."""
+    gdf = gdf.copy()
+    if tolerance == 0:
+        return gdf
+    gdf.geometry = shapely.coverage_simplify(
+        shapely.coverage_clean(gdf.geometry.values), tolerance
+    )
+    return gdf
+
+
+def is_built(layer: GeoLayer, resolution: Resolution) -> bool:
+    source_mtime = os.path.getmtime(GEO_LAYERS[layer])
+    return all(
+        os.path.isfile(path) and os.path.getmtime(path) >= source_mtime
+        for path in (_store_path(layer, resolution), 
+                     _static_path(layer, resolution),
+                     _arrow_path(layer, resolution))
+    )
+
+
+def _write_geojson(gdf: gpd.GeoDataFrame, path: str) -> None:
+    """Compact GeoJSON, keeping only the `id` property"""
+    gdf = gdf[['id', 'geometry']].copy()
+    gdf.geometry = shapely.set_precision(gdf.geometry.values, STATIC_PRECISION)
+    geojson = gdf.to_json(drop_id=True, separators=(',', ':'))
+    # drop the float noise left over beyond the chosen precision
+    geojson = re.sub(r'(\.\d{5})\d+', r'\1', geojson)
+    with open(path, 'w') as file:
+        file.write(geojson)
+
+
+def _write_arrow(gdf: gpd.GeoDataFrame, path: str) -> None:
+    """WKB geometry with the centroid and bounds of every shape, which is
+    all the map needs to centre itself without loading the shapes"""
+    with warnings.catch_warnings():
+        # in degrees, as the map has always been centred
+        warnings.simplefilter('ignore', UserWarning)
+        centroids = gdf.centroid
+    bounds = gdf.bounds
+    write_table(path, pa.table({
+        'id': pa.array(gdf['id'], pa.int64()),
+        'centroid_x': centroids.x.to_numpy(),
+        'centroid_y': centroids.y.to_numpy(),
+        **{column: bounds[column].to_numpy() for column in bounds.columns},
+        'geometry': pa.array(shapely.to_wkb(gdf.geometry.values), pa.binary()),
+    }))
+
+
+def build_geodata(force: bool = False) -> list[str]:
+    """Reprojects every layer to EPSG:4326 once and stores it as GeoParquet
+    at each resolution. Returns the paths of the rebuilt files."""
+    os.makedirs(GEO_CACHE_DIR, exist_ok=True)
+    os.makedirs(STATIC_DIR, exist_ok=True)
+    os.makedirs(os.path.join(REFDATA_DIR, 'geodata'), exist_ok=True)
+    built = []
+    for layer, source in GEO_LAYERS.items():
+        if not force and all(is_built(layer, r) for r in RESOLUTIONS):
+            continue
+        gdf = gpd.read_file(source)
+        gdf['id'] = gdf['id'].astype(int)
+        for resolution, tolerance in RESOLUTIONS.items():
+            projected = _simplify(gdf, tolerance).to_crs("EPSG:4326")
+            for path, write in [
+                (_store_path(layer, resolution), projected.to_parquet),
+                (_static_path(layer, resolution), 
+                 lambda path: _write_geojson(projected, path)),
+                (_arrow_path(layer, resolution),
+                 lambda path: _write_arrow(projected, path)),
+            ]:
+                _write_atomically(path, write)
+                built.append(path)
+    built.extend(build_canton_subsets(force))
+    return built
+
+
+def canton_subsets_built() -> bool:
+    source_mtime = max(
+        os.path.getmtime(GEO_LAYERS['communes']),
+        os.path.getmtime(GEO_LAYERS['cantons'])
+    )
+    return all(
+        os.path.isfile(path) and os.path.getmtime(path) >= source_mtime
+        for path in (_canton_static_path(canton_id, part)
+                     for canton_id in range(1, 27) for part in CANTON_PARTS)
+    )
+
+
+def build_canton_subsets(force: bool = False) -> list[str]:
+    """Splits the communes by canton_ID (the canton containing them) and
+    stores each canton's communes, boundary and neighbour ring apart"""
+    if not force and canton_subsets_built():
+        return []
+    os.makedirs(os.path.join(STATIC_DIR, 'cantons'), exist_ok=True)
+    tolerance = RESOLUTIONS[CANTON_RESOLUTION]
+    cantons = _simplify(gpd.read_file(GEO_LAYERS['cantons']), tolerance)
+    communes = _simplify(gpd.read_file(GEO_LAYERS['communes']), tolerance)
+    cantons['id'] = cantons['id'].astype(int)
+    communes['id'] = communes['id'].astype(int)
+    points = communes.set_geometry(communes.representative_point())
+    communes['canton_ID'] = (
+        points.sjoin(cantons[['id', 'geometry']].rename(columns={'id': 'canton_ID'}),
+                     predicate='within')
+        ['canton_ID']
+    )
+    built = []
+    for canton in cantons.itertuples():
+        own = communes['canton_ID'] == canton.id
+        near = communes.intersects(canton.geometry.buffer(RING_WIDTH))
+        subsets = {
+            'communes': communes[own],
+            'boundary': cantons[cantons['id'] == canton.id],
+            'ring': communes[~own & near],
+        }
+        for part, subset in subsets.items():
+            path = _canton_static_path(canton.id, part)
+            projected = subset.to_crs("EPSG:4326")
+            _write_atomically(path, lambda path: _write_geojson(projected, path))
+            built.append(path)
+    return built
+
+
+@lru_cache
+def load_layer(layer: GeoLayer,
+               resolution: Resolution = 'full') -> gpd.GeoDataFrame:
+    """Preprojected layer, built on first use and loaded once per process.
+    The returned GeoDataFrame is shared: copy it before modifying it."""
+    if not is_built(layer, resolution):
+        build_geodata()
+    return gpd.read_parquet(_store_path(layer, resolution))
+
+
+def map_layer(layer: GeoLayer, resolution: Resolution = 'full') -> pa.Table:
+    """Preprojected layer memory-mapped from its Arrow export: `id`,
+    `centroid_x`/`_y`, `minx`, `miny`, `maxx`, `maxy` and WKB `geometry`.
+    Processes mapping it share the same pages."""
+    if not is_built(layer, resolution):
+        build_geodata()
+    return map_table(_arrow_path(layer, resolution))
+
+
+def static_url(layer: GeoLayer, resolution: Resolution = 'full') -> str:
+    """URL, relative to the app, of the GeoJSON served as a static file"""
+    if not is_built(layer, resolution):
+        build_geodata()
+    return f'{STATIC_URL}/{layer}_{resolution}.geojson'
+
+
+def canton_static_url(canton_id: int, part: CantonPart) -> str:
+    """URL of the GeoJSON subset of a canton, see `build_canton_subsets`"""
+    if not canton_subsets_built():
+        build_canton_subsets()
+    return f'{STATIC_URL}/cantons/{canton_id}_{part}.geojson'
+
+
+if __name__ == '__main__':
+    for store_path in build_geodata(force=True):
+        print(f'Built {store_path}')
@@ -0,0 +1,367 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import unicodedata
+
+from datetime import datetime, timezone
+from typing import Callable
+
+import polars as pl
+
+from utils.constants import (
+    COLNAMES_RATES, COLNAMES_SCALES_BASE, COLNAMES_SCALES_DIFF,
+    COLNAMES_SCALES_FLAT, COLNAMES_SCALES_FORMULA
+)
+from utils.instrumentation import timed
+
+# append-only: a new snapshot is stored whenever a downloaded workbook
+# changes, older ones are kept for time series
+DB_PATH = os.environ.get('TAXMAPP_DB', 'data/history.sqlite')
+LATEST = '9999-12-31'
+
+SCALES_META = [
+    'canton_ID', 'canton', 'type_of_tax',
+    'taxable_entity', 'tax_authority', 'layout'
+]
+SCALES_COLUMNS = {
+    'base': COLNAMES_SCALES_BASE[5:],
+    'diff': COLNAMES_SCALES_DIFF[5:],
+    'flat': COLNAMES_SCALES_FLAT[5:],
+    'formula': COLNAMES_SCALES_FORMULA[5:],
+}
+_SCALES_VALUES = list(dict.fromkeys(
+    column for columns in SCALES_COLUMNS.values() for column in columns
+))
+_TYPES = {pl.Int64: 'INTEGER', pl.Float64: 'REAL', pl.String: 'TEXT'}
+_RATES_SCHEMA = {
+    column: pl.Int64 if column in ('canton_ID', 'FSO_ID')
+    else pl.String if column in ('canton', 'commune')
+    else pl.Float64
+    for column in COLNAMES_RATES
+}
+_SCALES_SCHEMA = {
+    column: pl.Int64 if column == 'canton_ID'
+    else pl.String if column in SCALES_META or column == 'formula'
+    else pl.Float64
+    for column in SCALES_META + _SCALES_VALUES
+}
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL, -- 'rates' or 'scales'
+    year INTEGER NOT NULL,
+    canton TEXT NOT NULL DEFAULT '',
+    type_of_tax TEXT NOT NULL DEFAULT '',
+    downloaded_at TEXT NOT NULL,
+    ingested_at TEXT NOT NULL,
+    source TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS snapshots_key
+    ON snapshots (kind, year, canton, type_of_tax, downloaded_at);
+CREATE TABLE IF NOT EXISTS rates (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots (id),
+    year INTEGER NOT NULL,
+    commune_key TEXT,
+    {', '.join(f'{c} {_TYPES[t]}' for c, t in _RATES_SCHEMA.items())}
+);
+CREATE INDEX IF NOT EXISTS rates_snapshot ON rates (snapshot_id);
+CREATE INDEX IF NOT EXISTS rates_fso_id ON rates (FSO_ID, year);
+CREATE INDEX IF NOT EXISTS rates_canton ON rates (canton, year);
+CREATE INDEX IF NOT EXISTS rates_commune ON rates (commune_key, year);
+CREATE TABLE IF NOT EXISTS scales (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots (id),
+    position INTEGER NOT NULL,
+    {', '.join(f'{c} {_TYPES[t]}' for c, t in _SCALES_SCHEMA.items())}
+);
+CREATE INDEX IF NOT EXISTS scales_snapshot ON scales (snapshot_id, position);
+"""
+
+
+def normalise_commune(name: str) -> str:
+    """Case, accent and whitespace insensitive commune name"""
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(name.casefold().split())
+
+
+# stores whose schema this process has created, and the connections of
+# each thread (sqlite3 connections cannot be shared between threads)
+_created: set[str] = set()
+_created_lock = threading.Lock()
+_local = threading.local()
+
+
+def _create(db_path: str) -> None:
+    with _created_lock:
+        if db_path in _created:
+            return
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        connection = sqlite3.connect(db_path, timeout=30)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL') # readers never block
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+        _created.add(db_path)
+
+
+def connect(db_path: str = DB_PATH) -> sqlite3.Connection:
+    """Connection of the current thread to the store, creating the store
+    the first time this process opens it. Do not close it."""
+    connections = getattr(_local, 'connections', None)
+    if connections is None or _local.pid != os.getpid():
+        # connections inherited through fork are never reused
+        connections = _local.connections = {}
+        _local.pid = os.getpid()
+    if db_path not in connections:
+        _create(db_path)
+        connection = sqlite3.connect(db_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connections[db_path] = connection
+    return connections[db_path]
+
+
+def disconnect(db_path: str = DB_PATH) -> None:
+    """Closes the current thread's connection to the store, e.g. before
+    deleting it: the next `connect` creates it again"""
+    connection = getattr(_local, 'connections', {}).pop(db_path, None)
+    if connection is not None:
+        connection.close()
+    with _created_lock:
+        _created.discard(db_path)
+
+
+def _file_hash(file_path: str) -> str:
+    with open(file_path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def _timestamp(seconds: float) -> str:
+    return (datetime.fromtimestamp(seconds, timezone.utc)
+            .isoformat(sep=' ', timespec='seconds'))
+
+
+def _snapshot(connection: sqlite3.Connection, kind: str, year: int,
+              canton: str = '', type_of_tax: str = '',
+              as_of: str | None = None) -> sqlite3.Row | None:
+    """Latest snapshot downloaded up to `as_of` (by default the newest)"""
+    return connection.execute(
+        """
+        SELECT * FROM snapshots
+        WHERE kind = ? AND year = ? AND canton = ? AND type_of_tax = ?
+            AND downloaded_at <= ?
+        ORDER BY id DESC LIMIT 1
+        """,
+        (kind, year, canton, type_of_tax, as_of or LATEST)
+    ).fetchone()
+
+
+def _insert_rows(connection: sqlite3.Connection, snapshot_id: int, kind: str,
+                 year: int, frame: pl.DataFrame) -> None:
+    if kind == 'rates':
+        frame = frame.select(
+            pl.lit(snapshot_id).alias('snapshot_id'), pl.lit(year).alias('year'),
+            pl.col('commune').map_elements(normalise_commune, pl.String)
+            .alias('commune_key'),
+            *COLNAMES_RATES
+        )
+    else:
+        frame = frame.select(
+            pl.lit(snapshot_id).alias('snapshot_id'),
+            pl.int_range(pl.len()).alias('position'),
+            *[
+                pl.col(column) if column in frame.columns
+                else pl.lit(None, _SCALES_SCHEMA[column]).alias(column)
+                for column in _SCALES_SCHEMA
+            ]
+        )
+    connection.executemany(
+        f"INSERT INTO {kind} ({', '.join(frame.columns)})"
+        f" VALUES ({', '.join('?' * frame.width)})",
+        frame.iter_rows()
+    )
+
+
+def _read_rows(connection: sqlite3.Connection, snapshot: sqlite3.Row) -> pl.DataFrame:
+    if snapshot['kind'] == 'rates':
+        rows = connection.execute(
+            f"SELECT {', '.join(COLNAMES_RATES)} FROM rates"
+            " WHERE snapshot_id = ? ORDER BY rowid",
+            (snapshot['id'],)
+        ).fetchall()
+        return pl.DataFrame(
+            [tuple(row) for row in rows], schema=_RATES_SCHEMA, orient='row'
+        )
+    layout = connection.execute(
+        "SELECT layout FROM scales WHERE snapshot_id = ? LIMIT 1",
+        (snapshot['id'],)
+    ).fetchone()
+    columns = SCALES_META + SCALES_COLUMNS[layout['layout']] if layout else SCALES_META
+    rows = connection.execute(
+        f"SELECT {', '.join(columns)} FROM scales"
+        " WHERE snapshot_id = ? ORDER BY position",
+        (snapshot['id'],)
+    ).fetchall()
+    return pl.DataFrame(
+        [tuple(row) for row in rows], orient='row',
+        schema={c: _SCALES_SCHEMA[c] for c in columns}
+    )
+
+
+def is_stored(file_path: str, kind: str, year: int, canton: str = '',
+              type_of_tax: str = '', db_path: str = DB_PATH) -> bool:
+    """Whether the latest snapshot is of the workbook as it is on disk"""
+    snapshot = _snapshot(connect(db_path), kind, year, canton, type_of_tax)
+    if snapshot is None or not os.path.isfile(file_path):
+        return snapshot is not None
+    stat = os.stat(file_path)
+    return (snapshot['source'] == os.path.normpath(file_path)
+            and (snapshot['mtime_ns'], snapshot['size'])
+                == (stat.st_mtime_ns, stat.st_size))
+
+
+@timed('history.sync')
+def sync(file_path: str, parse: Callable[[str], pl.DataFrame], kind: str,
+         year: int, canton: str = '', type_of_tax: str = '',
+         db_path: str = DB_PATH) -> pl.DataFrame | None:
+    """Stored table of a workbook. The workbook is parsed (with `parse`)
+    and appended as a new snapshot only if its content changed since the
+    latest snapshot. Without the workbook, the latest snapshot is used."""
+    connection = connect(db_path)
+    snapshot = _snapshot(connection, kind, year, canton, type_of_tax)
+    if not os.path.isfile(file_path):
+        return None if snapshot is None else _read_rows(connection, snapshot)
+    stat = os.stat(file_path)
+    if (snapshot is not None and snapshot['source'] == os.path.normpath(file_path)
+        and (snapshot['mtime_ns'], snapshot['size'])
+            == (stat.st_mtime_ns, stat.st_size)):
+        return _read_rows(connection, snapshot)
+    sha256 = _file_hash(file_path)
+    if snapshot is not None and snapshot['sha256'] == sha256:
+        # touched but unchanged: skip hashing next time
+        with connection:
+            connection.execute(
+                "UPDATE snapshots SET mtime_ns = ?, size = ?, source = ?"
+                " WHERE id = ?",
+                (stat.st_mtime_ns, stat.st_size,
+                 os.path.normpath(file_path), snapshot['id'])
+            )
+        return _read_rows(connection, snapshot)
+    frame = parse(file_path)
+    with connection:
+        # another process may have stored the same workbook meanwhile
+        connection.execute('BEGIN IMMEDIATE')
+        snapshot = _snapshot(connection, kind, year, canton, type_of_tax)
+        if snapshot is not None and snapshot['sha256'] == sha256:
+            return frame
+        cursor = connection.execute(
+            """
+            INSERT INTO snapshots (kind, year, canton, type_of_tax,
+                downloaded_at, ingested_at, source, sha256, size, mtime_ns)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (kind, year, canton, type_of_tax, _timestamp(stat.st_mtime),
+             _timestamp(datetime.now().timestamp()),
+             os.path.normpath(file_path), sha256,
+             stat.st_size, stat.st_mtime_ns)
+        )
+        _insert_rows(connection, cursor.lastrowid, kind, year, frame)
+    return frame
+
+
+def read_rates(year: int, as_of: str | None = None,
+               db_path: str = DB_PATH) -> pl.DataFrame | None:
+    """Multipliers of `year` as downloaded up to `as_of`"""
+    connection = connect(db_path)
+    snapshot = _snapshot(connection, 'rates', year, as_of=as_of)
+    return None if snapshot is None else _read_rows(connection, snapshot)
+
+
+def read_scales(canton: str, type_of_tax: str, year: int,
+                as_of: str | None = None,
+                db_path: str = DB_PATH) -> pl.DataFrame | None:
+    """Scales of `year` as downloaded up to `as_of`"""
+    connection = connect(db_path)
+    snapshot = _snapshot(connection, 'scales', year, canton, type_of_tax, as_of)
+    return None if snapshot is None else _read_rows(connection, snapshot)
+
+
+def stored_years(kind: str, canton: str = '', type_of_tax: str = '',
+                 db_path: str = DB_PATH) -> list[int]:
+    connection = connect(db_path)
+    rows = connection.execute(
+        "SELECT DISTINCT year FROM snapshots"
+        " WHERE kind = ? AND canton = ? AND type_of_tax = ? ORDER BY year",
+        (kind, canton, type_of_tax)
+    ).fetchall()
+    return [row['year'] for row in rows]
+
+
+# latest rates snapshot of every year downloaded up to a date
+_CURRENT_RATES = """
+    SELECT max(id) FROM snapshots
+    WHERE kind = 'rates' AND downloaded_at <= ?
+    GROUP BY year
+"""
+
+
+def multipliers(commune: str | int, latest_year: int,
+                as_of: str | None = None,
+                db_path: str = DB_PATH) -> dict[str, float] | None:
+    """Latest multipliers up to `latest_year` of a commune, given by name
+    or FSO_ID, falling back to a substring match of the name"""
+    if isinstance(commune, int):
+        conditions = [('FSO_ID = ?', commune)]
+    else:
+        key = normalise_commune(commune)
+        conditions = [('commune_key = ?', key), ('instr(commune_key, ?) > 0', key)]
+    connection = connect(db_path)
+    for condition, value in conditions:
+        row = connection.execute(
+            f"""
+            SELECT {', '.join(COLNAMES_RATES)} FROM rates
+            WHERE {condition} AND year <= ?
+                AND snapshot_id IN ({_CURRENT_RATES})
+            ORDER BY year DESC, FSO_ID LIMIT 1
+            """,
+            (value, latest_year, as_of or LATEST)
+        ).fetchone()
+        if row is not None:
+            return dict(row)
+    return None
+
+
+def rates_history(fso_id: int, db_path: str = DB_PATH) -> pl.DataFrame:
+    """Every stored multiplier of a commune, one row per snapshot"""
+    connection = connect(db_path)
+    rows = connection.execute(
+        f"""
+        SELECT r.year, s.downloaded_at, {', '.join(f'r.{c}' for c in COLNAMES_RATES)}
+        FROM rates r JOIN snapshots s ON s.id = r.snapshot_id
+        WHERE r.FSO_ID = ? ORDER BY r.year, s.downloaded_at
+        """,
+        (fso_id,)
+    ).fetchall()
+    return pl.DataFrame(
+        [tuple(row) for row in rows], orient='row',
+        schema={'year': pl.Int64, 'downloaded_at': pl.String, **_RATES_SCHEMA}
+    )
+
+
+def snapshots(db_path: str = DB_PATH) -> pl.DataFrame:
+    """Catalogue of the stored snapshots"""
+    connection = connect(db_path)
+    rows = connection.execute(
+        "SELECT id, kind, year, canton, type_of_tax, downloaded_at,"
+        " ingested_at, source, sha256 FROM snapshots ORDER BY id"
+    ).fetchall()
+    return pl.DataFrame(
+        [tuple(row) for row in rows], orient='row',
+        schema=['id', 'kind', 'year', 'canton', 'type_of_tax',
+                'downloaded_at', 'ingested_at', 'source', 'sha256']
+    )
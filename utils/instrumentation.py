@@ -0,0 +1,240 @@
+import argparse
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from time import perf_counter, time
+from typing import Any, Callable, Iterator
+
+# set TAXMAPP_LOG to a level name (e.g. INFO, DEBUG) to write JSON lines
+# to stderr: one per request at INFO, one per span at DEBUG
+LOG_LEVEL = os.environ.get('TAXMAPP_LOG')
+PROFILE_DIR = os.environ.get('TAXMAPP_PROFILE_DIR', 'profiles')
+
+logger = logging.getLogger('taxmapp')
+
+
+@dataclass
+class Span:
+    name: str
+    start: float # seconds since the start of the trace
+    duration: float
+    depth: int
+    thread: int
+    fields: dict[str, Any]
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'start_ms': round(self.start * 1e3, 3),
+            'duration_ms': round(self.duration * 1e3, 3),
+            'depth': self.depth,
+            **self.fields,
+        }
+
+
+@dataclass
+class Trace:
+    """Spans and counters recorded while handling a single request"""
+    name: str
+    started_at: float = field(default_factory=time)
+    spans: list[Span] = field(default_factory=list)
+    counters: Counter[str] = field(default_factory=Counter)
+    duration: float | None = None
+    _t0: float = field(default_factory=perf_counter, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+
+    def summary(self) -> list[dict]:
+        """Calls and time spent in each stage, slowest first"""
+        stages: dict[str, dict] = {}
+        for span in self.spans:
+            stage = stages.setdefault(
+                span.name, {'name': span.name, 'calls': 0, 'total_ms': 0.0}
+            )
+            stage['calls'] += 1
+            stage['total_ms'] += span.duration * 1e3
+        return sorted(stages.values(), key=lambda s: s['total_ms'], reverse=True)
+
+    def to_dict(self) -> dict:
+        return {
+            'trace': self.name,
+            'started_at': self.started_at,
+            'duration_ms': None if self.duration is None
+                           else round(self.duration * 1e3, 3),
+            'counters': dict(sorted(self.counters.items())),
+            'spans': [span.to_dict() for span in self.spans],
+        }
+
+    def chrome_trace(self) -> dict:
+        """Spans in the Trace Event Format, which chrome://tracing,
+        Perfetto and speedscope show as a flame graph"""
+        pid = os.getpid()
+        return {
+            'traceEvents': [
+                {
+                    'name': span.name, 'ph': 'X', 'pid': pid,
+                    'tid': span.thread,
+                    'ts': span.start * 1e6, 'dur': span.duration * 1e6,
+                    'args': span.fields,
+                }
+                for span in self.spans
+            ],
+            'displayTimeUnit': 'ms',
+        }
+
+
+_trace: ContextVar[Trace | None] = ContextVar('taxmapp_trace', default=None)
+_depth: ContextVar[int] = ContextVar('taxmapp_depth', default=0)
+
+
+def current_trace() -> Trace | None:
+    return _trace.get()
+
+
+def count(name: str, n: int = 1) -> None:
+    """Increments a counter of the current trace, if any"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.count(name, n)
+
+
+@contextmanager
+def span(name: str, **fields) -> Iterator[dict[str, Any]]:
+    """Times the enclosed block as a stage of the current trace. Fields
+    can be added to the yielded dict; a `rows` field also increments
+    the `rows.<name>` counter."""
+    trace = _trace.get()
+    if trace is None and not logger.isEnabledFor(logging.DEBUG):
+        yield fields # nothing listens, nothing is recorded
+        return
+    depth = _depth.get()
+    token = _depth.set(depth + 1)
+    t0 = perf_counter()
+    try:
+        yield fields
+    finally:
+        duration = perf_counter() - t0
+        _depth.reset(token)
+        record = Span(name, t0 - trace._t0 if trace else 0.0, duration,
+                      depth, threading.get_ident(), fields)
+        if trace is not None:
+            trace.add(record)
+            if 'rows' in fields:
+                trace.count(f'rows.{name}', fields['rows'])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps({'span': record.to_dict()}, default=str))
+
+
+def timed(name: str | None = None) -> Callable[[Callable], Callable]:
+    """Decorator running the function inside a span, named after the
+    function by default. Row counts of returned tables are recorded."""
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name) as fields:
+                result = func(*args, **kwargs)
+                rows = getattr(result, 'height', None) # polars tables
+                if isinstance(rows, int):
+                    fields['rows'] = rows
+                return result
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def trace(name: str) -> Iterator[Trace]:
+    """Collects the spans and counters of a request, then logs them"""
+    current = Trace(name)
+    token = _trace.set(current)
+    try:
+        yield current
+    finally:
+        current.duration = perf_counter() - current._t0
+        _trace.reset(token)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(current.to_dict(), default=str))
+
+
+def write_trace(current: Trace, file_path: str) -> None:
+    with open(file_path, 'w') as file:
+        json.dump(current.chrome_trace(), file)
+
+
+@contextmanager
+def profile(name: str, directory: str = PROFILE_DIR) -> Iterator[Trace]:
+    """Traces and profiles a single request. Writes `<name>.prof` (cProfile
+    stats, for snakeviz, flameprof or `python -m pstats`) and
+    `<name>.trace.json` (stage spans, for Perfetto or speedscope)."""
+    os.makedirs(directory, exist_ok=True)
+    profiler = cProfile.Profile()
+    with trace(name) as current:
+        profiler.enable()
+        try:
+            yield current
+        finally:
+            profiler.disable()
+    profiler.dump_stats(os.path.join(directory, f'{name}.prof'))
+    write_trace(current, os.path.join(directory, f'{name}.trace.json'))
+
+
+class _JsonLinesFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        if message.startswith('{'):
+            return message
+        return json.dumps({'level': record.levelname, 'message': message})
+
+
+def configure_logging(level: str | int | None = LOG_LEVEL) -> None:
+    """Writes the `taxmapp` logs to stderr as JSON lines"""
+    if level is None or logger.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(_JsonLinesFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+
+
+if __name__ == '__main__':
+    sys.path.append(os.path.dirname(sys.path[0]))
+    from utils.pipelines import fill_all_taxes
+    # the pipelines record their spans in `utils.instrumentation`,
+    # not in this script's own copy of the module
+    from utils.instrumentation import profile
+
+    parser = argparse.ArgumentParser(
+        description='Profiles the tax table of a single request'
+    )
+    parser.add_argument('income', type=float)
+    parser.add_argument('assets', type=float)
+    parser.add_argument('--year', type=int, default=None)
+    parser.add_argument('--name', default='fill_all_taxes')
+    parser.add_argument('--directory', default=PROFILE_DIR)
+    args = parser.parse_args()
+    kwargs = {} if args.year is None else {'latest_year': args.year}
+    configure_logging()
+    with profile(args.name, args.directory) as current:
+        fill_all_taxes(args.income, args.assets, **kwargs)
+    for stage in current.summary():
+        print(f"{stage['name']:<32}{stage['calls']:>6}"
+              f"{stage['total_ms']:>12.3f} ms")
+    print(f'Profile written to {os.path.join(args.directory, args.name)}'
+          f'.prof and .trace.json')
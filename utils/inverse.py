@@ -0,0 +1,163 @@
+import os
+import sys
+import warnings
+
+from datetime import datetime
+from typing import Callable, Literal, TypeAlias
+
+import numpy as np
+import polars as pl
+
+sys.path.append(os.path.dirname(sys.path[0]))
+
+from utils.instrumentation import timed
+from utils.pipelines import clean_rates, get_schedule, tax_bases_by_canton
+from utils.schedules import MissingScalesError, TaxSchedule
+
+Target: TypeAlias = Literal['total', 'net_income']
+NEWTON_STEPS = 4 # on the exact formulas, from the sampled pieces
+
+
+def _income_schedules(canton: str, **kwargs) -> tuple[TaxSchedule, TaxSchedule]:
+    """Cantonal and communal income tax schedules of a canton"""
+    return tuple(
+        get_schedule(
+            canton,
+            taxable_entity = kwargs.get('taxable_entity', 'single'),
+            type_of_tax = 'income',
+            authority = authority,
+            latest_year = kwargs.get('latest_year', datetime.today().year)
+        )
+        for authority in ['canton', 'commune']
+    )
+
+
+def _invert(breakpoints: np.ndarray, values: np.ndarray, slopes: np.ndarray,
+            target: float) -> np.ndarray:
+    """Smallest amount reaching `target` on each row of non-decreasing
+    piecewise-linear functions, given their values and slopes at the
+    shared breakpoints. NaN where the target is out of reach."""
+    # the target lies in the last segment starting below it
+    idx = (values < target).sum(axis=1) - 1
+    rows = np.arange(len(values))
+    start = np.maximum(idx, 0)
+    slope = slopes[rows, start]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        amounts = breakpoints[start] + (target - values[rows, start]) / slope
+    # a target falling in a jump of the tax is reached at the breakpoint
+    amounts = np.minimum(amounts, np.append(breakpoints[1:], np.inf)[start])
+    amounts[idx < 0] = np.where(values[idx < 0, 0] == target, 0.0, np.nan)
+    amounts[(idx >= 0) & (slope <= 0)] = np.nan
+    return amounts
+
+
+def _refine(breakpoints: np.ndarray, amounts: np.ndarray,
+            tax: Callable[[np.ndarray], np.ndarray],
+            rate: Callable[[np.ndarray], np.ndarray],
+            target: float) -> np.ndarray:
+    """Newton steps from the amounts solved on the sampled pieces of
+    formula brackets to the roots of the exact `tax - target`, each kept
+    within the piece it was found in (the tax is monotone there, so it
+    holds the root unless the target falls in a jump)"""
+    start = np.searchsorted(breakpoints, amounts, side='right') - 1
+    start = np.clip(start, 0, len(breakpoints) - 1)
+    lower = breakpoints[start]
+    upper = np.append(breakpoints[1:], np.inf)[start]
+    for _ in range(NEWTON_STEPS):
+        gap, slope = tax(amounts) - target, rate(amounts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.where(slope > 0, gap / slope, 0.0)
+        amounts = np.clip(amounts - step, lower, upper)
+    return amounts
+
+
+@timed()
+def solve_income(target: float, assets: float = 0.0, on: Target = 'total',
+                 **kwargs) -> pl.DataFrame:
+    """Income needed in every commune for the `total` tax of
+    `fill_all_taxes(income, assets, **kwargs)` to equal `target` or, with
+    `on='net_income'`, for the income left after that tax to equal it.
+
+    The schedules are piecewise linear and the multipliers scale them, so
+    each commune's tax is piecewise linear in the income, with breakpoints
+    shared by its canton: the brackets are inverted exactly, one canton at
+    a time for all of its communes. Formula brackets are inverted on their
+    sampled pieces, then refined by Newton steps on the exact formulas.
+    Out of reach targets, and cantons without such scales (e.g. JU for
+    families), give nulls."""
+    if on not in ['total', 'net_income']:
+        raise ValueError('`on` should be either "total" or "net_income"')
+    table = clean_rates()
+    cantons = table.get_column('canton').to_numpy()
+    assets_bases = tax_bases_by_canton(
+        assets, table.get_column('canton').unique().to_list(), ('assets',),
+        **kwargs
+    )
+    table = table.join(assets_bases, on='canton', how='left').with_columns(
+        assets_tax = (
+            pl.col('assets_canton') * pl.col('assets_canton_base')
+            + pl.col('assets_commune') * pl.col('assets_commune_base')
+        )
+    )
+    canton_multipliers = table.get_column('income_canton').to_numpy()
+    commune_multipliers = table.get_column('income_commune').to_numpy()
+    assets_tax = table.get_column('assets_tax').to_numpy()
+    incomes = np.full(table.height, np.nan)
+    income_tax = np.full(table.height, np.nan)
+    for canton in np.unique(cantons):
+        rows = np.flatnonzero(cantons == canton)
+        m1 = canton_multipliers[rows, None]
+        m2 = commune_multipliers[rows, None]
+        try:
+            canton_schedule, commune_schedule = _income_schedules(canton,
+                                                                  **kwargs)
+        except MissingScalesError as e:
+            warnings.warn(f'No income solved in {canton} with {kwargs}: {e}')
+            continue
+        breakpoints = np.union1d(
+            0.0, np.concatenate([canton_schedule.breakpoints,
+                                 commune_schedule.breakpoints])
+        )
+        breakpoints = breakpoints[breakpoints >= 0]
+        values = (
+            assets_tax[rows, None]
+            + m1 * canton_schedule(breakpoints)
+            + m2 * commune_schedule(breakpoints)
+        )
+        slopes = (
+            m1 * canton_schedule.slopes(breakpoints)
+            + m2 * commune_schedule.slopes(breakpoints)
+        )
+        if on == 'net_income':
+            values, slopes = breakpoints - values, 1 - slopes
+        incomes[rows] = _invert(breakpoints, values, slopes, target)
+        if (canton_schedule.floors is not None
+            or commune_schedule.floors is not None):
+            def tax(x: np.ndarray) -> np.ndarray:
+                tax = (assets_tax[rows] + m1[:, 0] * canton_schedule(x)
+                       + m2[:, 0] * commune_schedule(x))
+                return x - tax if on == 'net_income' else tax
+            def rate(x: np.ndarray) -> np.ndarray:
+                rate = (m1[:, 0] * canton_schedule.marginal_rates(x)
+                        + m2[:, 0] * commune_schedule.marginal_rates(x))
+                return 1 - rate if on == 'net_income' else rate
+            incomes[rows] = _refine(breakpoints, incomes[rows], tax, rate,
+                                    target)
+        income_tax[rows] = (
+            m1[:, 0] * canton_schedule(incomes[rows])
+            + m2[:, 0] * commune_schedule(incomes[rows])
+        )
+    return (
+        table.select('canton_ID', 'canton', 'FSO_ID', 'commune')
+        .with_columns(
+            pl.Series('income', incomes, nan_to_null=True),
+            pl.Series('income_tax', income_tax, nan_to_null=True),
+            pl.Series('assets_tax', assets_tax, nan_to_null=True)
+        )
+        .with_columns(total = pl.col('income_tax') + pl.col('assets_tax'))
+        .with_columns(net_income = pl.col('income') - pl.col('total'))
+    )
+
+
+if __name__ == '__main__':
+    print(solve_income(10_000).sort('income', nulls_last=True))
@@ -1,12 +1,14 @@
+import glob
 import os
 import sys
 import warnings
 
+from dataclasses import dataclass
 from datetime import datetime
-from functools import lru_cache
-from math import log
-from typing import Callable, Literal, TypeAlias
+from functools import lru_cache, partial
+from typing import Callable, Iterator, Literal, TypeAlias, TypeVar
 
+import numpy as np
 import polars as pl
 import polars.selectors as cs
 
@@ -18,19 +20,44 @@ from utils import (
     COLNAMES_SCALES_FORMULA, TAX_AUTHORITIES,
     TAXABLE_ENTITIES,TAX_GROUPS
 )
+from utils import history, refdata
+from utils.caching import bounded_cache
+from utils.history import normalise_commune
+from utils.instrumentation import timed
+from utils.constants import FORMULA_HEADERS
+from utils.schedules import (
+    MissingScalesError, ScaleLayout, TaxSchedule, compile_schedule
+)
+from utils.scraper import DownloadJob
+from utils.workbooks import read_workbook
 
 Authority: TypeAlias = Literal['canton', 'commune', 'federal']
 TaxType: TypeAlias = Literal['income', 'assets']
 MaritalStatus: TypeAlias = Literal['all', 'single', 'with_family']
-
-
-def clean_rates(year: int = 2023) -> pl.DataFrame:
-    file_path = "data/rates/estv_rates_{}.xlsx"
-    rates = pl.read_excel(
-        file_path.format(year),
-        has_header=False, 
-        engine='xlsx2csv'
-    )
+Frame = TypeVar('Frame', pl.DataFrame, pl.LazyFrame)
+
+LABEL_COLUMNS = ['canton_ID', 'canton', 'FSO_ID', 'commune']
+TAX_COLUMNS = [
+    'federal_tax', 'cantonal_income_tax', 'communal_income_tax',
+    'cantonal_assets_tax', 'communal_assets_tax',
+    'income_tax', 'assets_tax', 'total'
+]
+
+# memory budget (MB) and time-to-live (s) of the cached tax tables
+RESULTS_CACHE_BYTES = int(os.environ.get('TAXMAPP_CACHE_MB', 256)) * 2**20
+RESULTS_CACHE_TTL = float(os.environ.get('TAXMAPP_CACHE_TTL', 3600))
+# entries of the reference data caches, sized to their key spaces: the
+# years of rates, the cantons (Conf included) x types of tax x years of
+# scales, times the taxable entities x authorities of their selections
+RATES_CACHE_ENTRIES = 32
+SCALES_CACHE_ENTRIES = 1_024
+SCHEDULE_CACHE_ENTRIES = 8_192
+TAX_BASE_CACHE_ENTRIES = 16_384
+
+
+@timed()
+def _clean_rates_workbook(file_path: str) -> pl.DataFrame:
+    rates = read_workbook(file_path)
     rates = rates.drop(cs.last())
     rates.columns = COLNAMES_RATES
     rates = rates.slice(4)
@@ -47,6 +74,19 @@ def clean_rates(year: int = 2023) -> pl.DataFrame:
     )
 
 
+@bounded_cache(max_entries=RATES_CACHE_ENTRIES)
+@timed()
+def clean_rates(year: int = 2023) -> pl.DataFrame:
+    """Multipliers of `year`, mapped from their Arrow export or from the
+    history store (the workbook is parsed only when it changes)"""
+    file_path = "data/rates/estv_rates_{}.xlsx"
+    rates = refdata.sync(file_path.format(year), _clean_rates_workbook,
+                         'rates', year)
+    if rates is None:
+        raise FileNotFoundError(f"No rates stored for {year}")
+    return rates
+
+
 def retrieve_multipliers(rates_df: pl.DataFrame, 
                          commune: str) -> dict[str, float] | None:
     multipliers = (
@@ -68,49 +108,84 @@ def retrieve_multipliers(rates_df: pl.DataFrame,
     return None if len(multipliers) == 0 else multipliers[0]
 
 
-def retrieve_multipliers_by_year(
-    commune: str, 
-    latest_year: int = datetime.today().year
-) -> dict[str, float]:
-    file_path = f"data/rates/estv_rates_{latest_year}.xlsx"
-    multipliers = None
-    while os.path.exists(file_path) and multipliers is None:
-        rates = pl.read_excel(
-            f"data/rates/estv_rates_{latest_year}.xlsx",
-            has_header=False, 
-            engine='xlsx2csv'
+def available_rates_years() -> list[int]:
+    years = {
+        int(os.path.basename(f).removeprefix('estv_rates_').removesuffix('.xlsx'))
+        for f in glob.glob("data/rates/estv_rates_*.xlsx")
+    }
+    return sorted(years.union(history.stored_years('rates')))
+
+
+@dataclass(frozen=True)
+class CommuneIndex:
+    """Communes of every available year of rates. Their multipliers are
+    looked up in the history store (`retrieve_multipliers_by_year`)."""
+    by_fso_id: dict[int, list[int]] # FSO_ID -> years
+    by_name: dict[str, list[int]] # normalised name -> FSO_IDs
+
+    def years(self, fso_id: int) -> list[int]:
+        """Years whose rates contain the commune"""
+        return self.by_fso_id.get(fso_id, [])
+
+    def resolve(self, commune: str | int, 
+                latest_year: int = datetime.today().year
+    ) -> dict[str, float] | None:
+        """Latest multipliers up to `latest_year` of a commune, given by
+        name or FSO_ID"""
+        return retrieve_multipliers_by_year(commune, latest_year)
+
+    def resolve_many(self, communes: list[str | int],
+                     latest_year: int = datetime.today().year
+    ) -> list[dict[str, float] | None]:
+        return [self.resolve(commune, latest_year) for commune in communes]
+
+
+@lru_cache
+@timed()
+def get_commune_index() -> CommuneIndex:
+    """Builds the commune index once, reading each year of rates once"""
+    by_fso_id: dict[int, list[int]] = {}
+    by_name: dict[str, list[int]] = {}
+    for year in available_rates_years():
+        communes = (
+            clean_rates(year).select('FSO_ID', 'commune')
+            .filter(pl.col('FSO_ID').is_not_null())
         )
-        rates = rates.drop(cs.last()) # last is null column
-        rates.columns = COLNAMES_RATES
-        multipliers = retrieve_multipliers(rates, commune)
-        latest_year -= 1
-    return multipliers     
+        for fso_id, commune in communes.iter_rows():
+            by_fso_id.setdefault(fso_id, []).append(year)
+            fso_ids = by_name.setdefault(normalise_commune(commune), [])
+            if fso_id not in fso_ids:
+                fso_ids.append(fso_id)
+    return CommuneIndex(by_fso_id, by_name)
 
 
-def _read_scales_from_excel(
-        canton: str, type_of_tax: TaxType = 'income',
-        latest_year: int = datetime.today().year 
-) -> pl.DataFrame | None: 
-    if type_of_tax.lower() not in ['income', 'assets']:
-        raise ValueError('`type_of_tax` should be either "income" or "assets"')
-    
-    file_path = "data/scales/{}/{}/estv_scales_{}.xlsx"
-    while (not os.path.isfile(file_path.format(type_of_tax, latest_year, canton))
-           and latest_year >= 2010):
+def retrieve_multipliers_by_year(
+    commune: str | int, 
+    latest_year: int = datetime.today().year
+) -> dict[str, float] | None:
+    """Latest multipliers up to `latest_year` of a commune, given by name
+    or FSO_ID: an indexed lookup in the history store, falling back to a
+    substring match of the name. The store holds every year of rates once
+    the commune index is built: each year is read (hence stored) once per
+    process, not at every lookup."""
+    get_commune_index()
+    return history.multipliers(commune, latest_year)
+
+
+def _scales_path(canton: str, type_of_tax: TaxType, year: int) -> str:
+    return f"data/scales/{type_of_tax}/{year}/estv_scales_{canton}.xlsx"
+
+
+def _scales_year(canton: str, type_of_tax: TaxType = 'income',
+                 latest_year: int = datetime.today().year) -> int | None:
+    """Latest year up to `latest_year` with scales, downloaded or stored"""
+    stored = history.stored_years('scales', canton, type_of_tax)
+    while latest_year >= 2010:
+        if (os.path.isfile(_scales_path(canton, type_of_tax, latest_year))
+            or latest_year in stored):
+            return latest_year
         latest_year -= 1
-    if not os.path.isfile(file_path.format(type_of_tax, latest_year, canton)):
-        warnings.warn(
-            f"File {file_path.format(type_of_tax, latest_year, canton)}"
-            f" could not be retrieved. Check validity of canton or year."
-        )
-        return None
-    
-    scales = pl.read_excel(
-        file_path.format(type_of_tax, latest_year, canton),
-        has_header=False, 
-        engine='xlsx2csv'            
-    )
-    return scales
+    return None
 
 
 def _crop_table(table: pl.DataFrame, offset: int = 4) -> pl.DataFrame:
@@ -121,18 +196,30 @@ def _crop_table(table: pl.DataFrame, offset: int = 4) -> pl.DataFrame:
     table = table.select(not_null_col_names)
     return table
 
+def _detect_layout(table: pl.DataFrame, 
+                   scales: pl.DataFrame) -> ScaleLayout:
+    """Tells the scales layout from the header row and the column count"""
+    header = table.select(scales.columns).row(3)
+    if len(header) == len(COLNAMES_SCALES_BASE):
+        return 'base'
+    if len(header) == len(COLNAMES_SCALES_FLAT):
+        return 'flat'
+    if len(header) == len(COLNAMES_SCALES_DIFF):
+        if str(header[-1]).strip() in FORMULA_HEADERS:
+            return 'formula'
+        return 'diff'
+    raise ValueError(
+        f"Unknown scales layout with {len(header)} columns: {header}"
+    )
+
 # There are 4 different main pipelines for cleaning scales
-def _clean_scales_base(
-        canton: str, type_of_tax: TaxType = 'income',
-        latest_year: int = datetime.today().year
-) -> pl.DataFrame: 
-    scales = _read_scales_from_excel(canton, type_of_tax, latest_year)
-    scales = _crop_table(scales)
+def _clean_scales_base(scales: pl.DataFrame) -> pl.DataFrame: 
     scales.columns = COLNAMES_SCALES_BASE
     return (
         scales.select(
             pl.col('canton_ID').str.replace(r'\-', '0').cast(pl.Int64),
             *COLNAMES_SCALES_BASE[1:5],
+            pl.lit('base').alias('layout'),
             pl.col('taxable_worth').cast(pl.Float64),
             pl.col('additional_percentage').cast(pl.Float64)/100,
             pl.col('base_amount_CHF').cast(pl.Float64)
@@ -140,81 +227,108 @@ def _clean_scales_base(
     )
 
 
-def _clean_scales_diff(
-        canton: str, type_of_tax: TaxType = 'income',
-        latest_year: int = datetime.today().year
-) -> pl.DataFrame: 
-    scales = _read_scales_from_excel(canton, type_of_tax, latest_year)
-    scales = _crop_table(scales)
+def _clean_scales_diff(scales: pl.DataFrame) -> pl.DataFrame: 
     scales.columns = COLNAMES_SCALES_DIFF
 
     return (
         scales.select(
             pl.col('canton_ID').cast(pl.Int64),
             *COLNAMES_SCALES_DIFF[1:5],
+            pl.lit('diff').alias('layout'),
             pl.col('to_next_CHF').cast(pl.Float64),
             pl.col('additional_percentage').cast(pl.Float64)/100
         )
     )
 
 
-def _clean_scales_flat(
-        canton: str, type_of_tax: TaxType = 'income',
-        latest_year: int = datetime.today().year
-) -> pl.DataFrame: 
-    scales = _read_scales_from_excel(canton, type_of_tax, latest_year)
-    scales = _crop_table(scales)
+def _clean_scales_flat(scales: pl.DataFrame) -> pl.DataFrame: 
     scales.columns = COLNAMES_SCALES_FLAT
 
     return (
         scales.select(
             pl.col('canton_ID').cast(pl.Int64),
             *COLNAMES_SCALES_FLAT[1:5],
+            pl.lit('flat').alias('layout'),
             pl.col('tax_rate').cast(pl.Float64)/100
         )
     )
 
 
-def _clean_scales_formula(
-        canton: str, type_of_tax: TaxType = 'income',
-        latest_year: int = datetime.today().year
-) -> pl.DataFrame: 
-    scales = _read_scales_from_excel(canton, type_of_tax, latest_year)
-    scales = _crop_table(scales)
+def _clean_scales_formula(scales: pl.DataFrame) -> pl.DataFrame: 
     scales.columns = COLNAMES_SCALES_FORMULA
 
     return (
         scales.select(
             pl.col('canton_ID').cast(pl.Int64),
             *COLNAMES_SCALES_FLAT[1:5],
+            pl.lit('formula').alias('layout'),
             pl.col('taxable_worth').cast(pl.Float64),
             pl.col("formula")
         )
     )
 
-@lru_cache
+
+CLEANING_FUNCTIONS: dict[ScaleLayout, Callable[[pl.DataFrame], pl.DataFrame]] = {
+    'base': _clean_scales_base,
+    'diff': _clean_scales_diff,
+    'flat': _clean_scales_flat,
+    'formula': _clean_scales_formula,
+}
+
+@timed()
+def _clean_scales_workbook(file_path: str) -> pl.DataFrame:
+    table = read_workbook(file_path)
+    scales = _crop_table(table)
+    layout = _detect_layout(table, scales)
+    return CLEANING_FUNCTIONS[layout](scales)
+
+@bounded_cache(max_entries=SCALES_CACHE_ENTRIES)
+@timed()
 def clean_scales(      
         canton: str, type_of_tax: str = 'income',
         latest_year: int = datetime.today().year
-) -> pl.DataFrame: 
-    kwargs = {
-        "canton": canton,
-        "type_of_tax": type_of_tax,
-        "latest_year": latest_year
-    }
-    CLEANING_FUNCTIONS = [
-        _clean_scales_base, _clean_scales_diff,
-        _clean_scales_flat, _clean_scales_formula,
-
-    ]
-    for i in range(4):
-        try: 
-            return CLEANING_FUNCTIONS[i](**kwargs)
-        except Exception as e: 
-            print(e)
-            continue
-
-@lru_cache
+) -> pl.DataFrame | None: 
+    """Scales cleaned according to their layout, which is recorded in the
+    `layout` column, mapped from their Arrow export or from the history
+    store (the workbook is parsed only when it changes)"""
+    if type_of_tax.lower() not in ['income', 'assets']:
+        raise ValueError('`type_of_tax` should be either "income" or "assets"')
+    year = _scales_year(canton, type_of_tax, latest_year)
+    if year is None:
+        warnings.warn(
+            f"File {_scales_path(canton, type_of_tax, latest_year)}"
+            f" could not be retrieved. Check validity of canton or year."
+        )
+        return None
+    return refdata.sync(_scales_path(canton, type_of_tax, year),
+                        _clean_scales_workbook, 'scales', year,
+                        canton, type_of_tax)
+
+
+def export_reference_data() -> list[str]:
+    """Exports the cleaned rates and scales of every workbook on disk to
+    memory-mappable Arrow files (see `utils.refdata`), so that processes
+    starting later map them instead of cleaning them again. Returns the
+    workbooks exported."""
+    exported = []
+    for file_path in sorted(glob.glob("data/rates/estv_rates_*.xlsx")):
+        if not refdata.is_exported(file_path):
+            year = int(os.path.basename(file_path)
+                       .removeprefix('estv_rates_').removesuffix('.xlsx'))
+            refdata.sync(file_path, _clean_rates_workbook, 'rates', year)
+            exported.append(file_path)
+    for file_path in sorted(glob.glob("data/scales/*/*/estv_scales_*.xlsx")):
+        if not refdata.is_exported(file_path):
+            type_of_tax, year = os.path.normpath(file_path).split(os.sep)[-3:-1]
+            canton = (os.path.basename(file_path)
+                      .removeprefix('estv_scales_').removesuffix('.xlsx'))
+            refdata.sync(file_path, _clean_scales_workbook, 'scales',
+                         int(year), canton, type_of_tax)
+            exported.append(file_path)
+    return exported
+
+@bounded_cache(max_entries=SCHEDULE_CACHE_ENTRIES)
+@timed()
 def select_scales(
     canton: str,
     taxable_entity: MaritalStatus = 'single',
@@ -259,109 +373,99 @@ def select_scales(
 
     return sel2
 
-@lru_cache
-def calculate_tax_base(net_worth: float, canton: str, **kwargs) -> float:
-    """Calculate taxes before applying the canton/commune-specific multipliers"""
-    ### WARNING!!! There is a eval function below which is better not to use! ###
-    scales = select_scales(
+@bounded_cache(max_entries=SCHEDULE_CACHE_ENTRIES)
+@timed()
+def get_schedule(
+    canton: str,
+    taxable_entity: MaritalStatus = 'single',
+    type_of_tax: TaxType = 'income',
+    authority: Authority = 'canton',
+    latest_year: int = datetime.today().year
+) -> TaxSchedule:
+    """Compiles the selected scales once into a vectorized tax schedule"""
+    return compile_schedule(
+        select_scales(canton, taxable_entity, type_of_tax, authority, latest_year)
+    )
+
+
+def calculate_tax_bases(net_worths: np.ndarray, canton: str, 
+                        **kwargs) -> np.ndarray:
+    """Vectorized `calculate_tax_base` over an array of amounts"""
+    schedule = get_schedule(
         canton, 
         taxable_entity = kwargs.get('taxable_entity', 'single'), 
         type_of_tax = kwargs.get('type_of_tax', 'income'),
         authority = kwargs.get('authority', 'canton'),
         latest_year = kwargs.get('latest_year', datetime.today().year)
     )
+    return schedule(net_worths)
 
-    calculation_method = scales.columns[-1] # last column index is different for each method
-    if calculation_method == 'base_amount_CHF':
-        if max(scales.get_column('base_amount_CHF')) != 0:
-            row = scales.filter(pl.col('taxable_worth') <= net_worth).to_dicts()[-1]
-            base = row['base_amount_CHF']
-            increment = row['additional_percentage'] * (net_worth - row['taxable_worth'])
-        else:
-            base = 0
-            i = 0
-            amounts = scales.get_column('taxable_worth')
-            factors = scales.get_column('additional_percentage')
-            while i < len(amounts)-1 and amounts[i+1] <= net_worth:
-                step = amounts[i+1]-amounts[i]
-                base += step * factors[i]
-                i += 1
-            increment = (net_worth - amounts[i]) * factors[i]
-        return base + increment
-    
-    if calculation_method == 'additional_percentage':
-        scales = scales.with_columns(
-            taxable_worth = pl.col('to_next_CHF').cum_sum().shift(fill_value=0),
-            base_amount_CHF = (
-                (pl.col('to_next_CHF') * pl.col('additional_percentage'))
-                .cum_sum().shift(fill_value=0)
-            ),
+@bounded_cache(max_entries=TAX_BASE_CACHE_ENTRIES)
+def calculate_tax_base(net_worth: float, canton: str, **kwargs) -> float:
+    """Calculate taxes before applying the canton/commune-specific multipliers"""
+    return float(calculate_tax_bases(net_worth, canton, **kwargs))
+
+def tax_bases_or_nan(net_worths: np.ndarray | float, canton: str,
+                     **kwargs) -> np.ndarray | float:
+    """`calculate_tax_bases` (`calculate_tax_base` for a single amount),
+    NaN where the canton has no such scales, e.g. JU for families"""
+    try:
+        if np.isscalar(net_worths):
+            return calculate_tax_base(net_worths, canton, **kwargs)
+        return calculate_tax_bases(net_worths, canton, **kwargs)
+    except MissingScalesError as e:
+        warnings.warn(f'No tax computed in {canton} with {kwargs}: {e}')
+        if np.isscalar(net_worths):
+            return np.nan
+        return np.full(len(net_worths), np.nan)
+
+@timed()
+def tax_bases_by_canton(net_worth: float, cantons: list[str],
+                        types_of_tax: tuple[TaxType, ...] = ('income', 'assets'),
+                        **kwargs) -> pl.DataFrame:
+    """Tax bases of every canton, before applying the multipliers. Null
+    where the canton has no such scales."""
+    cantons = sorted(set(cantons))
+    return pl.DataFrame([
+        pl.Series('canton', cantons, dtype=pl.String),
+        *(
+            pl.Series(
+                f'{type_of_tax}_{authority}_base',
+                np.array([
+                    tax_bases_or_nan(
+                        net_worth, canton,
+                        authority = authority,
+                        type_of_tax = type_of_tax,
+                        **kwargs
+                    )
+                    for canton in cantons
+                ], dtype=np.float64),
+                dtype = pl.Float64,
+                nan_to_null = True
+            )
+            for type_of_tax in types_of_tax
+            for authority in ['canton', 'commune']
         )
-        row = scales.filter(pl.col('taxable_worth') <= net_worth).to_dicts()[-1]
-        base = row['base_amount_CHF']
-        increment = row['additional_percentage'] * (net_worth - row['taxable_worth'])
-        return base + increment
-    
-    if calculation_method == 'tax_rate':
-        return scales[0, 'tax_rate'] * net_worth
-    
-    if calculation_method == 'formula':
-        row = scales.filter(pl.col('taxable_worth') <= net_worth).to_dicts()[-1]
-        formula: str | None = row['formula']
-        if formula:
-            return eval(formula.replace('$wert$', f'({net_worth})'))
-        else:
-            return 0
+    ])
 
-def fill_taxes(net_worth: float, **kwargs) -> pl.DataFrame:
-    """Multiply the tax base by the relative cantonal/communal multiplier"""
-    table = clean_rates()
+
+def apply_multipliers(table: Frame) -> Frame:
+    """Taxes of each row of a table holding the multipliers of the rates,
+    the tax bases of its canton (`<type_of_tax>_<authority>_base`, null
+    without scales) and the `federal_tax`. Adds the TAX_COLUMNS."""
     return (
         table.with_columns(
             cantonal_income_tax = (
-                pl.col('income_canton')
-                * pl.col('canton').map_elements(
-                    lambda x: calculate_tax_base(net_worth, x, authority='canton', **kwargs),
-                    pl.Float64
-                )
+                pl.col('income_canton') * pl.col('income_canton_base')
             ),
             communal_income_tax = (
-                pl.col('income_commune')
-                * pl.col('canton').map_elements(
-                    lambda x: calculate_tax_base(
-                        net_worth, x, authority='commune', **kwargs
-                    ),
-                    pl.Float64
-                )
+                pl.col('income_commune') * pl.col('income_commune_base')
             ),
             cantonal_assets_tax = (
-                pl.col('assets_canton')
-                * pl.col('canton').map_elements(
-                    lambda x: calculate_tax_base(
-                        net_worth, x, 
-                        authority='canton', 
-                        type_of_tax = 'assets',
-                        **kwargs
-                    ),
-                    pl.Float64
-                )
+                pl.col('assets_canton') * pl.col('assets_canton_base')
             ),
             communal_assets_tax = (
-                pl.col('assets_commune')
-                * pl.col('canton').map_elements(
-                    lambda x: calculate_tax_base(
-                        net_worth, x, 
-                        authority = 'commune',
-                        type_of_tax = 'assets',
-                        **kwargs
-                    ),
-                    pl.Float64
-                )
-            ),
-            federal_tax = calculate_tax_base(
-                net_worth, 'Conf', 
-                authority='federal',
-                **kwargs
+                pl.col('assets_commune') * pl.col('assets_commune_base')
             )
         )
         .with_columns(
@@ -372,7 +476,53 @@ def fill_taxes(net_worth: float, **kwargs) -> pl.DataFrame:
             assets_tax = (
                 pl.col('cantonal_assets_tax')
                 + pl.col('communal_assets_tax')
-            ),
+            )
+        )
+        .with_columns(
+            total = pl.col('income_tax') + pl.col('assets_tax')
+        )
+    )
+
+def _with_bases(rates: pl.DataFrame, income: float, assets: float,
+                types_of_tax: tuple[TaxType, ...] = ('income', 'assets'),
+                federal: bool = True, **kwargs) -> pl.LazyFrame:
+    """Rates joined with the income and assets bases of their cantons and
+    with the federal tax on `income`. Bases of the other types of tax, and
+    the federal tax without `federal`, are left null without computing
+    them."""
+    cantons = rates.get_column('canton').drop_nulls().to_list()
+    amounts = {'income': income, 'assets': assets}
+    federal_tax = (
+        tax_bases_or_nan(income, 'Conf', authority='federal', **kwargs)
+        if federal else np.nan
+    )
+    table = rates.lazy()
+    for type_of_tax in ['income', 'assets']:
+        if type_of_tax in types_of_tax:
+            bases = tax_bases_by_canton(amounts[type_of_tax], cantons,
+                                        (type_of_tax,), **kwargs)
+            table = table.join(bases.lazy(), on='canton', how='left')
+        else:
+            table = table.with_columns(
+                pl.lit(None, pl.Float64).alias(f'{type_of_tax}_{authority}_base')
+                for authority in ['canton', 'commune']
+            )
+    return table.with_columns(
+        federal_tax = pl.lit(None if np.isnan(federal_tax) else federal_tax,
+                             dtype=pl.Float64)
+    )
+
+
+def scan_taxes(net_worth: float, where: pl.Expr | None = None,
+               **kwargs) -> pl.LazyFrame:
+    """Lazy `fill_taxes`. The rates are filtered by `where` first, so that
+    only the cantons left get their tax bases computed."""
+    rates = clean_rates()
+    if where is not None:
+        rates = rates.filter(where)
+    return (
+        apply_multipliers(_with_bases(rates, net_worth, net_worth, **kwargs))
+        .with_columns(
             total = (
                 pl.col('cantonal_income_tax')
                 + pl.col('communal_income_tax')
@@ -381,43 +531,196 @@ def fill_taxes(net_worth: float, **kwargs) -> pl.DataFrame:
                 + pl.col('federal_tax')
             )
         )
+        .select(
+            *rates.columns,
+            'cantonal_income_tax', 'communal_income_tax',
+            'cantonal_assets_tax', 'communal_assets_tax',
+            'federal_tax', 'income_tax', 'assets_tax', 'total'
+        )
     )
 
-@lru_cache
+
+@timed()
+def fill_taxes(net_worth: float, **kwargs) -> pl.DataFrame:
+    """Multiply the tax base by the relative cantonal/communal multiplier"""
+    return scan_taxes(net_worth, **kwargs).collect()
+
+
+def scan_all_taxes(income: float, assets: float,
+                   where: pl.Expr | None = None,
+                   columns: list[str] | None = None,
+                   **kwargs) -> pl.LazyFrame:
+    """Lazy `fill_all_taxes` of the communes kept by `where`, e.g. a canton
+    or two communes: their rates are filtered first, so that only their
+    cantons get their tax bases computed. With `columns` (a subset of the
+    TAX_COLUMNS), only those follow the labels, and only the tax bases
+    they need are computed, e.g. no assets bases for the income tax."""
+    if columns is None:
+        columns = [
+            'federal_tax', 'income_tax',
+            'cantonal_income_tax', 'communal_income_tax',
+            'assets_tax', 'cantonal_assets_tax', 'communal_assets_tax',
+            'total'
+        ]
+    unknown = set(columns).difference(TAX_COLUMNS)
+    if unknown:
+        raise ValueError(f'Unknown tax columns {sorted(unknown)}:'
+                         f' choose among {TAX_COLUMNS}')
+    types_of_tax = tuple(
+        type_of_tax for type_of_tax in ['income', 'assets']
+        if any(type_of_tax in column or column == 'total'
+               for column in columns)
+    )
+    kept = pl.col('FSO_ID').is_not_null()
+    rates = clean_rates().filter(kept if where is None else kept & where)
+    return (
+        apply_multipliers(_with_bases(
+            rates, income, assets, types_of_tax,
+            federal = 'federal_tax' in columns, **kwargs
+        ))
+        .select(*LABEL_COLUMNS, *columns)
+    )
+
+
+@bounded_cache(max_bytes=RESULTS_CACHE_BYTES, ttl=RESULTS_CACHE_TTL)
+@timed()
 def fill_all_taxes(income: float, assets: float, **kwargs) -> pl.DataFrame:
     """Calculate both income and assets tax. **kwargs include latest_year=..."""
-    table_income = fill_taxes(income, **kwargs)
-    table_assets = fill_taxes(assets, **kwargs)
-    return (
-        table_income.select(
-            pl.col('canton_ID'), pl.col('canton'),
-            pl.col('FSO_ID'), pl.col('commune'),
-            pl.col('federal_tax'), pl.col('income_tax'),
-            pl.col('cantonal_income_tax'), pl.col('communal_income_tax')
+    return scan_all_taxes(income, assets, **kwargs).collect()
+
+
+def _falls_back_to(year: int, arguments: dict) -> bool:
+    """Whether a call made with `latest_year` may have read `year`'s files"""
+    return arguments.get('latest_year', datetime.today().year) >= year
+
+
+def invalidate_scales(canton: str, type_of_tax: TaxType, year: int) -> int:
+    """Drops the cached scales, schedules, tax bases and tax tables that
+    may depend on the scales of `canton` for `year`. Returns how many
+    entries were dropped."""
+    def depends(arguments: dict) -> bool:
+        return (
+            arguments['canton'] == canton
+            and arguments.get('type_of_tax', 'income') == type_of_tax
+            and _falls_back_to(year, arguments)
         )
-        .join(
-            table_assets.select(
-                pl.col('FSO_ID'), pl.col('assets_tax'),
-                pl.col('cantonal_assets_tax'), pl.col('communal_assets_tax')
-            ),
-            on = 'FSO_ID'
+    return (
+        clean_scales.cache_discard(depends)
+        + select_scales.cache_discard(depends)
+        + get_schedule.cache_discard(depends)
+        + calculate_tax_base.cache_discard(depends)
+        + fill_all_taxes.cache_discard(partial(_falls_back_to, year))
+    )
+
+
+def invalidate_rates(year: int) -> int:
+    """Drops the cached multipliers of `year` and what is derived from them"""
+    get_commune_index.cache_clear()
+    # fill_taxes reads the multipliers of a fixed year, whatever its 
+    # latest_year: every cached tax table is discarded
+    return (
+        clean_rates.cache_discard(lambda arguments: arguments['year'] == year)
+        + fill_all_taxes.cache_discard(lambda arguments: True)
+    )
+
+
+def invalidate_downloads(jobs: list[DownloadJob]) -> int:
+    """Invalidates the caches depending on the workbooks just downloaded"""
+    dropped = 0
+    for job in jobs:
+        if job.rs == 'rates':
+            dropped += invalidate_rates(job.year)
+        else:
+            dropped += invalidate_scales(TAX_GROUPS[job.taxGroup], 
+                                         job.taxType, job.year)
+    return dropped
+
+
+@timed('sweep_taxes')
+def _sweep_taxes(incomes: np.ndarray, assets: np.ndarray,
+                 first_scenario: int = 0, **kwargs) -> pl.DataFrame:
+    table = clean_rates()
+    cantons = sorted(table.get_column('canton').unique().to_list())
+    n = len(incomes)
+    amounts = {'income': incomes, 'assets': assets}
+    bases = pl.DataFrame([
+        pl.Series('scenario', np.tile(
+            np.arange(first_scenario, first_scenario + n), len(cantons)
+        )),
+        pl.Series('canton', np.repeat(cantons, n)),
+        *(
+            pl.Series(
+                f'{type_of_tax}_{authority}_base',
+                np.concatenate([
+                    tax_bases_or_nan(
+                        amounts[type_of_tax], canton,
+                        authority = authority,
+                        type_of_tax = type_of_tax,
+                        **kwargs
+                    )
+                    for canton in cantons
+                ]),
+                nan_to_null = True
+            )
+            for type_of_tax in ['income', 'assets']
+            for authority in ['canton', 'commune']
         )
-        .with_columns(
-            total = pl.col('income_tax') + pl.col('assets_tax')
+    ])
+    scenarios = pl.DataFrame([
+        pl.Series('scenario', np.arange(first_scenario, first_scenario + n)),
+        pl.Series('income', incomes),
+        pl.Series('assets', assets),
+        pl.Series('federal_tax', tax_bases_or_nan(
+            incomes, 'Conf', authority='federal', **kwargs
+        ), nan_to_null=True)
+    ])
+    return (
+        apply_multipliers(
+            table.join(bases, on='canton').join(scenarios, on='scenario')
         )
+        .select('scenario', 'income', 'assets', *LABEL_COLUMNS, *TAX_COLUMNS)
+        .sort('scenario', 'FSO_ID')
     )
 
 
+def sweep_all_taxes(incomes: np.ndarray, assets: np.ndarray,
+                    **kwargs) -> pl.DataFrame:
+    """Same as `fill_all_taxes`, for every (income, assets) pair at once.
+    Returns a long table with one row per commune and scenario."""
+    incomes = np.asarray(incomes, dtype=np.float64).ravel()
+    assets = np.asarray(assets, dtype=np.float64).ravel()
+    if incomes.shape != assets.shape:
+        raise ValueError('`incomes` and `assets` should have the same length')
+    return _sweep_taxes(incomes, assets, **kwargs)
+
+
+def iter_sweep_all_taxes(incomes: np.ndarray, assets: np.ndarray,
+                         chunk_size: int = 100, 
+                         **kwargs) -> Iterator[pl.DataFrame]:
+    """Lazily yields `sweep_all_taxes` in chunks of `chunk_size` scenarios,
+    so that large grids never sit fully in memory"""
+    incomes = np.asarray(incomes, dtype=np.float64).ravel()
+    assets = np.asarray(assets, dtype=np.float64).ravel()
+    if incomes.shape != assets.shape:
+        raise ValueError('`incomes` and `assets` should have the same length')
+    if chunk_size < 1:
+        raise ValueError('`chunk_size` should be a positive integer')
+    for start in range(0, len(incomes), chunk_size):
+        yield _sweep_taxes(
+            incomes[start:start + chunk_size],
+            assets[start:start + chunk_size],
+            first_scenario = start,
+            **kwargs
+        )
+
+
 def show_taxes(income: float, assets:float, **kwargs) -> None:
     table = fill_all_taxes(income, assets, **kwargs)
     print(table.sort(by=pl.col('total'), nulls_last=True))
 
 
 def _print_rates_table() -> None:
-    table = pl.read_excel(
-        "data/rates/estv_rates_2023.xlsx",
-        has_header=False, engine='xlsx2csv'
-    )
+    table = read_workbook("data/rates/estv_rates_2023.xlsx")
     table = table.drop(cs.last())
     table.columns = COLNAMES_RATES
     table = table.slice(4)
@@ -425,9 +728,8 @@ def _print_rates_table() -> None:
 
 
 def _print_scales_table(canton: str, type_of_tax = 'income', year=2024) -> None:
-    table = pl.read_excel(
-        f"data/scales/{type_of_tax}/{year}/estv_scales_{canton}.xlsx",
-        has_header=False, engine='xlsx2csv'
+    table = read_workbook(
+        f"data/scales/{type_of_tax}/{year}/estv_scales_{canton}.xlsx"
     )
     table = table.drop(cs.last()).drop(cs.last()).drop(cs.last())
     # table.columns = COLNAMES_SCALES_BASE
@@ -0,0 +1,104 @@
+import os
+import threading
+
+from typing import Callable
+
+import polars as pl
+import pyarrow as pa
+
+from utils import history
+from utils.instrumentation import timed
+
+# cleaned tables as uncompressed Arrow IPC files, mapped read-only so that
+# loads skip the workbooks; the tables are only ~1.5 MB and polars copies
+# the string columns into views, so this saves little per-process memory
+REFDATA_DIR = os.environ.get('TAXMAPP_REFDATA_DIR', 'cachedata/refdata')
+
+
+def _export_path(file_path: str) -> str:
+    """Arrow file mirroring the workbook location"""
+    relative = os.path.splitext(os.path.normpath(file_path))[0]
+    relative = os.path.splitdrive(relative)[1].lstrip(os.sep)
+    return os.path.join(REFDATA_DIR, relative) + '.arrow'
+
+
+def _source_metadata(file_path: str) -> dict[bytes, bytes]:
+    stat = os.stat(file_path)
+    return {
+        b'source': os.path.normpath(file_path).encode(),
+        b'mtime_ns': str(stat.st_mtime_ns).encode(),
+        b'size': str(stat.st_size).encode(),
+    }
+
+
+def map_table(arrow_path: str) -> pa.Table:
+    """Zero-copy read of an Arrow IPC file: the buffers of the table
+    point into the mapped file"""
+    with pa.memory_map(arrow_path) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def write_table(arrow_path: str, table: pa.Table) -> None:
+    """Writes atomically, so that processes mapping the previous version
+    keep reading it"""
+    os.makedirs(os.path.dirname(arrow_path), exist_ok=True)
+    tmp_path = f'{arrow_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, arrow_path)
+
+
+def is_exported(file_path: str) -> bool:
+    """Whether the export of the workbook's table is up to date"""
+    arrow_path = _export_path(file_path)
+    if not (os.path.isfile(file_path) and os.path.isfile(arrow_path)):
+        return False
+    with pa.memory_map(arrow_path) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    return metadata == _source_metadata(file_path)
+
+
+def read_exported(file_path: str) -> pl.DataFrame | None:
+    """Mapped table of the workbook, None if not exported or out of date"""
+    arrow_path = _export_path(file_path)
+    if not (os.path.isfile(file_path) and os.path.isfile(arrow_path)):
+        return None
+    table = map_table(arrow_path)
+    if table.schema.metadata != _source_metadata(file_path):
+        return None
+    return pl.from_arrow(table, rechunk=False)
+
+
+def export_table(file_path: str, table: pl.DataFrame) -> None:
+    """Stores the cleaned table of a workbook, stamped with its mtime and
+    size. Strings are kept as plain Arrow strings: views cannot be mapped."""
+    metadata = _source_metadata(file_path)
+    write_table(
+        _export_path(file_path),
+        table.rechunk().to_arrow(compat_level=pl.CompatLevel.oldest())
+        .replace_schema_metadata(metadata)
+    )
+
+
+@timed('refdata.sync')
+def sync(file_path: str, parse: Callable[[str], pl.DataFrame], kind: str,
+         year: int, canton: str = '', type_of_tax: str = ''
+) -> pl.DataFrame | None:
+    """`history.sync` behind the mapped export of the workbook's table.
+    Tables of workbooks no longer on disk come from the history store."""
+    table = read_exported(file_path)
+    if table is not None:
+        if not history.is_stored(file_path, kind, year, canton, type_of_tax):
+            # e.g. the store was deleted: store the export, without parsing
+            history.sync(file_path, lambda _: table, kind, year, canton,
+                         type_of_tax)
+        return table
+    table = history.sync(file_path, parse, kind, year, canton, type_of_tax)
+    if table is not None and os.path.isfile(file_path):
+        try:
+            export_table(file_path, table)
+        except OSError: # e.g. mapped elsewhere on Windows, try next time
+            return table
+        return read_exported(file_path)
+    return table
@@ -0,0 +1,180 @@
+from dataclasses import dataclass
+from typing import Literal, TypeAlias
+
+import numpy as np
+import polars as pl
+
+from utils.formulas import Formula, compile_derivative, compile_formula
+
+ScaleLayout: TypeAlias = Literal['base', 'diff', 'flat', 'formula']
+
+# fallback for scales without a `layout` column: the last column
+# of a cleaned scales table tells its layout apart
+LAYOUTS: dict[str, ScaleLayout] = {
+    'base_amount_CHF': 'base',
+    'additional_percentage': 'diff',
+    'tax_rate': 'flat',
+    'formula': 'formula',
+}
+# formula brackets are evaluated exactly; their linear pieces only give
+# the slopes that seed the inverse solver (see `utils.inverse`)
+FORMULA_SAMPLES = 1024 # linear pieces per formula bracket
+FORMULA_OPEN_END = 16 # the open-ended bracket is sampled up to 16x its floor
+
+
+class MissingScalesError(ValueError):
+    """No scales match the authority and taxable entity in a canton"""
+
+
+@dataclass(frozen=True, eq=False)
+class TaxSchedule:
+    """Piecewise-linear schedule: tax = base + rate * (amount - breakpoint)"""
+    breakpoints: np.ndarray
+    bases: np.ndarray
+    rates: np.ndarray
+    layout: ScaleLayout
+    # formula layouts only: the floors of the brackets, their formulas
+    # and the exact derivatives (None for brackets without one)
+    floors: np.ndarray | None = None
+    formulas: tuple[Formula | None, ...] = ()
+    derivatives: tuple[Formula | None, ...] = ()
+
+    @property
+    def kinks(self) -> np.ndarray:
+        """Amounts where the marginal rate may jump"""
+        return self.breakpoints if self.floors is None else self.floors
+
+    def _brackets(self, amounts: np.ndarray) -> np.ndarray:
+        return np.maximum(
+            np.searchsorted(self.breakpoints, amounts, side='right') - 1, 0
+        )
+
+    def _formula_brackets(self, amounts: np.ndarray) -> np.ndarray:
+        return np.maximum(
+            np.searchsorted(self.floors, amounts, side='right') - 1, 0
+        )
+
+    def _evaluate(self, functions: tuple[Formula | None, ...],
+                  amounts: np.ndarray) -> np.ndarray:
+        """Each amount through the function of its formula bracket, zero
+        in brackets without a formula"""
+        idx = self._formula_brackets(amounts)
+        values = np.zeros(amounts.shape)
+        for i, function in enumerate(functions):
+            if function is not None and (idx == i).any():
+                values[idx == i] = function(amounts[idx == i])
+        return values
+
+    def __call__(self, amounts: float | np.ndarray) -> np.ndarray:
+        """Evaluates the schedule over a scalar or a whole array of amounts.
+        Amounts below the first breakpoint fall into the first bracket.
+        Formula brackets evaluate their formula on the amounts in them."""
+        amounts = np.asarray(amounts, dtype=np.float64)
+        if self.floors is not None:
+            # log is undefined in zero: the tax of less than a franc is
+            # the tax of one franc
+            return self._evaluate(self.formulas, np.maximum(amounts, 1.0))
+        idx = self._brackets(amounts)
+        return self.bases[idx] + self.rates[idx] * (amounts - self.breakpoints[idx])
+
+    def slopes(self, amounts: float | np.ndarray) -> np.ndarray:
+        """Slope of the linear piece each amount falls into (of the
+        sampled formula, for formula brackets)"""
+        amounts = np.asarray(amounts, dtype=np.float64)
+        return self.rates[self._brackets(amounts)]
+
+    def marginal_rates(self, amounts: float | np.ndarray) -> np.ndarray:
+        """Tax on one more franc: the rate of the bracket each amount
+        falls into, or the derivative of the bracket's formula"""
+        amounts = np.asarray(amounts, dtype=np.float64)
+        if self.floors is None:
+            return self.slopes(amounts)
+        return self._evaluate(self.derivatives, np.maximum(amounts, 1.0))
+
+
+def _compile_base(scales: pl.DataFrame) -> tuple[np.ndarray, ...]:
+    breakpoints = scales.get_column('taxable_worth').to_numpy()
+    rates = scales.get_column('additional_percentage').to_numpy()
+    bases = scales.get_column('base_amount_CHF').to_numpy()
+    if not bases.any(): # zero-base tables accumulate bracket by bracket
+        bases = np.concatenate(([0.0], np.cumsum(np.diff(breakpoints) * rates[:-1])))
+    return breakpoints, bases, rates
+
+
+def _compile_diff(scales: pl.DataFrame) -> tuple[np.ndarray, ...]:
+    widths = scales.get_column('to_next_CHF').to_numpy()
+    rates = scales.get_column('additional_percentage').to_numpy()
+    breakpoints = np.concatenate(([0.0], np.cumsum(widths)[:-1]))
+    bases = np.concatenate(([0.0], np.cumsum(widths * rates)[:-1]))
+    return breakpoints, bases, rates
+
+
+def _compile_flat(scales: pl.DataFrame) -> tuple[np.ndarray, ...]:
+    return np.zeros(1), np.zeros(1), scales.get_column('tax_rate').to_numpy()[:1]
+
+
+def _compile_formula(scales: pl.DataFrame) -> tuple[np.ndarray, ...]:
+    """Samples each formula bracket on a geometric grid of linear pieces,
+    the starting point of the inverse solver"""
+    floors = scales.get_column('taxable_worth').to_list()
+    formulas = scales.get_column('formula').to_list()
+    ceilings = floors[1:] + [None]
+    breakpoints, bases, rates = [], [], []
+    for floor, ceiling, formula in zip(floors, ceilings, formulas):
+        if not formula:
+            breakpoints.append([floor])
+            bases.append([0.0])
+            rates.append([0.0])
+            continue
+        lower = max(floor, 1.0) # log is undefined in zero
+        upper = ceiling if ceiling is not None else lower * FORMULA_OPEN_END
+        samples = np.geomspace(lower, upper, FORMULA_SAMPLES + 1)
+        values = compile_formula(formula)(samples)
+        breakpoints.append(samples[:-1])
+        bases.append(values[:-1])
+        rates.append(np.diff(values) / np.diff(samples))
+    return tuple(np.concatenate(v).astype(np.float64)
+                 for v in (breakpoints, bases, rates))
+
+
+COMPILERS = {
+    'base': _compile_base,
+    'diff': _compile_diff,
+    'flat': _compile_flat,
+    'formula': _compile_formula,
+}
+
+
+def compile_schedule(scales: pl.DataFrame) -> TaxSchedule:
+    """Compiles a selection of scales (one authority and taxable entity)
+    into breakpoint, cumulative-base and marginal-rate arrays"""
+    if scales.is_empty():
+        raise MissingScalesError(
+            'Cannot compile a tax schedule from empty scales.'
+        )
+    if 'layout' in scales.columns:
+        layout = scales.get_column('layout')[0]
+    else:
+        layout = LAYOUTS[scales.columns[-1]]
+    breakpoints, bases, rates = COMPILERS[layout](scales)
+    formulas = {}
+    if layout == 'formula':
+        formulas = {
+            'floors': scales.get_column('taxable_worth').to_numpy()
+                      .astype(np.float64),
+            'formulas': tuple(
+                compile_formula(formula) if formula else None
+                for formula in scales.get_column('formula').to_list()
+            ),
+            'derivatives': tuple(
+                compile_derivative(formula) if formula else None
+                for formula in scales.get_column('formula').to_list()
+            ),
+        }
+    return TaxSchedule(
+        breakpoints = np.ascontiguousarray(breakpoints, dtype=np.float64),
+        bases = np.ascontiguousarray(bases, dtype=np.float64),
+        rates = np.ascontiguousarray(rates, dtype=np.float64),
+        layout = layout,
+        **formulas
+    )
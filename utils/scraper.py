@@ -1,94 +1,425 @@
+import gzip
+import hashlib
+import http.client
 import json
 import os
+import random
 import sys
-import urllib.request as rq
+import threading
+import zlib
 
-from urllib.error import HTTPError
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from time import monotonic, sleep
+from email.message import Message
+from typing import Callable, NamedTuple
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
 
 sys.path.append(os.path.dirname(sys.path[0]))
 
 from utils.constants import TAX_GROUPS
 
-API_URLS = {
-    'rates': (
-        "https://swisstaxcalculator.estv.admin.ch"
-        "/delegate/ost-integration/v1/export/income-tax-rates/{}"
-    ),
-    'scales': (
-        "https://swisstaxcalculator.estv.admin.ch"
-        "/delegate/ost-integration/v1/export/tax-scales/{}"
-    )
+# point TAXMAPP_ESTV_URL to a stand-in (see utils/standin.py) to work offline
+API_BASE = os.environ.get(
+    'TAXMAPP_ESTV_URL', "https://swisstaxcalculator.estv.admin.ch"
+)
+API_PATHS = {
+    'rates': "/delegate/ost-integration/v1/export/income-tax-rates/{}",
+    'scales': "/delegate/ost-integration/v1/export/tax-scales/{}"
 }
 TAX_TYPES = {
     'assets': 'VERMOEGENSSTEUER',
-    'income': 'EINKOMMENSSTEUER' 
+    'income': 'EINKOMMENSSTEUER'
 }
+HEADERS = {
+    "User-Agent":  ' '.join([
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+        "AppleWebKit/537.36 (KHTML, like Gecko)",
+        "Chrome/130.0.0.0",
+        "Safari/537.36",
+        "Edg/130.0.0.0"
+    ]),
+    "Accept": "application/json, text/plain, */*",
+    # only encodings the standard library can decode
+    "Accept-Encoding": "gzip, deflate",
+    "Accept-Language": (
+        "it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7,"
+        "de-AT;q=0.6,de;q=0.5,en-GB;q=0.4"
+    ),
+    "Connection": "keep-alive",
+    "content-type": "application/json"
+}
+MAX_WORKERS = 8
+MAX_RETRIES = 4
+BACKOFF = 0.5 # seconds, doubled at every retry
+TIMEOUT = 30
+# the server answers these when overloaded: slow down and retry
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# content hash (and validators for conditional requests) of every file
+# downloaded so far, so that unchanged workbooks are never rewritten
+MANIFEST_PATH = 'data/.manifest.json'
 
-def _try_download(taxGroup: int, year: int, 
-                  taxType: str | None = None, 
-                  rs: str = 'rates', lang: str = 'EN') -> None:
-    sleep(0.1)
-    if rs == 'scales' and taxType.lower() not in ['income', 'assets']:
+Progress = Callable[[int, int], None]
+
+
+class DownloadJob(NamedTuple):
+    taxGroup: int
+    year: int
+    taxType: str | None = None
+    rs: str = 'rates'
+    lang: str = 'EN'
+
+    @property
+    def file_path(self) -> str:
+        if self.rs == 'rates':
+            return f'./data/rates/estv_rates_{self.year}.xlsx'
+        return (
+            f'./data/scales/{self.taxType}/{self.year}'
+            f'/estv_scales_{TAX_GROUPS[self.taxGroup]}.xlsx'
+        )
+
+    @property
+    def payload(self) -> bytes:
+        payload = {
+            "taxGroup": 99,
+            "simKey": None,
+            "year": self.year
+        }
+        if self.rs == 'scales':
+            payload.update({"taxType": TAX_TYPES[self.taxType]})
+            payload["taxGroup"] = self.taxGroup
+        return json.dumps(payload).encode()
+
+
+class Response(NamedTuple):
+    status: int
+    body: bytes
+    headers: Message
+
+
+class DownloadResult(NamedTuple):
+    job: DownloadJob
+    changed: bool
+    entry: dict
+
+
+class DownloadReport(NamedTuple):
+    changed: list[DownloadJob]
+    errors: dict[DownloadJob, Exception]
+
+
+class Throttle:
+    """Minimum interval between requests shared by all the workers. It
+    doubles (up to `max_delay`) whenever the server answers 429/5xx and
+    shrinks back by 10% towards `min_delay` after every success, so that
+    the request rate settles just below what the server tolerates."""
+
+    def __init__(self, min_delay: float = 0.1, max_delay: float = 5,
+                 step: float = 0.05) -> None:
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.step = step # smallest delay after a slow down
+        self.delay = min_delay
+        self._next_slot = self._slowed_at = monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> float:
+        """Blocks until the next free slot. Returns the time it was given."""
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.delay
+        sleep(slot - now)
+        return slot
+
+    def slow_down(self, retry_after: float | None = None,
+                  sent_at: float | None = None) -> None:
+        """`retry_after` pauses every worker once, it is not the new delay.
+        Requests sent before the last slow down were already in flight at
+        the old rate: they extend the pause but do not double the delay."""
+        with self._lock:
+            now = monotonic()
+            if sent_at is None or sent_at >= self._slowed_at:
+                self.delay = min(self.max_delay, max(2 * self.delay, self.step))
+                self._slowed_at = now
+            self._next_slot = max(self._next_slot, now + (retry_after or 0))
+
+    def speed_up(self) -> None:
+        with self._lock:
+            self.delay = max(self.min_delay, 0.9 * self.delay)
+
+
+class Session:
+    """Keeps one persistent connection per thread and host, so that the
+    TLS handshake is paid once per worker instead of once per file"""
+
+    def __init__(self, throttle: Throttle | None = None,
+                 max_retries: int = MAX_RETRIES, backoff: float = BACKOFF,
+                 timeout: float = TIMEOUT, base_url: str = API_BASE) -> None:
+        self.base_url = base_url.rstrip('/')
+        self.throttle = throttle or Throttle()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._local = threading.local()
+        # every thread's connections, to close them all at once
+        self._opened: list[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def _connections(self) -> dict[tuple[str, str], http.client.HTTPConnection]:
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        return self._local.connections
+
+    def _connection(self, url: str) -> http.client.HTTPConnection:
+        parts = urlsplit(url)
+        connections = self._connections()
+        key = (parts.scheme, parts.netloc)
+        if key not in connections:
+            if parts.scheme == 'https':
+                connections[key] = http.client.HTTPSConnection(
+                    parts.netloc, timeout=self.timeout
+                )
+            else:
+                connections[key] = http.client.HTTPConnection(
+                    parts.netloc, timeout=self.timeout
+                )
+            with self._lock:
+                self._opened.append(connections[key])
+        return connections[key]
+
+    def _drop_connection(self, url: str) -> None:
+        parts = urlsplit(url)
+        connection = self._connections().pop((parts.scheme, parts.netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def close(self) -> None:
+        """Closes the connections of every thread, e.g. once the workers
+        of a pool are done"""
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for connection in opened:
+            connection.close()
+
+    def _post_once(self, url: str, data: bytes, 
+                   headers: dict[str, str]) -> Response:
+        connection = self._connection(url)
+        parts = urlsplit(url)
+        connection.request('POST', parts.path or '/', body=data, 
+                           headers={**HEADERS, **headers})
+        response = connection.getresponse()
+        body = response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            self._drop_connection(url)
+        if response.status not in (200, 304):
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, None)
+        encoding = response.getheader('Content-Encoding', '').lower()
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        return Response(response.status, body, response.headers)
+
+    def post(self, url: str, data: bytes, 
+             headers: dict[str, str] | None = None) -> Response:
+        """POST with retries and exponential backoff on 429/5xx responses
+        and dropped connections. Other HTTP errors are raised at once,
+        304 (not modified) is returned as is."""
+        for attempt in range(self.max_retries + 1):
+            sent_at = self.throttle.wait()
+            try:
+                response = self._post_once(url, data, headers or {})
+            except HTTPError as e:
+                if e.code not in RETRY_STATUSES or attempt == self.max_retries:
+                    raise
+                retry_after = e.headers.get('Retry-After')
+                self.throttle.slow_down(
+                    float(retry_after) if retry_after and retry_after.isdigit()
+                    else None,
+                    sent_at
+                )
+            except (http.client.HTTPException, OSError):
+                # stale keep-alive connection or network hiccup
+                self._drop_connection(url)
+                if attempt == self.max_retries:
+                    raise
+            else:
+                self.throttle.speed_up()
+                return response
+            sleep(self.backoff * 2**attempt * random.uniform(1, 1.5))
+
+
+_default_session = Session()
+
+
+def _file_hash(file_path: str) -> str:
+    with open(file_path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def load_manifest(manifest_path: str = MANIFEST_PATH) -> dict[str, dict]:
+    try:
+        with open(manifest_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest: dict[str, dict],
+                  manifest_path: str = MANIFEST_PATH) -> None:
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def manifest_digest(manifest_path: str = MANIFEST_PATH) -> str:
+    """Fingerprint of the downloaded data, changes with any workbook"""
+    manifest = load_manifest(manifest_path)
+    hashes = [(path, entry.get('sha256')) for path, entry in manifest.items()]
+    return hashlib.sha256(json.dumps(sorted(hashes)).encode()).hexdigest()
+
+
+def _stored_hash(file_path: str, entry: dict) -> str | None:
+    """Hash of the file on disk, trusting the manifest if untouched"""
+    if not os.path.isfile(file_path):
+        return None
+    stat = os.stat(file_path)
+    if (entry.get('mtime_ns') == stat.st_mtime_ns
+        and entry.get('size') == stat.st_size):
+        return entry.get('sha256')
+    return _file_hash(file_path)
+
+
+def download(job: DownloadJob, session: Session | None = None,
+             entry: dict | None = None) -> DownloadResult:
+    """Downloads a single workbook, rewriting it only if its content
+    changed. `entry` is its manifest record from a previous download."""
+    if job.rs == 'scales' and (job.taxType or '').lower() not in ['income', 'assets']:
         raise ValueError('`type_of_tax` should be either "income" or "assets"')
-    
-    payload = {
-        "taxGroup": 99,
-        "simKey": None,
-        "year": year
-    }
-    if rs == 'scales':
-        payload.update({"taxType": TAX_TYPES[taxType]})
-        payload["taxGroup"] = taxGroup
-    payload = json.dumps(payload)
-    req = rq.Request(
-        url = API_URLS[rs].format(lang.upper()),
-        headers = {
-            "User-Agent":  ' '.join([
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-                "AppleWebKit/537.36 (KHTML, like Gecko)", 
-                "Chrome/130.0.0.0",
-                "Safari/537.36", 
-                "Edg/130.0.0.0"
-            ]),
-            "Accept": "application/json, text/plain, */*",
-            "Accept-Encoding": "gzip, deflate, br, zstd",
-            "Accept-Language": (
-                "it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7,"
-                "de-AT;q=0.6,de;q=0.5,en-GB;q=0.4"
-            ),
-             "content-type": "application/json" 
-        },
-        data = payload.encode()
+    session = session or _default_session
+    entry = dict(entry or {})
+    filepath = job.file_path
+    stored_hash = _stored_hash(filepath, entry)
+    headers = {}
+    if stored_hash is not None and stored_hash == entry.get('sha256'):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    response = session.post(
+        session.base_url + API_PATHS[job.rs].format(job.lang.upper()),
+        job.payload, headers
     )
-    with rq.urlopen(req) as f:
-        binary_file = f.read()
-        filepath = f'./data'
-        if rs == 'rates':
-            filepath += f'/rates/estv_rates_{year}.xlsx'
-        else:
-            filepath += f'/scales/{taxType}/{year}' 
-            filepath += f'/estv_scales_{TAX_GROUPS[taxGroup]}.xlsx' 
-        if not os.path.isdir('/'.join(filepath.split('/')[:-1])):
-            os.makedirs('/'.join(filepath.split('/')[:-1]))
-        with open(filepath, 'wb') as output:
-            output.write(binary_file)
-
-
-def download_all(year: int = datetime.today().year, 
-            taxType: str | None = None, 
-            rs: str = 'rates', lang: str = 'EN') -> None:
+    if response.status == 304:
+        return DownloadResult(job, False, entry)
+    sha256 = hashlib.sha256(response.body).hexdigest()
+    changed = sha256 != stored_hash
+    if changed:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmp_path = f'{filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as output:
+            output.write(response.body)
+        os.replace(tmp_path, filepath)
+    stat = os.stat(filepath)
+    entry.update(
+        sha256 = sha256,
+        size = stat.st_size,
+        mtime_ns = stat.st_mtime_ns,
+        etag = response.headers.get('ETag'),
+        last_modified = response.headers.get('Last-Modified'),
+    )
+    return DownloadResult(job, changed, entry)
+
+
+def _try_download(taxGroup: int, year: int,
+                  taxType: str | None = None,
+                  rs: str = 'rates', lang: str = 'EN') -> None:
+    report = download_many([DownloadJob(taxGroup, year, taxType, rs, lang)],
+                           max_workers=1, session=_default_session)
+    for e in report.errors.values():
+        raise e
+
+
+def _manifest_key(job: DownloadJob) -> str:
+    return os.path.normpath(job.file_path)
+
+
+def download_many(jobs: list[DownloadJob], max_workers: int = MAX_WORKERS,
+                  progress: Progress | None = None,
+                  session: Session | None = None,
+                  manifest_path: str = MANIFEST_PATH) -> DownloadReport:
+    """Downloads the workbooks concurrently over pooled connections.
+    `progress(done, total)` is called from the calling thread after each
+    file, so it may safely update the UI. Returns the jobs whose file
+    changed and the failed ones."""
+    own_session = session is None
+    session = session or Session()
+    manifest = load_manifest(manifest_path)
+    changed, errors = [], {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(download, job, session, 
+                                manifest.get(_manifest_key(job))): job
+                for job in jobs
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                job = futures[future]
+                if future.exception() is not None:
+                    errors[job] = future.exception()
+                else:
+                    result = future.result()
+                    manifest[_manifest_key(job)] = result.entry
+                    if result.changed:
+                        changed.append(job)
+                if progress is not None:
+                    progress(done, len(jobs))
+    finally:
+        save_manifest(manifest, manifest_path)
+        if own_session:
+            session.close()
+    return DownloadReport(changed, errors)
+
+
+def year_jobs(year: int = datetime.today().year,
+              lang: str = 'EN') -> list[DownloadJob]:
+    """Every workbook of a year: income scales of each tax group, assets
+    scales of each canton (there is no federal assets tax) and rates"""
+    jobs = [DownloadJob(key, year, 'income', 'scales', lang) for key in TAX_GROUPS]
+    jobs.extend(
+        DownloadJob(key, year, 'assets', 'scales', lang)
+        for key in TAX_GROUPS if TAX_GROUPS[key] != 'Conf'
+    )
+    jobs.append(DownloadJob(99, year, lang=lang))
+    return jobs
+
+
+def download_year(year: int = datetime.today().year, lang: str = 'EN',
+                  max_workers: int = MAX_WORKERS,
+                  progress: Progress | None = None) -> DownloadReport:
+    return download_many(year_jobs(year, lang), max_workers, progress)
+
+
+def download_all(year: int = datetime.today().year,
+            taxType: str | None = None,
+            rs: str = 'rates', lang: str = 'EN',
+            max_workers: int = MAX_WORKERS,
+            progress: Progress | None = None) -> None:
     if rs == 'rates':
         _try_download(99, year)
         return
-    for key in TAX_GROUPS.keys():
-        try:
-            _try_download(key, year, taxType, rs, lang)
-        except HTTPError as e:
-            print(e)
+    jobs = [DownloadJob(key, year, taxType, rs, lang) for key in TAX_GROUPS]
+    for e in download_many(jobs, max_workers, progress).errors.values():
+        print(e)
 
 if __name__ == '__main__':
-    download_all(taxType='income', rs='scales')
-    download_all(taxType='assets', rs='scales')
-    download_all(rs='rates')
\ No newline at end of file
+    report = download_year()
+    for job in report.changed:
+        print(f'Updated {job.file_path}')
+    for job, e in report.errors.items():
+        print(job.file_path, e)
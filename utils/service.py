@@ -0,0 +1,278 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Any, Callable
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+import polars as pl
+
+sys.path.append(os.path.dirname(sys.path[0]))
+
+from utils.batch import warm_caches
+from utils.history import normalise_commune
+from utils.pipelines import (
+    available_rates_years, fill_all_taxes, get_commune_index,
+    retrieve_multipliers_by_year, scan_all_taxes, select_scales
+)
+
+MAX_BODY = 2**20 # bytes
+MAX_BATCH = 1_000 # queries per request
+LATENCY_SAMPLES = 1_024 # latest latencies kept per endpoint for percentiles
+OPTIONS = ['latest_year', 'taxable_entity'] # passed on to the pipeline
+
+
+class LatencyStats:
+    """Request count, errors and latency percentiles of an endpoint"""
+
+    def __init__(self, samples: int = LATENCY_SAMPLES) -> None:
+        self._lock = threading.Lock()
+        self._latencies: deque[float] = deque(maxlen=samples)
+        self.requests = self.errors = self.queries = 0
+        self.total = 0.0
+
+    def record(self, seconds: float, queries: int, error: bool) -> None:
+        with self._lock:
+            self.requests += 1
+            self.queries += queries
+            self.errors += error
+            self.total += seconds
+            self._latencies.append(seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            latencies = np.array(self._latencies) * 1e3
+            snapshot = {
+                'requests': self.requests,
+                'queries': self.queries,
+                'errors': self.errors,
+                'mean_ms': self.total * 1e3 / self.requests
+                           if self.requests else None,
+            }
+        for q in [50, 95, 99]:
+            snapshot[f'p{q}_ms'] = (float(np.percentile(latencies, q))
+                                    if len(latencies) else None)
+        snapshot['max_ms'] = float(latencies.max()) if len(latencies) else None
+        return snapshot
+
+
+def _options(query: dict) -> dict:
+    return {key: query[key] for key in OPTIONS if query.get(key) is not None}
+
+
+def _fso_ids(commune: str | int) -> list[int]:
+    if isinstance(commune, int) or str(commune).strip().isdigit():
+        return [int(commune)]
+    return get_commune_index().by_name.get(normalise_commune(commune), [])
+
+
+def taxes(query: dict) -> list[dict]:
+    """Rows of `fill_all_taxes`, optionally of one canton or commune"""
+    income, assets = float(query['income']), float(query['assets'])
+    if query.get('canton') is None and query.get('commune') is None:
+        return fill_all_taxes(income, assets, **_options(query)).to_dicts()
+    # only the cantons of the matching communes get their bases computed
+    where = pl.lit(True)
+    if query.get('canton') is not None:
+        where &= pl.col('canton') == query['canton']
+    if query.get('commune') is not None:
+        where &= pl.col('FSO_ID').is_in(_fso_ids(query['commune']))
+    return scan_all_taxes(
+        income, assets, where=where, **_options(query)
+    ).collect().to_dicts()
+
+
+def scales(query: dict) -> list[dict]:
+    """Rows of `select_scales`"""
+    arguments = ['taxable_entity', 'type_of_tax', 'authority', 'latest_year']
+    return select_scales(
+        query['canton'],
+        **{key: query[key] for key in arguments if query.get(key) is not None}
+    ).to_dicts()
+
+
+def commune(query: dict) -> dict | None:
+    """Latest multipliers of a commune up to `latest_year`"""
+    kwargs = {'latest_year': int(query['latest_year'])} \
+        if query.get('latest_year') is not None else {}
+    name = query['commune']
+    return retrieve_multipliers_by_year(
+        int(name) if str(name).strip().isdigit() else name, **kwargs
+    )
+
+
+# path -> handler of a single query
+ENDPOINTS: dict[str, Callable[[dict], Any]] = {
+    '/taxes': taxes,
+    '/scales': scales,
+    '/commune': commune,
+}
+
+
+class TaxService:
+    """JSON API over the tax pipeline, with caches warmed at boot.
+
+    POST a query object to an endpoint, or a list of them for a batch
+    (answered with a list, where failed queries hold an `error`). GET
+    takes a single query as url parameters. `/metrics` gives the latency
+    of each endpoint and `/health` the years available."""
+
+    def __init__(self, host: str = 'localhost', port: int = 0,
+                 years: list[int | None] | None = None,
+                 reuse_port: bool = False) -> None:
+        self.years = [None, *available_rates_years()] if years is None else years
+        warm_caches(self.years)
+        get_commune_index()
+        self.metrics = {path: LatencyStats() for path in ENDPOINTS}
+        server_class = type('Server', (ThreadingHTTPServer,),
+                            {'allow_reuse_port': reuse_port})
+        self._server = server_class((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def answer(self, path: str, payload: Any) -> tuple[int, Any]:
+        """Status and body of a request, timed in the endpoint's metrics"""
+        if path == '/health':
+            return 200, {'status': 'ok', 'pid': os.getpid(),
+                         'years': available_rates_years()}
+        if path == '/metrics':
+            return 200, {
+                'pid': os.getpid(),
+                'endpoints': {p: m.snapshot() for p, m in self.metrics.items()}
+            }
+        if path not in ENDPOINTS:
+            return 404, {'error': f'Unknown endpoint {path}'}
+        endpoint = ENDPOINTS[path]
+        t0 = perf_counter()
+        status, error = 200, False
+        if isinstance(payload, list):
+            if len(payload) > MAX_BATCH:
+                status, body = 413, {'error': f'More than {MAX_BATCH} queries'}
+            else:
+                body = [self._query(endpoint, query) for query in payload]
+                error = any(isinstance(b, dict) and 'error' in b for b in body)
+        else:
+            body = self._query(endpoint, payload)
+            if isinstance(body, dict) and 'error' in body:
+                status = body.pop('status')
+        self.metrics[path].record(
+            perf_counter() - t0,
+            len(payload) if isinstance(payload, list) else 1,
+            error or status != 200
+        )
+        return status, body
+
+    @staticmethod
+    def _query(endpoint: Callable[[dict], Any], query: Any) -> Any:
+        if not isinstance(query, dict):
+            return {'status': 400, 'error': 'A query should be an object'}
+        try:
+            return endpoint(query)
+        except KeyError as e:
+            return {'status': 400, 'error': f'Missing parameter {e}'}
+        except (TypeError, ValueError) as e:
+            return {'status': 400, 'error': str(e)}
+        except Exception as e:
+            return {'status': 500, 'error': f'{type(e).__name__}: {e}'}
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+            def _reply(self, status: int, body: Any) -> None:
+                data = json.dumps(body, default=str).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self) -> None:
+                url = urlsplit(self.path)
+                query = dict(parse_qsl(url.query))
+                if 'latest_year' in query and query['latest_year'].isdigit():
+                    query['latest_year'] = int(query['latest_year'])
+                self._reply(*service.answer(url.path, query))
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get('Content-Length', 0))
+                if length > MAX_BODY:
+                    self.close_connection = True
+                    return self._reply(413, {'error': 'Request too large'})
+                try:
+                    payload = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    return self._reply(400, {'error': 'Invalid JSON'})
+                self._reply(*service.answer(urlsplit(self.path).path, payload))
+
+        return Handler
+
+    def start(self) -> 'TaxService':
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'TaxService':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def _serve(host: str, port: int, years: list[int | None] | None,
+           reuse_port: bool) -> None:
+    TaxService(host, port, years, reuse_port).serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=TaxService.__doc__)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8600)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes sharing the port (SO_REUSEPORT)')
+    parser.add_argument('--year', type=int, action='append', dest='years',
+                        help='years to warm up (default: every year)')
+    args = parser.parse_args()
+    # each worker warms its own caches, the kernel spreads the connections
+    workers = [
+        multiprocessing.get_context('spawn').Process(
+            target=_serve,
+            args=(args.host, args.port, args.years, args.workers > 1)
+        )
+        for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    print(f'Serving taxes at http://{args.host}:{args.port}'
+          f' with {args.workers} worker(s)')
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
@@ -0,0 +1,203 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+
+sys.path.append(os.path.dirname(sys.path[0]))
+
+from utils.constants import TAX_GROUPS
+from utils.scraper import API_PATHS, TAX_TYPES
+
+LANGUAGES = ['DE', 'FR', 'IT', 'EN']
+XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class EstvStandIn:
+    """Local stand-in of the ESTV export API serving the workbooks found
+    in `data_dir`. It accepts the same requests as the real service and
+    can add latency, random failures (503) and a rate limit (429)."""
+
+    def __init__(self, data_dir: str = 'data', host: str = 'localhost',
+                 port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 failure_rate: float = 0.0, rate_limit: float | None = None,
+                 etags: bool = True, seed: int | None = None) -> None:
+        self.data_dir = os.path.abspath(data_dir)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.rate_limit = rate_limit
+        self.etags = etags
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent: deque[float] = deque()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+        self.reset_stats()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.statuses: Counter[int] = Counter()
+            self.connections = 0
+            self.bytes_sent = 0
+            self._active = self.max_concurrency = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'requests': sum(self.statuses.values()),
+                'statuses': dict(sorted(self.statuses.items())),
+                'connections': self.connections,
+                'bytes_sent': self.bytes_sent,
+                'max_concurrency': self.max_concurrency,
+            }
+
+    def file_path(self, path: str, payload: dict) -> str | None:
+        """Workbook answering a request, None if the request is invalid"""
+        for rs, template in API_PATHS.items():
+            prefix = template.format('')
+            if not path.startswith(prefix):
+                continue
+            if path.removeprefix(prefix).upper() not in LANGUAGES:
+                return None
+            year = payload.get('year')
+            if not isinstance(year, int):
+                return None
+            if rs == 'rates':
+                return os.path.join(self.data_dir, 'rates',
+                                    f'estv_rates_{year}.xlsx')
+            tax_types = {value: key for key, value in TAX_TYPES.items()}
+            if (payload.get('taxType') not in tax_types
+                or payload.get('taxGroup') not in TAX_GROUPS):
+                return None
+            return os.path.join(
+                self.data_dir, 'scales', tax_types[payload['taxType']],
+                str(year), f'estv_scales_{TAX_GROUPS[payload["taxGroup"]]}.xlsx'
+            )
+        return None
+
+    def _rate_limited(self) -> bool:
+        if self.rate_limit is None:
+            return False
+        with self._lock:
+            now = monotonic()
+            while self._recent and now - self._recent[0] > 1:
+                self._recent.popleft()
+            if len(self._recent) >= self.rate_limit:
+                return True
+            self._recent.append(now)
+            return False
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+            def setup(self) -> None:
+                super().setup()
+                with standin._lock:
+                    standin.connections += 1
+
+            def _reply(self, status: int, body: bytes = b'',
+                       headers: dict[str, str] | None = None) -> None:
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with standin._lock:
+                    standin.statuses[status] += 1
+                    standin.bytes_sent += len(body)
+
+            def do_POST(self) -> None:
+                with standin._lock:
+                    standin._active += 1
+                    standin.max_concurrency = max(standin.max_concurrency,
+                                                  standin._active)
+                try:
+                    self._serve()
+                finally:
+                    with standin._lock:
+                        standin._active -= 1
+
+            def _serve(self) -> None:
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    payload = json.loads(self.rfile.read(length))
+                except ValueError:
+                    return self._reply(400)
+                sleep(standin.latency
+                      + standin.jitter * standin._random.random())
+                if standin._rate_limited():
+                    return self._reply(429, headers={'Retry-After': '1'})
+                if standin._random.random() < standin.failure_rate:
+                    return self._reply(503)
+                file_path = standin.file_path(self.path, payload)
+                if file_path is None:
+                    return self._reply(400)
+                if not os.path.isfile(file_path):
+                    return self._reply(404)
+                with open(file_path, 'rb') as file:
+                    body = file.read()
+                headers = {'Content-Type': XLSX}
+                if standin.etags:
+                    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+                    if self.headers.get('If-None-Match') == etag:
+                        return self._reply(304, headers={'ETag': etag})
+                    headers['ETag'] = etag
+                self._reply(200, body, headers)
+
+        return Handler
+
+    def start(self) -> 'EstvStandIn':
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'EstvStandIn':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=EstvStandIn.__doc__)
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=None)
+    args = parser.parse_args()
+    standin = EstvStandIn(args.data_dir, port=args.port, latency=args.latency,
+                          jitter=args.jitter, failure_rate=args.failure_rate,
+                          rate_limit=args.rate_limit)
+    print(f'Serving {standin.data_dir} at {standin.url}'
+          f' (TAXMAPP_ESTV_URL={standin.url})')
+    standin.serve_forever()
@@ -0,0 +1,114 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+
+from typing import Callable
+
+import polars as pl
+
+from utils.instrumentation import timed
+
+CACHE_DIR = 'cachedata/workbooks'
+WORKBOOK_PATTERNS = [
+    'data/rates/*.xlsx',
+    'data/scales/income/*/*.xlsx',
+    'data/scales/assets/*/*.xlsx',
+]
+
+
+def _file_hash(file_path: str) -> str:
+    with open(file_path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def _cache_paths(file_path: str) -> tuple[str, str]:
+    """Parquet file and its json sidecar mirroring the workbook location"""
+    relative = os.path.splitext(os.path.normpath(file_path))[0]
+    relative = os.path.splitdrive(relative)[1].lstrip(os.sep)
+    cached = os.path.join(CACHE_DIR, relative)
+    return cached + '.parquet', cached + '.json'
+
+
+def _read_sidecar(sidecar_path: str) -> dict:
+    try:
+        with open(sidecar_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_atomically(path: str, write: Callable[[str], None]) -> None:
+    """Concurrent readers never see a half-written file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_sidecar(sidecar_path: str, sidecar: dict) -> None:
+    def write(path: str) -> None:
+        with open(path, 'w') as file:
+            json.dump(sidecar, file)
+    _write_atomically(sidecar_path, write)
+
+
+def is_cached(file_path: str) -> bool:
+    """Whether the cache of the workbook is up to date (by mtime, then hash)"""
+    parquet_path, sidecar_path = _cache_paths(file_path)
+    if not os.path.isfile(parquet_path):
+        return False
+    sidecar = _read_sidecar(sidecar_path)
+    stat = os.stat(file_path)
+    if (sidecar.get('mtime_ns') == stat.st_mtime_ns
+        and sidecar.get('size') == stat.st_size):
+        return True
+    if sidecar.get('sha256') != _file_hash(file_path):
+        return False
+    # touched but unchanged: refresh the mtime to skip hashing next time
+    sidecar.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+    _write_sidecar(sidecar_path, sidecar)
+    return True
+
+
+@timed('parse_workbook')
+def ingest_workbook(file_path: str) -> pl.DataFrame:
+    """Parses the workbook and stores it as parquet, whatever the cache"""
+    table = pl.read_excel(file_path, has_header=False, engine='xlsx2csv')
+    parquet_path, sidecar_path = _cache_paths(file_path)
+    stat = os.stat(file_path)
+    sidecar = {
+        'source': os.path.normpath(file_path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': _file_hash(file_path),
+    }
+    _write_atomically(parquet_path, table.write_parquet)
+    _write_sidecar(sidecar_path, sidecar)
+    return table
+
+
+@timed()
+def read_workbook(file_path: str) -> pl.DataFrame:
+    """Drop-in for `pl.read_excel(file_path, has_header=False)` that reads
+    from the parquet cache, rebuilding it only when the workbook changes"""
+    if is_cached(file_path):
+        return pl.read_parquet(_cache_paths(file_path)[0])
+    return ingest_workbook(file_path)
+
+
+def ingest_workbooks(patterns: list[str] = WORKBOOK_PATTERNS) -> list[str]:
+    """Caches every workbook not cached yet. Returns the rebuilt ones."""
+    rebuilt = []
+    for pattern in patterns:
+        for file_path in sorted(glob.glob(pattern)):
+            if not is_cached(file_path):
+                ingest_workbook(file_path)
+                rebuilt.append(file_path)
+    return rebuilt
+
+
+if __name__ == '__main__':
+    for file_path in ingest_workbooks():
+        print(f'Cached {file_path}')